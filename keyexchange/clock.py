@@ -0,0 +1,250 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Clocks used for the TTLs.
+
+Clock gives the time in seconds since the epoch, as time.time() does, but
+it's monotonic: it's the wall-clock time when the clock was created, plus
+the monotonic time elapsed since. NTP steps can't make entries expire
+early or live forever. With a resolution, the value is cached and
+refreshed every resolution seconds by a ticker thread. If the ticker
+stops, the clock reads the time on every call instead.
+
+The ticker does not survive a fork. On Python 3.7+, a fork hook starts a
+new one in the child. Otherwise the cached clock compares the pid with
+the one that started the ticker on every call, and starts a new ticker
+in a child.
+
+With a resolution of 0, there's no ticker and the clock calls
+time.time() on every call, never going backwards. Reading the monotonic
+time through ctypes on Python 2 costs about 20 times more, which is too
+much for a request path.
+
+The shared clock is cached when there are fork hooks. On Python 2, the
+pid check makes a cached read slower than time.time() (0.25us against
+0.18us), so it uses a resolution of 0.
+
+Every structure that has TTLs takes a clock option. It defaults to the
+clock shared by the process, see get_clock(). VirtualClock can be used
+instead to control the time, in tests or to replay past traffic.
+"""
+import os
+import sys
+import time
+import atexit
+import threading
+from os import getpid
+from functools import partial
+
+_time = time.time
+# Python 3.7+
+_AT_FORK = hasattr(os, 'register_at_fork')
+
+
+def _linux_monotonic():
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                        use_errno=True)
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        spec = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+
+    monotonic()
+    return monotonic
+
+
+def _monotonic_source():
+    # None if there's none, time.time() is used then
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if sys.platform.startswith('linux'):
+        try:
+            return _linux_monotonic()
+        except (ImportError, OSError, AttributeError):
+            pass
+    return None
+
+
+_MONOTONIC = _monotonic_source()
+
+
+class _Ticker(threading.Thread):
+    """Refreshes the time of a clock."""
+
+    def __init__(self, clock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.clock = clock
+        self.running = True
+
+    def run(self):
+        clock = self.clock
+        try:
+            while self.running:
+                time.sleep(clock.resolution)
+                # time.time() can go backwards, when it's the source
+                clock.now = max(clock.now, clock.read())
+        except Exception, e:
+            try:
+                from keyexchange.filtering import logger
+                logger.error('The clock ticker stopped: %s' % str(e))
+            except Exception:
+                # the interpreter is shutting down
+                pass
+        finally:
+            # a stale cached time would freeze every TTL
+            clock.time = clock._clamped
+
+
+class Clock(object):
+    """Coarse monotonic clock.
+
+    time() returns the time, at most resolution seconds old. If
+    resolution is 0, there's no ticker and time() returns time.time(),
+    or the last value it returned if the time went backwards.
+    """
+    def __init__(self, resolution=0.01):
+        # may come from a config file
+        self.resolution = resolution = float(resolution)
+        if _MONOTONIC is None:
+            self._source, self._offset = time.time, 0
+        else:
+            self._source = _MONOTONIC
+            self._offset = time.time() - _MONOTONIC()
+        self.now = self._last = self.read()
+        self._ticker = self._pid = None
+        if resolution:
+            self._start()
+            if _AT_FORK:
+                # calls getattr(self, 'now') without running any Python
+                # code
+                self.time = partial(getattr, self, 'now')
+                os.register_at_fork(after_in_child=self._forked)
+            else:
+                self.time = self._cached
+            # before the modules are torn down
+            atexit.register(self.stop)
+        else:
+            self.time = self._clamped
+
+    def __reduce__(self):
+        if self is _shared[0]:
+            return get_clock, ()
+        return Clock, (self.resolution,)
+
+    def _start(self):
+        self._pid = getpid()
+        self.now = max(self.now, self.read())
+        self._ticker = _Ticker(self)
+        self._ticker.start()
+
+    def _forked(self):
+        if self._ticker is not None:
+            # the ticker stayed in the parent
+            self._start()
+
+    def _cached(self):
+        if self._pid != getpid():
+            # forked: the ticker stayed in the parent
+            self._start()
+        return self.now
+
+    def _clamped(self):
+        now = _time()
+        if now < self._last:
+            return self._last
+        self._last = now
+        return now
+
+    def read(self):
+        """Reads the monotonic time, without the cache."""
+        return self._source() + self._offset
+
+    def stop(self):
+        if self._ticker is not None and self._pid == getpid():
+            self._ticker.running = False
+            self._ticker.join()
+        self._ticker = None
+        self.time = self._clamped
+
+
+class VirtualClock(object):
+    """A clock that returns the time it's set to."""
+
+    def __init__(self, now=0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+_shared = [None]
+_shared_lock = threading.Lock()
+
+
+def get_clock():
+    """Returns the clock shared by the process, created on first use.
+
+    It's cached with a resolution of 10ms when the interpreter has fork
+    hooks, and reads time.time() on every call otherwise.
+    """
+    clock = _shared[0]
+    if clock is not None:
+        return clock
+    _shared_lock.acquire()
+    try:
+        if _shared[0] is None:
+            if _AT_FORK:
+                _shared[0] = Clock()
+            else:
+                _shared[0] = Clock(0)
+        return _shared[0]
+    finally:
+        _shared_lock.release()
@@ -71,11 +71,25 @@ IPv6ranges = {
     }
 
 
-class IPint:
+class IPint(object):
     """Handling of IP addresses returning integers.
 
     Use class IP instead because some features are not implemented for
-    IPint."""
+    IPint.
+
+    Instances use __slots__ so that large lists of networks don't pay for
+    a per-object __dict__. The printing flags NoPrefixForSingleIp and
+    WantPrefixLen fall back to class-level defaults and only take room
+    once they are set on an instance."""
+
+    __slots__ = ('ip', '_ipversion', '_prefixlen', '_noprefix',
+                 '_wantprefixlen')
+
+    # Print no Prefixlen for /32 and /128
+    _NoPrefixForSingleIp = 1
+
+    # Do we want prefix printed by default? see _printPrefix()
+    _WantPrefixLen = None
 
     def __init__(self, data, ipversion=0, make_net=0):
         """Create an instance of an IP object.
@@ -106,12 +120,6 @@ class IPint:
         See module documentation for more examples.
         """
 
-        # Print no Prefixlen for /32 and /128
-        self.NoPrefixForSingleIp = 1
-
-        # Do we want prefix printed by default? see _printPrefix()
-        self.WantPrefixLen = None
-
         netbits = 0
         prefixlen = -1
 
@@ -207,6 +215,43 @@ class IPint:
         else:
             raise TypeError("Unsupported data type: %s" % type(data))
 
+    def _getNoPrefixForSingleIp(self):
+        try:
+            return self._noprefix
+        except AttributeError:
+            return self._NoPrefixForSingleIp
+
+    def _setNoPrefixForSingleIp(self, value):
+        self._noprefix = value
+
+    NoPrefixForSingleIp = property(_getNoPrefixForSingleIp,
+                                   _setNoPrefixForSingleIp)
+
+    def _getWantPrefixLen(self):
+        try:
+            return self._wantprefixlen
+        except AttributeError:
+            return self._WantPrefixLen
+
+    def _setWantPrefixLen(self, value):
+        self._wantprefixlen = value
+
+    WantPrefixLen = property(_getWantPrefixLen, _setWantPrefixLen)
+
+    def __getstate__(self):
+        # objects with __slots__ and no __dict__ need this to be pickled
+        state = {}
+        for name in IPint.__slots__:
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def int(self):
         """Return the first / base / network addess as an (long) integer.
 
@@ -728,6 +773,8 @@ class IPint:
 class IP(IPint):
     """Class for handling IP addresses and networks."""
 
+    __slots__ = ()
+
     def net(self):
         """Return the base (first) address of a network as an IP object.
 
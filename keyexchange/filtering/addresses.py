@@ -0,0 +1,132 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Bounded LRU cache of parsed client addresses.
+
+The same clients poll the server over and over, so parsing their address
+once and keeping the (integer, version) result around avoids re-parsing
+it for every whitelist, deny list or blacklist network lookup.
+"""
+import threading
+
+from keyexchange.filtering.importer import parse_address
+
+# indexes in a cache entry
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class AddressCache(object):
+    """Thread-safe LRU cache of IP string -> (integer, version).
+
+    Unparseable IPs are cached as None.
+    """
+    def __init__(self, size=10000, parser=parse_address):
+        self.size = size
+        self._parser = parser
+        self._lock = threading.Lock()
+        self._entries = {}
+        # circular doubly linked list, oldest entries are on the right
+        # of the root.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self.hits = self.misses = 0
+
+    def parse(self, ip):
+        """Returns an (integer, version) tuple, or None if ip is invalid."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(ip)
+            if entry is not None:
+                self._unlink(entry)
+                self._link(entry)
+                self.hits += 1
+                return entry[_VALUE]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        # parsing out of the lock
+        try:
+            value = self._parser(ip)
+        except ValueError:
+            value = None
+
+        self._lock.acquire()
+        try:
+            if ip not in self._entries:
+                entry = [None, None, ip, value]
+                self._link(entry)
+                self._entries[ip] = entry
+                if len(self._entries) > self.size:
+                    oldest = self._root[_NEXT]
+                    self._unlink(oldest)
+                    del self._entries[oldest[_KEY]]
+        finally:
+            self._lock.release()
+        return value
+
+    def _link(self, entry):
+        # adds the entry as the most recent one
+        root = self._root
+        last = root[_PREV]
+        entry[_PREV], entry[_NEXT] = last, root
+        last[_NEXT] = root[_PREV] = entry
+
+    def _unlink(self, entry):
+        prev, next = entry[_PREV], entry[_NEXT]
+        prev[_NEXT], next[_PREV] = next, prev
+
+    def hit_ratio(self):
+        """Returns the ratio of lookups served from the cache."""
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.
+        return float(self.hits) / total
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ip):
+        return ip in self._entries
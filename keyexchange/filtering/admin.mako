@@ -29,5 +29,8 @@
     <input type="submit"></input>
    </form>
    %endif
+   %if next_page:
+   <a href="${next_page | h}">Next page</a>
+   %endif
  </body>
 </html>
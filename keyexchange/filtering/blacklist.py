@@ -45,41 +45,99 @@ calls. If an IP as a high number of calls, it's blacklisted.
 
 For the bad request counter, the same technique is used.
 
-Blacklisted IPs are kept in memory with a TTL.
+Blacklisted IPs are kept in memory with a TTL. Expiry times are also kept
+in a heap, so expired entries are dropped as soon as their TTL is over,
+even if the IP never comes back.
+
+Membership checks don't take any lock: they read an immutable view of the
+blacklist that writers publish by swapping a reference once they are done.
+
+Networks in CIDR notation can be blacklisted as well, and once enough
+addresses from the same network are blacklisted they can be replaced by
+a single entry for the whole network.
 """
 import time
+import heapq
+import bisect
 import threading
 
+from keyexchange.clock import get_clock
+from keyexchange.filtering.IPy import IP
+from keyexchange.filtering.importer import parse_address, canonical_address
+from keyexchange.filtering.sync import ADD, REMOVE
+from keyexchange.filtering.bloom import BloomFilter
+from keyexchange.filtering.transports import MemcacheTransport
+from keyexchange.filtering.codec import encode, decode
+from keyexchange.filtering.disk import write_atomic, read_mapped
+from keyexchange.filtering.offenders import OffenderHistory
+
+_BITS = {4: 32, 6: 128}
+# marks the entries removed since the last full view
+_REMOVED = object()
+
 
 class _Syncer(threading.Thread):
+    """Syncs the blacklist.
 
-    def __init__(self, blacklist, frequency=5):
+    The thread wakes up when a change is made locally, when the next entry
+    expires, when a checkpoint is due, or every frequency seconds to poll
+    the transport. Local changes made within delay seconds are pushed
+    together.
+    """
+    def __init__(self, blacklist, frequency=5, delay=0.005):
         threading.Thread.__init__(self)
         self.blacklist = blacklist
         self.frequency = frequency
-        self.running = False
+        self.delay = delay
+        # set here so join() works even before the thread runs
+        self.running = True
+        self._changed = threading.Event()
+
+    def notify(self):
+        self._changed.set()
+
+    def _timeout(self):
+        timeout = self.frequency
+        now = self.blacklist._clock.time()
+        for deadline in (self.blacklist._next_expiry(),
+                         self.blacklist._next_checkpoint):
+            if deadline is None:
+                continue
+            deadline = max(0, deadline - now)
+            if timeout is None or deadline < timeout:
+                timeout = deadline
+        return timeout
+
+    def _sync(self):
+        try:
+            self.blacklist.expire()
+            if self.blacklist.outsynced:
+                self.blacklist.save()
+            else:
+                self.blacklist.update()
+            self.blacklist.checkpoint()
+        except Exception, e:
+            # in case something goes wrong
+            # we log it but don't want our thread to die.
+            from keyexchange.filtering import logger
+            logger.error(str(e))
 
     def run(self):
-        self.running = True
         while self.running:
+            self._changed.wait(self._timeout())
+            if self._changed.isSet():
+                self._changed.clear()
+                if self.running:
+                    # coalescing the changes made in a burst
+                    time.sleep(self.delay)
             # this syncs the blacklist
-            try:
-                if self.blacklist.outsynced:
-                    self.blacklist.save()
-                else:
-                    self.blacklist.update()
-            except Exception, e:
-                # in case something goes wrong
-                # we log it but don't want our thread to die.
-                from keyexchange.filtering import logger
-                logger.error(str(e))
-
-            time.sleep(self.frequency)
+            self._sync()
 
     def join(self):
         if not self.running:
             return
         self.running = False
+        self._changed.set()
         threading.Thread.join(self)
 
 
@@ -87,31 +145,137 @@ class Blacklist(object):
     """IP Blacklist with TTL and memcache support.
 
     IPs are saved/loaded from Memcached so several apps can share the
-    blacklist.
+    blacklist. Only the changes are exchanged, see
+    keyexchange.filtering.sync. Another transport can be used to push the
+    changes to the other nodes instead, see
+    keyexchange.filtering.transports.
+
+    Entries are IPs or networks in CIDR notation. Networks are indexed by
+    prefix length, so checking an IP against them costs one dict lookup
+    per distinct prefix length.
+
+    If subnet_treshold is set, once that many IPs from the same network
+    (of subnet_prefixlen bits for IPv4, subnet_prefixlen6 for IPv6) are
+    blacklisted, they are replaced by the network.
+
+    If bloom_error_rate is set, a Bloom filter of the entries is published
+    with each view and checked before the entries. It pays off when
+    entries lookups are costlier than hashing the IP, e.g. for very large
+    blacklists.
+
+    If snapshot_path is set, the blacklist is loaded from that file on
+    startup, and written to it every snapshot_frequency seconds by
+    checkpoint(), so a restarted node doesn't depend on memcache to get
+    its bans back. Callables in checkpoint_callbacks are called at each
+    checkpoint, to save other state along with the blacklist.
+
+    If escalation_factor is set, the TTL of a ban is multiplied by
+    escalation_factor ** (number of previous bans of the entry), capped
+    at max_ttl. Previous bans are counted in an OffenderHistory, fed by
+    local bans and by the bans received from the other nodes.
+
+    Expiries are computed with clock, the shared keyexchange.clock.Clock
+    by default.
     """
-    def __init__(self, cache_server=None, frequency=5, async=True):
+    def __init__(self, cache_server=None, frequency=5, async=True,
+                 parse=None, subnet_treshold=None, subnet_prefixlen=24,
+                 subnet_prefixlen6=64, compact_every=100,
+                 bloom_error_rate=None, transport=None, sync_delay=0.005,
+                 snapshot_path=None, snapshot_frequency=60,
+                 escalation_factor=None, max_ttl=None, history_size=100000,
+                 history_half_life=86400, clock=None):
         self._ttls = {}
+        if clock is None:
+            clock = get_clock()
+        self._clock = clock
         self._cache_server = cache_server
+        if transport is None and cache_server is not None:
+            transport = MemcacheTransport(cache_server, frequency,
+                                          compact_every)
+        self._transport = transport
+        # the changes not pushed yet
+        self._changes = []
         self.ips = set()
+        # entries loaded without being recorded, kept out of the
+        # snapshots
+        self._local = set()
         self._dirty = False
         self._lock = threading.RLock()
+        self._parse = parse
+        self.subnet_treshold = subnet_treshold
+        self._subnet_prefixlen = {4: subnet_prefixlen, 6: subnet_prefixlen6}
+        # (version, prefixlen) -> {network >> host bits: entry}
+        self._networks = {}
+        # (version, network) -> blacklisted IPs of that network
+        self._subnets = {}
+        # heap of (expiry, entry). Entries that were removed or
+        # re-added with another TTL are skipped when popped.
+        self._expiries = []
+        # what readers see: (entries, recent changes, networks index,
+        # bloom filter or None). Published views are never modified.
+        self.bloom_error_rate = bloom_error_rate
+        self._bloom_capacity = 0
+        self.escalation_factor = escalation_factor
+        self.max_ttl = max_ttl
+        if escalation_factor is not None:
+            self._history = OffenderHistory(history_size, history_half_life)
+        else:
+            self._history = None
+        self._view = {}, {}, {}, None
+        # (view, sorted entries) used by page()
+        self._sorted = None, []
+        self._pending = {}
+        self._networks_changed = False
+        self.snapshot_path = snapshot_path
+        self.snapshot_frequency = snapshot_frequency
+        self.checkpoint_callbacks = []
+        self._next_checkpoint = None
+        if snapshot_path is not None:
+            self.restore()
+            self._next_checkpoint = self._clock.time() + snapshot_frequency
+        if transport is not None:
+            transport.attach(self)
         self.async = async
+        self._syncer = None
         if self.async:
-            self._syncer = _Syncer(self, frequency=frequency)
+            if transport is not None:
+                frequency = transport.frequency
+            else:
+                frequency = None
+            self._syncer = _Syncer(self, frequency, sync_delay)
             # sys.exit() call all threads join() in >= 2.6.5
             self._syncer.start()
 
     def __getstate__(self):
         odict = self.__dict__.copy()
         del odict['_lock']
-        if self.async:
-            del odict['_syncer']
+        del odict['_parse']
+        del odict['_view']
+        del odict['_sorted']
+        odict['_syncer'] = None
+        odict['checkpoint_callbacks'] = []
         return odict
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        if self.async:
-            self._lock = threading.RLock()
+        self._lock = threading.RLock()
+        self._parse = None
+        self._view = {}, {}, {}, None
+        self._sorted = None, []
+        self._networks_changed = True
+        self._publish(rebuild=True)
+        if self._transport is not None:
+            self._transport.attach(self)
+
+    def close(self):
+        """Stops the syncer, pushes the pending changes and closes the
+        transport."""
+        if self._syncer is not None:
+            self._syncer.join()
+        self.save()
+        self.checkpoint(force=True)
+        if self._transport is not None:
+            self._transport.close()
 
     def _get_dirty(self):
         # hiding it behind a property since
@@ -120,80 +284,527 @@ class Blacklist(object):
 
     outsynced = property(_get_dirty)
 
+    def _parse_address(self, ip):
+        if self._parse is not None:
+            return self._parse(ip)
+        try:
+            return parse_address(ip)
+        except ValueError:
+            return None
+
     def update(self):
-        """Loads the IP list from memcached."""
-        if self._cache_server is None:
+        """Loads the changes made by the other nodes."""
+        if self._transport is None:
             return
         self._lock.acquire()
         try:
-            self._update()
+            self._transport.poll()
+            self._publish()
         finally:
             self._lock.release()
 
-    def _update(self):
-        data = self._cache_server.get('keyexchange:blacklist')
-        # merging the memcached values
-        if data is not None:
-            ips, ttls = data
-            # get new blacklisted IP
-            if not self.ips.issuperset(ips):
-                self.ips.union(ips)
-                self._ttls.update(ttls)
+    def receive(self, records):
+        """Applies change records pushed by another node."""
+        self._lock.acquire()
+        try:
+            self._apply(records)
+            self._publish()
+        finally:
+            self._lock.release()
+
+    def _apply(self, records):
+        # applies remote changes, without recording them
+        now = self._clock.time()
+        history = self._history
+        for op, elmt, expiry in records:
+            if op == ADD:
+                if expiry is not None and expiry <= now:
+                    # expired already
+                    continue
+                if (history is not None and expiry is not None and
+                    not self._is_active(elmt, now)):
+                    history.offend(elmt, now, expiry)
+                self._set(elmt, expiry)
+            elif op == REMOVE:
+                if history is not None:
+                    history.forget(elmt)
+                if elmt in self.ips:
+                    self._remove(elmt, record=False)
 
     def save(self):
-        """Save the IP into memcached if needed."""
-        if self._cache_server is None or not self._dirty:
+        """Pushes the local changes if needed."""
+        if self._transport is None or not self._dirty:
             return
 
         self._lock.acquire()
         try:
-            # XXX will use CAS/GETS once pylibmc 1.1.2 is released
-            self._update()
-            data = self.ips, self._ttls
-            if not self._cache_server.set('keyexchange:blacklist', data):
-                from keyexchange.filtering import logger
-                logger.error('Could not update the backlist')
+            self._transport.poll()
+            self._expire()
+            changes, self._changes = self._changes, []
+            self._transport.publish(changes)
             self._dirty = False
+            self._publish()
+        finally:
+            self._lock.release()
+
+    def entries(self):
+        """Returns a mapping of the entries to their expiry, or None."""
+        self._lock.acquire()
+        try:
+            return self._ttls.copy()
         finally:
             self._lock.release()
 
+    def dump(self, path):
+        """Writes the blacklist to a file, atomically."""
+        self._lock.acquire()
+        try:
+            local = self._local
+            entries = [(elmt, expiry)
+                       for elmt, expiry in self._ttls.iteritems()
+                       if elmt not in local]
+        finally:
+            self._lock.release()
+        write_atomic(path, encode(entries))
+        return len(entries)
+
+    def restore(self, path=None):
+        """Loads the entries of a file written by dump().
+
+        Entries that expired in the meantime are skipped. Returns the
+        number of entries read, 0 if the file does not exist.
+        """
+        if path is None:
+            path = self.snapshot_path
+        data = read_mapped(path)
+        if data is None:
+            return 0
+        try:
+            entries = decode(data)
+        finally:
+            data.close()
+
+        self._lock.acquire()
+        try:
+            self._apply([(ADD, elmt, expiry) for elmt, expiry in entries])
+            self._publish(rebuild=True)
+        finally:
+            self._lock.release()
+        return len(entries)
+
+    def checkpoint(self, now=None, force=False):
+        """Writes the snapshot file and calls checkpoint_callbacks, if
+        snapshot_frequency seconds passed since the last checkpoint."""
+        if self._next_checkpoint is None:
+            return False
+        if now is None:
+            now = self._clock.time()
+        if not force and now < self._next_checkpoint:
+            return False
+        self._next_checkpoint = now + self.snapshot_frequency
+        self.dump(self.snapshot_path)
+        for callback in self.checkpoint_callbacks:
+            callback()
+        return True
+
+    def _snapshot(self):
+        # (entry, expiry) of the whole blacklist, for transports that
+        # write snapshots. Called with the lock held.
+        local = self._local
+        return [(elmt, self._ttls[elmt]) for elmt in self.ips
+                if elmt not in local]
+
+    def _record(self, op, elmt, expiry=None):
+        if self._transport is not None:
+            self._changes.append((op, elmt, expiry))
+            if self._syncer is not None:
+                self._syncer.notify()
+        self._dirty = True
+
+    def _schedule(self, elmt, expiry):
+        if expiry is not None:
+            heapq.heappush(self._expiries, (expiry, elmt))
+
+    def _next_expiry(self):
+        # a hint for the syncer, read without the lock
+        try:
+            return self._expiries[0][0]
+        except IndexError:
+            return None
+
+    def expire(self, now=None):
+        """Removes the entries whose TTL is over.
+
+        Returns the number of removed entries.
+        """
+        self._lock.acquire()
+        try:
+            removed = self._expire(now)
+            if removed:
+                self._publish()
+            return removed
+        finally:
+            self._lock.release()
+
+    def _expire(self, now=None):
+        if now is None:
+            now = self._clock.time()
+        expiries = self._expiries
+        removed = 0
+        while expiries and expiries[0][0] <= now:
+            expiry, elmt = heapq.heappop(expiries)
+            # skipping stale heap entries
+            if elmt in self._ttls and self._ttls[elmt] == expiry:
+                # every node expires its entries on its own
+                self._remove(elmt, record=False)
+                removed += 1
+        return removed
+
+    def _normalize(self, elmt):
+        # networks are stored with their canonical notation
+        if '/' not in elmt:
+            return elmt
+        return IP(elmt, make_net=True).strCompressed(1)
+
+    def _index(self, network):
+        network = IP(network)
+        version, prefixlen = network.version(), network.prefixlen()
+        hostbits = _BITS[version] - prefixlen
+        networks = self._networks.setdefault((version, prefixlen), {})
+        networks[network.int() >> hostbits] = network.strCompressed(1)
+        self._networks_changed = True
+
+    def _unindex(self, network):
+        network = IP(network)
+        version, prefixlen = network.version(), network.prefixlen()
+        networks = self._networks.get((version, prefixlen))
+        if networks is None:
+            return
+        hostbits = _BITS[version] - prefixlen
+        networks.pop(network.int() >> hostbits, None)
+        if not networks:
+            del self._networks[version, prefixlen]
+        self._networks_changed = True
+
+    def _subnet_key(self, elmt):
+        address = self._parse_address(elmt)
+        if address is None:
+            return None
+        ip, version = address
+        hostbits = _BITS[version] - self._subnet_prefixlen[version]
+        return version, ip >> hostbits << hostbits
+
+    def _escalate(self, elmt, ttl):
+        # keeps track of the IPs per network, and replaces them by the
+        # network once there are subnet_treshold of them.
+        key = self._subnet_key(elmt)
+        if key is None:
+            return
+        members = self._subnets.setdefault(key, set())
+        members.add(elmt)
+        if len(members) < self.subnet_treshold:
+            return
+        del self._subnets[key]
+        version, network = key
+        network = IP(network, ipversion=version)
+        network = network.make_net(self._subnet_prefixlen[version])
+        for member in members:
+            if member in self.ips:
+                self._remove(member)
+        self._add(network.strCompressed(1), ttl)
+
+    def _set(self, elmt, expiry):
+        if '/' in elmt:
+            self._index(elmt)
+        self._local.discard(elmt)
+        self.ips.add(elmt)
+        self._ttls[elmt] = expiry
+        self._pending[elmt] = expiry
+        self._schedule(elmt, expiry)
+
+    def _ban_ttl(self, elmt, ttl, now):
+        # escalates the TTL of repeat offenders
+        ttl = ttl * self.escalation_factor ** self._history.score(elmt, now)
+        if self.max_ttl is not None:
+            ttl = min(ttl, self.max_ttl)
+        return ttl
+
+    def _is_active(self, elmt, now):
+        expiry = self._ttls.get(elmt, _REMOVED)
+        return expiry is not _REMOVED and (expiry is None or expiry > now)
+
+    def _add(self, elmt, ttl):
+        elmt = self._normalize(elmt)
+        if ttl is not None:
+            now = self._clock.time()
+            expiry = now + ttl
+            if self._history is None:
+                pass
+            elif self._is_active(elmt, now):
+                # requests in flight when the ban was made, or another
+                # treshold crossed by the same request: it's the same
+                # offence, it's not escalated again
+                current = self._ttls[elmt]
+                if current is None or current >= expiry:
+                    return
+            else:
+                expiry = now + self._ban_ttl(elmt, ttl, now)
+                self._history.offend(elmt, now, expiry)
+        else:
+            expiry = None
+        self._set(elmt, expiry)
+        self._record(ADD, elmt, expiry)
+
     def add(self, elmt, ttl=None):
         self._lock.acquire()
         try:
-            self.ips.add(elmt)
+            # amortizing the expiry on writes
+            self._expire()
+            self._add(elmt, ttl)
+            if self.subnet_treshold and '/' not in elmt:
+                self._escalate(elmt, ttl)
+            self._publish()
+        finally:
+            self._lock.release()
+
+    def load(self, ttls, discard=(), record=False):
+        """Adds many IPs at once.
+
+        ttls maps IPs or networks to a TTL in seconds, or None. Entries
+        listed in discard are removed first. All of this happens under a
+        single lock acquisition, so the list can be swapped without readers
+        seeing it half-loaded.
+
+        Unless record is True, the changes are local to this node: they
+        are not sent to the other nodes and are left out of the
+        snapshots. Every node loads its own feeds.
+        """
+        now = self._clock.time()
+        expires = {}
+        for elmt, ttl in ttls.iteritems():
             if ttl is not None:
-                self._ttls[elmt] = time.time() + ttl
+                ttl = now + ttl
+            expires[self._normalize(elmt)] = ttl
+
+        self._lock.acquire()
+        try:
+            for elmt in discard:
+                elmt = self._normalize(elmt)
+                if elmt in self.ips:
+                    self._remove(elmt, record)
+            for elmt, expiry in expires.iteritems():
+                if '/' in elmt:
+                    self._index(elmt)
+                if expiry is not None:
+                    self._expiries.append((expiry, elmt))
+                if record:
+                    self._record(ADD, elmt, expiry)
+            heapq.heapify(self._expiries)
+            self.ips.update(expires)
+            self._ttls.update(expires)
+            if record:
+                self._local.difference_update(expires)
             else:
-                self._ttls[elmt] = None
-            self._dirty = True
+                self._local.update(expires)
+            self._publish(rebuild=True)
         finally:
             self._lock.release()
 
+    def _remove(self, elmt, record=True):
+        self.ips.remove(elmt)
+        del self._ttls[elmt]
+        self._local.discard(elmt)
+        self._pending[elmt] = _REMOVED
+        if '/' in elmt:
+            self._unindex(elmt)
+        elif self._subnets:
+            key = self._subnet_key(elmt)
+            members = self._subnets.get(key)
+            if members is not None:
+                members.discard(elmt)
+                if not members:
+                    del self._subnets[key]
+        if record:
+            self._record(REMOVE, elmt)
+
     def remove(self, elmt):
         self._lock.acquire()
         try:
-            self.ips.remove(elmt)
-            del self._ttls[elmt]
-            self._dirty = True
+            elmt = self._normalize(elmt)
+            if self._history is not None:
+                # unbanned by hand, it starts over
+                self._history.forget(elmt)
+            self._remove(elmt)
+            self._publish()
         finally:
             self._lock.release()
 
-    def __contains__(self, elmt):
+    def _canonical(self, elmt):
+        # the notation entries are stored with. Raises a ValueError if
+        # elmt is not an IP or a network.
+        if '/' in elmt:
+            return self._normalize(elmt)
+        return canonical_address(elmt)
+
+    def edit(self, add=None, remove=()):
+        """Adds and removes entries by hand.
+
+        add maps IPs or networks to a TTL in seconds, or None. TTLs are
+        not escalated, and removed entries are forgotten by the offender
+        history. Added entries are checked first, and a ValueError is
+        raised if one is invalid, without changing anything. Then everything
+        happens under a single lock acquisition and is pushed with a
+        single save(). Returns the lists of added and removed entries.
+        """
+        if add is None:
+            add = {}
+        now = self._clock.time()
+        canonical = []
+        for elmt in remove:
+            try:
+                canonical.append(self._canonical(elmt))
+            except ValueError:
+                # may have been added as is, e.g. by add()
+                canonical.append(elmt)
+        remove = canonical
+        expiries = []
+        for elmt, ttl in add.iteritems():
+            if ttl is not None:
+                ttl = now + float(ttl)
+            expiries.append((self._canonical(elmt), ttl))
+
+        added, removed = [], []
+        self._lock.acquire()
+        try:
+            for elmt in remove:
+                if self._history is not None:
+                    self._history.forget(elmt)
+                if elmt in self.ips:
+                    self._remove(elmt)
+                    removed.append(elmt)
+            for elmt, expiry in expiries:
+                self._set(elmt, expiry)
+                self._record(ADD, elmt, expiry)
+                added.append(elmt)
+            self._publish()
+        finally:
+            self._lock.release()
+        self.save()
+        return added, removed
+
+    def page(self, after=None, prefix=None, limit=100):
+        """Returns up to limit (entry, expiry) in entry order, and the
+        cursor of the next page or None.
+
+        Only the entries after the after cursor and starting with prefix
+        are returned.
+        """
+        limit = max(1, limit)
         self._lock.acquire()
         try:
-            found = elmt in self.ips
-            if found:
-                ttl = self._ttls[elmt]
-                if ttl is None:
-                    return True
-                if self._ttls[elmt] - time.time() <= 0:
-                    # this will not provocate a deadlock
-                    # since we use a Re-entrant lock.
-                    self.remove(elmt)
-                    return False
-            return found
+            if self._expire():
+                self._publish()
+            view, keys = self._sorted
+            if view is not self._view:
+                keys = sorted(self.ips)
+                self._sorted = self._view, keys
+            if prefix is not None:
+                start = bisect.bisect_left(keys, prefix)
+            else:
+                start = 0
+            if after is not None:
+                start = max(start, bisect.bisect_right(keys, after))
+            page = []
+            for elmt in keys[start:start + limit + 1]:
+                if prefix is not None and not elmt.startswith(prefix):
+                    break
+                page.append((elmt, self._ttls[elmt]))
         finally:
             self._lock.release()
+        if len(page) > limit:
+            page = page[:limit]
+            return page, page[-1][0]
+        return page, None
+
+    def _publish(self, rebuild=False):
+        # builds a new view out of the current one and the pending
+        # changes. The recent changes are folded in a full copy once
+        # they get bigger than the square root of the blacklist size, so
+        # a write costs O(sqrt(n)) amortized.
+        entries, recent, networks, bloom = self._view
+        if self._networks_changed:
+            networks = dict([(key, dict(index)) for key, index
+                             in self._networks.items()])
+            self._networks_changed = False
+
+        if rebuild or len(recent) + len(self._pending) > \
+                max(64, len(entries) ** .5):
+            entries, recent = self._ttls.copy(), {}
+            if self.bloom_error_rate is not None:
+                self._bloom_capacity = 2 * len(entries) + 1024
+                bloom = self._build_bloom(entries, self._bloom_capacity)
+        elif self._pending:
+            recent = dict(recent)
+            recent.update(self._pending)
+            if bloom is not None:
+                bloom = bloom.copy()
+                for elmt, expiry in self._pending.iteritems():
+                    if expiry is not _REMOVED:
+                        bloom.add(elmt)
+                if bloom.count > self._bloom_capacity:
+                    bloom = self._build_bloom(self._ttls,
+                                              2 * self._bloom_capacity)
+
+        self._pending = {}
+        self._view = entries, recent, networks, bloom
+
+    def _build_bloom(self, entries, capacity):
+        bloom = BloomFilter.for_capacity(capacity, self.bloom_error_rate)
+        for elmt in entries:
+            bloom.add(elmt)
+        return bloom
+
+    def _active(self, elmt, entries, recent, now):
+        expiry = recent.get(elmt, _REMOVED)
+        if expiry is _REMOVED:
+            if elmt in recent:
+                return False
+            expiry = entries.get(elmt, _REMOVED)
+            if expiry is _REMOVED:
+                return False
+        return expiry is None or expiry > now
+
+    def __contains__(self, elmt):
+        # lock-free: this only reads the current view
+        entries, recent, networks, bloom = self._view
+        if bloom is None or elmt in bloom:
+            # _active() inlined, and the clock is only read for the
+            # entries that have a TTL
+            expiry = recent.get(elmt, _REMOVED)
+            if expiry is _REMOVED and elmt not in recent:
+                expiry = entries.get(elmt, _REMOVED)
+            if expiry is None:
+                return True
+            if expiry is not _REMOVED and expiry > self._clock.time():
+                return True
+        if not networks or '/' in elmt:
+            return False
+
+        address = self._parse_address(elmt)
+        if address is None:
+            return False
+        now = self._clock.time()
+        ip, version = address
+        bits = _BITS[version]
+        for (netversion, prefixlen), index in networks.iteritems():
+            if netversion != version:
+                continue
+            network = index.get(ip >> (bits - prefixlen))
+            if network is not None and self._active(network, entries,
+                                                    recent, now):
+                return True
+        return False
 
     def __len__(self):
+        self.expire()
         return len(self.ips)
@@ -0,0 +1,156 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Bloom filter.
+
+A compact, probabilistic set: a negative answer is always right, a positive
+one is wrong with a probability close to the configured error rate. Items
+can't be removed, so the filter is rebuilt from scratch from time to time.
+"""
+import math
+import threading
+from hashlib import md5
+import struct
+
+from keyexchange.clock import get_clock
+
+_HASHES = struct.Struct('<QQ')
+
+
+class BloomFilter(object):
+    """Bloom filter over strings, stored in a bytearray."""
+
+    def __init__(self, size, hashes):
+        # size is in bits, rounded up to a whole byte
+        self.size = (size + 7) // 8 * 8
+        self.hashes = hashes
+        self.bits = bytearray(self.size // 8)
+        self.count = 0
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """Returns a filter sized for capacity items at error_rate."""
+        capacity = max(capacity, 1)
+        size = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(int(math.ceil(size)), hashes)
+
+    def _positions(self, item):
+        # double hashing out of a single md5 digest
+        first, second = _HASHES.unpack(md5(item).digest())
+        second |= 1
+        size = self.size
+        return [(first + index * second) % size
+                for index in xrange(self.hashes)]
+
+    def add(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def copy(self):
+        bloom = BloomFilter(self.size, self.hashes)
+        bloom.bits[:] = self.bits
+        bloom.count = self.count
+        return bloom
+
+    def tostring(self):
+        """Serializes the filter."""
+        return struct.pack('<IBI', self.size, self.hashes,
+                           self.count) + str(self.bits)
+
+    @classmethod
+    def fromstring(cls, data):
+        size, hashes, count = struct.unpack('<IBI', data[:9])
+        bloom = cls(size, hashes)
+        bloom.bits[:] = data[9:]
+        bloom.count = count
+        return bloom
+
+
+class RotatingBloomFilter(object):
+    """Bloom filter of the items added during the last period seconds.
+
+    Items are added to the current generation, which becomes the previous
+    one after period seconds, then gets dropped after another period. An
+    item is found for at least period seconds after being added.
+    """
+    def __init__(self, capacity, error_rate=0.01, period=300, clock=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.period = period
+        if clock is None:
+            clock = get_clock()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._rotation = clock.time() + period
+        self._generations = self._new(), self._new()
+
+    def _new(self):
+        return BloomFilter.for_capacity(self.capacity, self.error_rate)
+
+    def _rotate(self, now):
+        if now < self._rotation:
+            return
+        current, __ = self._generations
+        if now >= self._rotation + self.period:
+            # nothing was added for a whole period
+            current = self._new()
+        self._generations = self._new(), current
+        self._rotation = now + self.period
+
+    def add(self, item, now=None):
+        if now is None:
+            now = self._clock.time()
+        self._lock.acquire()
+        try:
+            self._rotate(now)
+            self._generations[0].add(item)
+        finally:
+            self._lock.release()
+
+    def __contains__(self, item):
+        # lock-free, generations are swapped as a whole
+        current, previous = self._generations
+        return item in current or item in previous
@@ -0,0 +1,153 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Compact binary encoding of blacklist entries.
+
+The blob starts with a header, then one section per kind of entry::
+
+    header: 'KXBL', format version (1 byte), then the number of IPv4,
+            IPv6 and other entries (3 x 4 bytes)
+    IPv4:   addresses (4 bytes each), then expiries (4 bytes each)
+    IPv6:   addresses (16 bytes each), then expiries (4 bytes each)
+    other:  expiries (4 bytes each), then the entries as text, one per line
+
+Everything is big-endian. Expiries are epoch seconds rounded up, 0 meaning
+no expiry. Addresses are sorted, so two blobs can be merged in one pass.
+Networks, and addresses that are not written in their canonical form, go
+in the other section.
+
+Columns are unpacked in bulk with array, never record by record.
+"""
+import sys
+import math
+import socket
+import struct
+from array import array
+
+MAGIC = 'KXBL'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('>4sBIII')
+_SIZES = ((socket.AF_INET, 4), (socket.AF_INET6, 16))
+
+
+def _pack_expiries(expiries):
+    packed = array('I', [int(math.ceil(expiry or 0))
+                         for expiry in expiries])
+    if sys.byteorder == 'little':
+        packed.byteswap()
+    return packed.tostring()
+
+
+def _unpack_expiries(data, offset, count):
+    expiries = array('I')
+    expiries.fromstring(data[offset:offset + count * 4])
+    if sys.byteorder == 'little':
+        expiries.byteswap()
+    return [expiry or None for expiry in expiries]
+
+
+def _pack(family, elmt):
+    # the packed address, if elmt is an address in its canonical form
+    try:
+        packed = socket.inet_pton(family, elmt)
+    except (socket.error, ValueError):
+        return None
+    if socket.inet_ntop(family, packed) != elmt:
+        return None
+    return packed
+
+
+def encode(entries):
+    """Encodes a list of (entry, expiry) into a string."""
+    sections = ([], [])
+    others = []
+    for elmt, expiry in entries:
+        index = int(':' in elmt)
+        packed = _pack(_SIZES[index][0], elmt)
+        if packed is None:
+            others.append((elmt, expiry))
+        else:
+            sections[index].append((packed, expiry))
+
+    parts = [_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections[0]),
+                          len(sections[1]), len(others))]
+    for section in sections:
+        section.sort()
+        parts.append(''.join([packed for packed, __ in section]))
+        parts.append(_pack_expiries([expiry for __, expiry in section]))
+    parts.append(_pack_expiries([expiry for __, expiry in others]))
+    parts.append('\n'.join([elmt for elmt, __ in others]))
+    return ''.join(parts)
+
+
+def decode(data):
+    """Decodes a string made by encode() into a list of (entry, expiry).
+
+    Raises a ValueError if the data is not in a known format.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError('Truncated blacklist blob')
+    magic, version, count4, count6, count = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a blacklist blob')
+    if version != FORMAT_VERSION:
+        raise ValueError('Unknown blacklist blob version %d' % version)
+
+    if len(data) < _HEADER.size + count4 * 8 + count6 * 20 + count * 4:
+        raise ValueError('Truncated blacklist blob')
+
+    entries = []
+    offset = _HEADER.size
+    for (family, size), total in zip(_SIZES, (count4, count6)):
+        end = offset + total * size
+        packed = [data[start:start + size]
+                  for start in xrange(offset, end, size)]
+        if family == socket.AF_INET:
+            addresses = map(socket.inet_ntoa, packed)
+        else:
+            addresses = [socket.inet_ntop(family, address)
+                         for address in packed]
+        entries.extend(zip(addresses, _unpack_expiries(data, end, total)))
+        offset = end + total * 4
+
+    expiries = _unpack_expiries(data, offset, count)
+    offset += count * 4
+    if count:
+        others = data[offset:].split('\n')
+        if len(others) != count:
+            raise ValueError('Truncated blacklist blob')
+        entries.extend(zip(others, expiries))
+    return entries
@@ -0,0 +1,184 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+The request counters the filtering policies decide on.
+
+IPFiltering and the shadow policies both feed every request to a
+RequestCounters, and blacklist what it reports over its treshold:
+
+- the IP, when its count in the queue of the last callers or the queue
+  of its route goes over the treshold. Requests add the cost of their
+  route instead of 1, see keyexchange.filtering.routes.
+- the network of the IP, when its count goes over the treshold of its
+  prefix level, see keyexchange.filtering.prefixes.
+- the IP, when its bad requests go over br_treshold.
+"""
+from keyexchange.filtering.ipqueue import StripedIPQueue
+from keyexchange.filtering.routes import Router
+from keyexchange.filtering.prefixes import PrefixCounters
+from keyexchange.filtering.addresses import AddressCache
+
+
+def _split(value):
+    # config values are lists, or strings separated by whitespace or
+    # commas
+    if isinstance(value, basestring):
+        return value.replace(',', ' ').split()
+    return value
+
+
+def _compile_statuses(statuses):
+    # expands classes like 4xx into the codes they cover. statuses can be
+    # a list, a string or a single code, as the config gives them.
+    if isinstance(statuses, basestring):
+        statuses = _split(statuses)
+    elif not isinstance(statuses, (list, tuple, set, frozenset)):
+        statuses = [statuses]
+    codes = set()
+    for status in statuses:
+        status = str(status).lower()
+        if status.endswith('xx'):
+            codes.update(['%s%02d' % (status[0], code)
+                          for code in range(100)])
+        else:
+            codes.add(status)
+    return frozenset(codes)
+
+
+def _parse_levels(levels):
+    # 'prefixlen:treshold' strings -> [(prefixlen, treshold)]
+    if levels is None:
+        return []
+    parsed = []
+    for level in _split(levels):
+        prefixlen, treshold = level.split(':')
+        parsed.append((int(prefixlen), int(treshold)))
+    return parsed
+
+
+class RequestCounters(object):
+    """Counts the requests and bad requests of each IP and network.
+
+    parse is the function turning an IP into an (integer, version) tuple,
+    or None. Only used for the prefix levels.
+    """
+    def __init__(self, treshold=20, queue_size=200, br_treshold=5,
+                 br_queue_size=20, ip_queue_ttl=360, route_costs=None,
+                 bad_statuses=('400',), prefix_tresholds=None,
+                 prefix_tresholds6=None, prefix_window=60,
+                 prefix_counters_size=100000, queue_stripes=16,
+                 parse=None, clock=None):
+        self.treshold = treshold
+        self.br_treshold = br_treshold
+        self.bad_statuses = _compile_statuses(bad_statuses)
+        self.last_ips = StripedIPQueue(queue_size, ip_queue_ttl,
+                                       queue_stripes, clock)
+        self.last_br_ips = StripedIPQueue(br_queue_size, ip_queue_ttl,
+                                          queue_stripes, clock)
+        if route_costs is None:
+            self.router = None
+            self.route_ips = {}
+        else:
+            if isinstance(route_costs, basestring):
+                route_costs = [route_costs]
+            self.router = Router(route_costs)
+            self.route_ips = dict([(route, StripedIPQueue(queue_size,
+                                                          ip_queue_ttl,
+                                                          queue_stripes,
+                                                          clock))
+                                   for route in self.router.routes
+                                   if route.treshold is not None])
+        levels = {4: _parse_levels(prefix_tresholds),
+                  6: _parse_levels(prefix_tresholds6)}
+        if levels[4] or levels[6]:
+            self.prefixes = PrefixCounters(levels, prefix_window,
+                                           prefix_counters_size, clock)
+        else:
+            self.prefixes = None
+        if parse is None:
+            parse = AddressCache().parse
+        self._parse = parse
+
+    def hit(self, ip, method=None, path=''):
+        """Counts a request of ip.
+
+        Returns (over, network): True if ip went over the treshold or the
+        one of its route, and the network of ip that went over its
+        treshold, or None.
+        """
+        cost, queue = 1, None
+        if self.router is not None:
+            route = self.router.match(method, path)
+            if route is not None:
+                cost, queue = route.cost, self.route_ips.get(route)
+        over = self.last_ips.append(ip, cost) >= self.treshold
+        if queue is not None:
+            over = queue.append(ip, cost) >= route.treshold or over
+
+        network = None
+        if self.prefixes is not None:
+            address = self._parse(ip)
+            if address is not None:
+                network = self.prefixes.hit(address, cost)
+        return over, network
+
+    def is_bad(self, status):
+        """Tells if a response status is a bad request."""
+        return status is not None and status[:3] in self.bad_statuses
+
+    def hit_bad(self, ip):
+        """Counts a bad request of ip. Returns True if it went over
+        br_treshold."""
+        return self.last_br_ips.append(ip) >= self.br_treshold
+
+    def networks(self, ip):
+        """Returns the counted networks of ip, most specific first."""
+        if self.prefixes is None:
+            return []
+        address = self._parse(ip)
+        if address is None:
+            return []
+        return self.prefixes.networks(address)
+
+    def remove(self, ip):
+        """Drops ip from the counters."""
+        for queue in [self.last_ips, self.last_br_ips] + \
+                self.route_ips.values():
+            try:
+                queue.remove(ip)
+            except ValueError:
+                pass
+
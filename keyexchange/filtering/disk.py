@@ -0,0 +1,84 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Local files used to keep the filtering state across restarts.
+
+Files are replaced atomically: the new content is written to a temporary
+file in the same directory, synced, then renamed over the old one. A
+crash leaves either the old or the new file, never a partial one.
+"""
+import os
+import mmap
+import errno
+import tempfile
+
+
+def write_atomic(path, data):
+    """Replaces the content of path with data."""
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.%s.' % name)
+    try:
+        tmp = os.fdopen(fd, 'wb')
+        try:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        finally:
+            tmp.close()
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
+
+
+def read_mapped(path):
+    """Maps the file in memory, read-only.
+
+    Returns None if the file does not exist or is empty. The caller has to
+    close the returned mmap.
+    """
+    try:
+        mapped = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        if os.fstat(mapped.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(mapped.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        mapped.close()
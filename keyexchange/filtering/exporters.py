@@ -0,0 +1,280 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Exports of the blacklist to deny lists a proxy or the kernel can enforce,
+so traffic from banned IPs is dropped before reaching the application.
+
+- NginxExporter: an include file for a geo block, or deny directives::
+
+    geo $keyexchange_banned {
+        default 0;
+        include /etc/nginx/keyexchange-banned.conf;
+    }
+
+- HAProxyExporter: a map file, e.g. for
+  ``http-request deny if { src,map_ip(/etc/haproxy/banned.map) -m found }``
+- IPSetExporter: an ``ipset restore`` file, each entry with its remaining
+  TTL. The first one fills temporary sets, then swaps them with the live
+  ones. The next ones only add and delete the entries that changed, and
+  must be restored in order, e.g. by a path unit watching the file. Every
+  full_every exports, the whole sets are written again, which catches up
+  consumers that missed a file.
+
+Files are only rewritten when the blacklist changed, and replaced
+atomically. Expired entries are never written. Entries that are not IPs
+or networks are skipped.
+
+nginx and HAProxy only read their files when they load their
+configuration, and a reload reads the whole file, so those are always
+written in full.
+"""
+import threading
+
+from keyexchange.clock import get_clock
+from keyexchange.filtering.IPy import IP
+from keyexchange.filtering.importer import parse_address
+from keyexchange.filtering.disk import write_atomic
+
+
+def _version(elmt):
+    # 4, 6, or None if elmt is neither an IP nor a network
+    try:
+        if '/' in elmt:
+            return IP(elmt).version()
+        return parse_address(elmt)[1]
+    except ValueError:
+        return None
+
+
+class Exporter(object):
+    """Base class: writes one line per entry, between a header and a
+    footer."""
+
+    def __init__(self, path):
+        self.path = path
+        self._exported = None
+        # versions are cached, entries don't change version
+        self._versions = {}
+
+    def header(self, now):
+        return []
+
+    def footer(self, now):
+        return []
+
+    def line(self, elmt, version, expiry, now):
+        raise NotImplementedError()
+
+    def render(self, active, now):
+        """Returns the lines of the file, for active, a mapping of the
+        entries to write -> expiry or None."""
+        lines = self.header(now)
+        for elmt in sorted(active):
+            version = self._get_version(elmt)
+            if version is not None:
+                lines.append(self.line(elmt, version, active[elmt], now))
+        lines.extend(self.footer(now))
+        return lines
+
+    def _get_version(self, elmt):
+        try:
+            return self._versions[elmt]
+        except KeyError:
+            version = self._versions[elmt] = _version(elmt)
+            return version
+
+    def export(self, entries, now=None):
+        """Writes entries, a mapping of entry -> expiry or None.
+
+        Returns False if nothing changed since the last export.
+        """
+        if now is None:
+            now = get_clock().time()
+        active = dict([(elmt, expiry) for elmt, expiry in entries.iteritems()
+                       if expiry is None or expiry > now])
+        if active == self._exported:
+            return False
+
+        lines = self.render(active, now)
+        # forgetting the entries that are gone
+        for elmt in self._versions.keys():
+            if elmt not in active:
+                del self._versions[elmt]
+        write_atomic(self.path, ''.join([line + '\n' for line in lines]))
+        self._exported = active
+        return True
+
+
+class NginxExporter(Exporter):
+    """Lines for a geo block (``<entry> 1;``), or deny directives
+    (``deny <entry>;``) if deny is True."""
+
+    def __init__(self, path, deny=False):
+        Exporter.__init__(self, path)
+        self.deny = deny
+
+    def line(self, elmt, version, expiry, now):
+        if self.deny:
+            return 'deny %s;' % elmt
+        return '%s 1;' % elmt
+
+
+class HAProxyExporter(Exporter):
+    """Map file lines: ``<entry> <expiry or 0>``."""
+
+    def line(self, elmt, version, expiry, now):
+        return '%s %d' % (elmt, expiry or 0)
+
+
+class IPSetExporter(Exporter):
+    """ipset restore file, with one hash:net set per IP version.
+
+    Only the changes since the previous file are written, except for the
+    first file and every full_every files.
+    """
+
+    def __init__(self, path, name='keyexchange-banned', full_every=100):
+        Exporter.__init__(self, path)
+        self.name = name
+        self.full_every = full_every
+        self._exports = 0
+
+    def _set(self, version, temporary=False):
+        name = self.name
+        if version == 6:
+            name += '6'
+        if temporary:
+            name += '-tmp'
+        return name
+
+    def header(self, now):
+        lines = []
+        for version, family in ((4, 'inet'), (6, 'inet6')):
+            for temporary in (False, True):
+                lines.append('create %s hash:net family %s timeout 0 -exist'
+                             % (self._set(version, temporary), family))
+            lines.append('flush %s' % self._set(version, True))
+        return lines
+
+    def footer(self, now):
+        lines = []
+        for version in (4, 6):
+            lines.append('swap %s %s' % (self._set(version, True),
+                                         self._set(version)))
+            lines.append('destroy %s' % self._set(version, True))
+        return lines
+
+    def _timeout(self, expiry, now):
+        if expiry is None:
+            return 0
+        # ipset timeouts are whole seconds, 0 meaning permanent
+        return max(1, int(expiry - now))
+
+    def line(self, elmt, version, expiry, now):
+        return 'add %s %s timeout %d' % (self._set(version, True), elmt,
+                                         self._timeout(expiry, now))
+
+    def render(self, active, now):
+        previous = self._exported
+        full = previous is None or self._exports % self.full_every == 0
+        self._exports += 1
+        if full:
+            return Exporter.render(self, active, now)
+
+        # -exist updates the timeout of the entries already in the set,
+        # and ignores the ones the kernel expired already
+        lines = []
+        for elmt in sorted(active):
+            expiry = active[elmt]
+            if elmt in previous and previous[elmt] == expiry:
+                continue
+            version = self._get_version(elmt)
+            if version is not None:
+                lines.append('add %s %s timeout %d -exist' % (
+                             self._set(version), elmt,
+                             self._timeout(expiry, now)))
+        for elmt in sorted(previous):
+            if elmt in active:
+                continue
+            version = self._get_version(elmt)
+            if version is not None:
+                lines.append('del %s %s -exist' % (self._set(version), elmt))
+        return lines
+
+
+class ExportThread(threading.Thread):
+    """Runs the exporters every frequency seconds, when the blacklist
+    changed."""
+
+    def __init__(self, blacklist, exporters, frequency=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.blacklist = blacklist
+        self.exporters = exporters
+        self.frequency = frequency
+        self.running = True
+        self._stopped = threading.Event()
+        self._view = None
+
+    def export(self):
+        # expiring first, so expired entries change the view
+        self.blacklist.expire()
+        view = self.blacklist._view
+        if view is self._view:
+            return
+        entries = self.blacklist.entries()
+        exported = True
+        for exporter in self.exporters:
+            try:
+                exporter.export(entries, self.blacklist._clock.time())
+            except (IOError, OSError), e:
+                # retried on the next run
+                exported = False
+                from keyexchange.filtering import logger
+                logger.error('Could not export the blacklist to %s: %s' %
+                             (exporter.path, str(e)))
+        if exported:
+            self._view = view
+
+    def run(self):
+        while self.running:
+            self.export()
+            self._stopped.wait(self.frequency)
+
+    def join(self):
+        self.running = False
+        self._stopped.set()
+        threading.Thread.join(self)
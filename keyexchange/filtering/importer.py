@@ -0,0 +1,169 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Bulk import of blocklist feeds.
+
+A feed is a text file with one entry per line::
+
+    # comments and blank lines are ignored
+    192.0.2.1
+    198.51.100.0/24
+    203.0.113.9  600     # TTL in seconds
+    2001:db8::/32
+
+Addresses are parsed straight into integers with inet_pton, without
+creating IP objects, and regular files are memory-mapped.
+
+Entries that have a TTL (given on the line, or the default TTL for single
+IPs) are temporary bans that go in the Blacklist. Entries without a TTL are
+permanent and go in the deny list (an IPSet).
+"""
+import os
+import mmap
+import socket
+import struct
+
+
+_V4 = struct.Struct('!I')
+_V6 = struct.Struct('!QQ')
+_MAXLEN = {4: 32, 6: 128}
+
+
+def parse_address(ip):
+    """Parses an IPv4 or IPv6 address in its usual notation.
+
+    Returns an (integer, version) tuple. Raises a ValueError if the address
+    is invalid.
+    """
+    try:
+        return _V4.unpack(socket.inet_pton(socket.AF_INET, ip))[0], 4
+    except socket.error:
+        pass
+    try:
+        high, low = _V6.unpack(socket.inet_pton(socket.AF_INET6, ip))
+    except socket.error:
+        raise ValueError('Invalid IP %r' % ip)
+    return (high << 64) | low, 6
+
+
+def canonical_address(ip):
+    """Returns the usual notation of an IPv4 or IPv6 address, e.g.
+    2001:db8::1 for 2001:0DB8:0:0:0:0:0:1.
+
+    Raises a ValueError if the address is invalid.
+    """
+    try:
+        return socket.inet_ntoa(socket.inet_pton(socket.AF_INET, ip))
+    except socket.error:
+        pass
+    try:
+        return socket.inet_ntop(socket.AF_INET6,
+                                socket.inet_pton(socket.AF_INET6, ip))
+    except socket.error:
+        raise ValueError('Invalid IP %r' % ip)
+
+
+def _lines(path):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as feed:
+        if size == 0:
+            return
+        data = mmap.mmap(feed.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            for line in iter(data.readline, ''):
+                yield line
+        finally:
+            data.close()
+
+
+def read_feed(path, default_ttl=None):
+    """Reads a feed file.
+
+    Returns a (ttls, ranges) tuple:
+
+    - ttls: mapping of IPs and networks to their TTL in seconds, for the
+      entries that have a TTL.
+    - ranges: mapping of IP version to a list of (start, end) integer
+      tuples, for the entries that don't.
+    """
+    ttls = {}
+    ranges = {4: [], 6: []}
+    invalid = 0
+
+    for line in _lines(path):
+        if '#' in line:
+            line = line.split('#', 1)[0]
+        fields = line.split()
+        if not fields:
+            continue
+        try:
+            network = fields[0]
+            if '/' in network:
+                address, prefixlen = network.split('/', 1)
+                prefixlen = int(prefixlen)
+                ttl = None
+            else:
+                address, prefixlen = network, None
+                ttl = default_ttl
+
+            if len(fields) > 1:
+                ttl = float(fields[1])
+
+            ip, version = parse_address(address)
+            size = _MAXLEN[version]
+            if prefixlen is None:
+                prefixlen = size
+            elif not 0 <= prefixlen <= size:
+                raise ValueError('Invalid prefix length')
+
+            if ttl is not None:
+                if '/' not in network:
+                    # blacklisted IPs are matched as strings
+                    network = canonical_address(network)
+                ttls[network] = ttl
+                continue
+
+            hostbits = size - prefixlen
+            start = (ip >> hostbits) << hostbits
+            ranges[version].append((start, start + (1 << hostbits) - 1))
+        except ValueError:
+            invalid += 1
+
+    if invalid > 0:
+        from keyexchange.filtering import logger
+        logger.error('%d invalid entries in %s' % (invalid, path))
+
+    return ttls, ranges
@@ -35,7 +35,9 @@
 # ***** END LICENSE BLOCK *****
 from collections import deque
 import threading
-import time
+import math
+
+from keyexchange.clock import get_clock
 
 
 class IPQueue(object):
@@ -50,15 +52,40 @@ class IPQueue(object):
     When the queue is full, the right element is discarded.
 
     Elements that are too old gets discarded, so this works also
-    for low traffic applications.
+    for low traffic applications. clock defaults to the shared
+    keyexchange.clock.Clock, a VirtualClock can be used to replay past
+    traffic.
+
+    The queue is a ring of time buckets of ttl / buckets seconds, each a
+    deque of (ip, sequence) entries in arrival order. Moving an IP back
+    to the left adds a new entry in the current bucket, and the previous
+    one becomes stale: it is skipped when it's dropped. Once a bucket is
+    entirely older than ttl, it is dropped as a whole, so len() doesn't
+    scan the queue. It may count IPs that are up to ttl / buckets seconds
+    too old, count() and the in operator are exact.
     """
-    def __init__(self, maxlen=200, ttl=360):
-        self._ips = deque()
+    def __init__(self, maxlen=200, ttl=360, clock=None, buckets=60):
+        # bucket index -> deque of (ip, sequence)
+        self._buckets = {}
+        # smallest bucket index, or None
+        self._oldest = None
+        # index and deque of the bucket append() adds to
+        self._index = self._bucket = None
+        # number of entries in the buckets, stale ones included
+        self._entries = 0
         self._counter = dict()
         self._last_update = dict()
+        self._sequence = dict()
+        self._next = 0
         self._maxlen = maxlen
         self._ttl = float(ttl)
-        self._lock = threading.RLock()
+        self._granularity = self._ttl / buckets
+        # compacting past this many entries
+        self._compact_at = 2 * maxlen + 16
+        if clock is None:
+            clock = get_clock()
+        self._clock = clock
+        self._lock = threading.Lock()
 
     def __getstate__(self):
         odict = self.__dict__.copy()
@@ -67,45 +94,157 @@ class IPQueue(object):
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, index):
+        bucket = self._buckets.get(index)
+        if bucket is None:
+            bucket = self._buckets[index] = deque()
+            if self._oldest is None or index < self._oldest:
+                self._oldest = index
+        return bucket
+
+    def _push(self, ip, updated):
+        self._next += 1
+        self._sequence[ip] = self._next
+        bucket = self._get_bucket(int(updated / self._granularity))
+        bucket.append((ip, self._next))
+        self._entries += 1
+        self._last_update[ip] = updated
+
+    def _is_stale(self, entry):
+        return self._sequence.get(entry[0]) != entry[1]
+
+    def _drop_bucket(self, index):
+        bucket = self._buckets.pop(index)
+        if self._index == index:
+            self._index = self._bucket = None
+        self._entries -= len(bucket)
+        if self._buckets:
+            self._oldest = min(self._buckets)
+        else:
+            self._oldest = None
+        return bucket
+
+    def _expire_due(self, now):
+        # the index of the first bucket to keep, if some must be dropped
+        if self._oldest is None:
+            return None
+        limit = int((now - self._ttl) / self._granularity)
+        if self._oldest < limit:
+            return limit
+        return None
 
-    def append(self, ip):
-        """Adds the IP and raise the counter accordingly."""
+    def _expire(self, now):
+        # drops the buckets that are entirely older than ttl
+        limit = self._expire_due(now)
+        if limit is None:
+            return
+        while self._oldest is not None and self._oldest < limit:
+            for entry in self._drop_bucket(self._oldest):
+                if not self._is_stale(entry):
+                    self._delete(entry[0])
+
+    def _trim(self):
+        while len(self._counter) > self._maxlen:
+            bucket = self._buckets[self._oldest]
+            entry = bucket.popleft()
+            self._entries -= 1
+            if not bucket:
+                self._drop_bucket(self._oldest)
+            if not self._is_stale(entry):
+                self._delete(entry[0])
+        if self._entries > self._compact_at:
+            # too many stale entries
+            for index, bucket in self._buckets.items():
+                live = deque([entry for entry in bucket
+                              if not self._is_stale(entry)])
+                self._entries -= len(bucket) - len(live)
+                if live:
+                    self._buckets[index] = live
+                    if self._index == index:
+                        self._bucket = live
+                else:
+                    self._drop_bucket(index)
+
+    def _delete(self, ip):
+        del self._counter[ip]
+        del self._last_update[ip]
+        del self._sequence[ip]
+
+    def append(self, ip, weight=1):
+        """Adds the IP and raise the counter by weight.
+
+        Returns the new count, so callers don't need to call count().
+        """
+        now = self._clock.time()
+        index = int(now / self._granularity)
         self._lock.acquire()
         try:
-            if ip not in self._ips:
-                self._ips.appendleft(ip)
-                self._counter[ip] = 1
-            else:
-                self._ips.remove(ip)
-                self._ips.appendleft(ip)
-                self._counter[ip] += 1
-
-            self._last_update[ip] = time.time()
-
-            if len(self._ips) > self._maxlen:
-                ip = self._ips.pop()
-                del self._counter[ip]
-                del self._last_update[ip]
+            if index != self._index:
+                # buckets can only expire when the time moves to a new one
+                self._expire(now)
+                self._bucket = self._get_bucket(index)
+                self._index = index
+            self._next += 1
+            self._sequence[ip] = self._next
+            self._bucket.append((ip, self._next))
+            self._entries += 1
+            self._last_update[ip] = now
+            count = self._counter[ip] = self._counter.get(ip, 0) + weight
+            if len(self._counter) > self._maxlen or \
+               self._entries > self._compact_at:
+                self._trim()
+            return count
         finally:
             self._lock.release()
 
-    def _discard_if_old(self, ip):
+    def items(self):
+        """Returns (ip, count, last update) for each IP, most recent
+        first."""
+        self._lock.acquire()
+        try:
+            items = []
+            for index in sorted(self._buckets, reverse=True):
+                for ip, sequence in reversed(self._buckets[index]):
+                    if self._sequence.get(ip) == sequence:
+                        items.append((ip, self._counter[ip],
+                                      self._last_update[ip]))
+            return items
+        finally:
+            self._lock.release()
+
+    def load(self, items):
+        """Adds the IPs returned by items(), unless they are too old or
+        already in the queue."""
+        oldest = self._clock.time() - self._ttl
+        self._lock.acquire()
+        try:
+            for ip, count, updated in reversed(items):
+                if updated < oldest or ip in self._counter:
+                    continue
+                self._push(ip, updated)
+                self._counter[ip] = count
+                self._trim()
+        finally:
+            self._lock.release()
+
+    def _is_old(self, ip, now):
         updated = self._last_update.get(ip)
-        if updated is None:
+        return updated is not None and now - updated > self._ttl
+
+    def _discard_if_old(self, ip):
+        if not self._is_old(ip, self._clock.time()):
+            return False
+        self._lock.acquire()
+        try:
+            # checked again, it may have come back in the meantime
+            if self._is_old(ip, self._clock.time()):
+                self._delete(ip)
+                return True
             return False
-        if time.time() - updated > self._ttl:
-            self.remove(ip)
-            return True
-        return False
-
-    def _discard_old_ips(self):
-        # from right-to-left check the age and discard old ones
-        index = len(self._ips) - 1
-        while index >= 0:
-            ip = self._ips[index]
-            if not self._discard_if_old(ip):
-                return
-            index -= 1
+        finally:
+            self._lock.release()
 
     def count(self, ip):
         """Returns the IP count."""
@@ -113,18 +252,80 @@ class IPQueue(object):
         return self._counter.get(ip, 0)
 
     def __len__(self):
-        self._discard_old_ips()
-        return len(self._ips)
+        now = self._clock.time()
+        if self._expire_due(now) is None:
+            return len(self._counter)
+        self._lock.acquire()
+        try:
+            self._expire(now)
+            return len(self._counter)
+        finally:
+            self._lock.release()
 
     def __contains__(self, ip):
         self._discard_if_old(ip)
-        return ip in self._ips
+        return ip in self._counter
 
     def remove(self, ip):
         self._lock.acquire()
         try:
-            self._ips.remove(ip)
-            del self._counter[ip]
-            del self._last_update[ip]
+            if ip not in self._counter:
+                raise ValueError(ip)
+            # its entry in the buckets is now stale
+            self._delete(ip)
         finally:
             self._lock.release()
+
+
+class StripedIPQueue(object):
+    """IPQueue split in stripes, to lower the contention between threads.
+
+    Each IP goes in the stripe picked by its hash. Stripes have their own
+    lock and a share of maxlen, so the least recent IP of a stripe is
+    discarded instead of the least recent one overall. The number of
+    stripes is lowered so each holds at least min_size IPs.
+    """
+    def __init__(self, maxlen=200, ttl=360, stripes=16, clock=None,
+                 min_size=32):
+        stripes = max(1, min(stripes, maxlen // min_size))
+        size = int(math.ceil(float(maxlen) / stripes))
+        self._stripes = [IPQueue(size, ttl, clock) for i in range(stripes)]
+
+    def _stripe(self, ip):
+        return self._stripes[hash(ip) % len(self._stripes)]
+
+    def append(self, ip, weight=1):
+        """Adds the IP and raise the counter by weight. Returns the new
+        count."""
+        return self._stripe(ip).append(ip, weight)
+
+    def count(self, ip):
+        """Returns the IP count."""
+        return self._stripe(ip).count(ip)
+
+    def remove(self, ip):
+        self._stripe(ip).remove(ip)
+
+    def items(self):
+        """Returns (ip, count, last update) for each IP, most recent
+        first."""
+        items = []
+        for stripe in self._stripes:
+            items.extend(stripe.items())
+        items.sort(key=lambda item: item[2], reverse=True)
+        return items
+
+    def load(self, items):
+        """Adds the IPs returned by items(), unless they are too old or
+        already in the queue."""
+        stripes = [[] for stripe in self._stripes]
+        for item in items:
+            stripes[hash(item[0]) % len(stripes)].append(item)
+        for stripe, items in zip(self._stripes, stripes):
+            stripe.load(items)
+
+    def __len__(self):
+        return sum([len(stripe) for stripe in self._stripes])
+
+    def __contains__(self, ip):
+        return ip in self._stripe(ip)
@@ -0,0 +1,207 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Set of IP ranges.
+
+Networks are collapsed into non-overlapping, non-adjacent ranges on load and
+kept as two sorted arrays of integers (starts and ends) per IP version.
+Membership is a binary search, and a whole batch of addresses can be checked
+at once with contains_many(), which is vectorized when numpy is installed.
+"""
+from array import array
+from bisect import bisect_right
+
+from keyexchange.filtering.IPy import IP, IPint, parseAddress
+
+
+def get_numpy():
+    """Returns the numpy module, or None if it's not installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _new_ints(version):
+    # IPv4 values fit in a 32 bits unsigned C int, IPv6 values don't
+    if version == 4:
+        return array('I')
+    return []
+
+
+def collapse(ranges):
+    """Merges overlapping and adjacent (start, end) ranges.
+
+    Returns a sorted list of (start, end) tuples.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = merged[-1][0], end
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class IPSet(object):
+    """Set of IPv4 and IPv6 networks.
+
+    Networks can be provided as strings in any notation IPy understands,
+    or as IP objects. Host bits are ignored, so '10.1.2.3/8' is 10/8.
+    """
+    def __init__(self, networks=None):
+        self._starts = {4: _new_ints(4), 6: _new_ints(6)}
+        self._ends = {4: _new_ints(4), 6: _new_ints(6)}
+        if networks is not None:
+            self.update(networks)
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        # arrays are pickled as lists to stay portable
+        odict['_starts'] = dict([(version, list(values)) for version, values
+                                 in self._starts.items()])
+        odict['_ends'] = dict([(version, list(values)) for version, values
+                               in self._ends.items()])
+        return odict
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in ('_starts', '_ends'):
+            values = getattr(self, name)
+            for version in (4, 6):
+                ints = _new_ints(version)
+                ints.extend(values[version])
+                values[version] = ints
+
+    def update(self, networks):
+        """Adds networks to the set."""
+        ranges = {4: zip(self._starts[4], self._ends[4]),
+                  6: zip(self._starts[6], self._ends[6])}
+
+        for network in networks:
+            if not isinstance(network, IPint):
+                network = IP(network, make_net=True)
+            start = network.int()
+            ranges[network.version()].append((start,
+                                              start + network.len() - 1))
+
+        self.update_ranges(ranges)
+
+    def update_ranges(self, ranges):
+        """Replaces the content of the set.
+
+        ranges is a mapping of IP version to a list of (start, end) integer
+        tuples, in any order.
+        """
+        for version in (4, 6):
+            starts, ends = _new_ints(version), _new_ints(version)
+            for start, end in collapse(ranges.get(version, [])):
+                starts.append(start)
+                ends.append(end)
+            self._starts[version] = starts
+            self._ends[version] = ends
+
+    def ranges(self, version):
+        """Returns the sorted (start, end) tuples for an IP version."""
+        return zip(self._starts[version], self._ends[version])
+
+    def contains_address(self, ip, version):
+        """Checks an already parsed address."""
+        starts = self._starts[version]
+        index = bisect_right(starts, ip) - 1
+        return index >= 0 and ip <= self._ends[version][index]
+
+    def __contains__(self, ip):
+        if isinstance(ip, IPint):
+            ip, version = ip.int(), ip.version()
+        else:
+            try:
+                ip, version = parseAddress(ip)
+            except ValueError:
+                # unparseable IPs are never part of the set
+                return False
+        return self.contains_address(ip, version)
+
+    def contains_many(self, ips):
+        """Checks a batch of IPs. Returns a list of booleans.
+
+        Unparseable IPs are reported as not contained.
+        """
+        results = [False] * len(ips)
+        positions = {4: [], 6: []}
+        values = {4: [], 6: []}
+        for position, ip in enumerate(ips):
+            try:
+                ip, version = parseAddress(ip)
+            except ValueError:
+                continue
+            positions[version].append(position)
+            values[version].append(ip)
+
+        numpy = get_numpy()
+        for version in (4, 6):
+            if not values[version]:
+                continue
+            if numpy is not None and version == 4:
+                found = self._search_numpy(numpy, values[version])
+            else:
+                found = [self.contains_address(ip, version)
+                         for ip in values[version]]
+            for position, hit in zip(positions[version], found):
+                results[position] = bool(hit)
+
+        return results
+
+    def _search_numpy(self, numpy, values):
+        dtype = 'u%d' % self._starts[4].itemsize
+        starts = numpy.frombuffer(self._starts[4], dtype=dtype)
+        ends = numpy.frombuffer(self._ends[4], dtype=dtype)
+        values = numpy.array(values, dtype=dtype)
+        if len(starts) == 0:
+            return numpy.zeros(len(values), dtype=bool)
+        indexes = numpy.searchsorted(starts, values, side='right') - 1
+        found = indexes >= 0
+        return found & (values <= ends[indexes.clip(0)])
+
+    def __len__(self):
+        """Returns the number of ranges."""
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def __nonzero__(self):
+        # called on every request, so it avoids going through __len__
+        return bool(self._starts[4] or self._starts[6])
@@ -49,13 +49,31 @@ Blacklisted IPs are kept in memory with a TTL.
 """
 import os
 import cgi
+import json
+import atexit
+from urllib import urlencode
+from urlparse import parse_qs
 
 from mako.template import Template
 
-from keyexchange.filtering.IPy import IP
 from keyexchange.util import get_memcache_class
+from keyexchange.clock import Clock, get_clock
 from keyexchange.filtering.blacklist import Blacklist
-from keyexchange.filtering.ipqueue import IPQueue
+from keyexchange.filtering.ipset import IPSet
+from keyexchange.filtering.importer import read_feed
+from keyexchange.filtering.addresses import AddressCache
+from keyexchange.filtering.counters import RequestCounters
+from keyexchange.filtering.shadow import ShadowRunner, parse_policy
+from keyexchange.filtering.transports import MemcacheTransport, UDPTransport
+from keyexchange.filtering.disk import write_atomic, read_mapped
+from keyexchange.filtering.exporters import (ExportThread, NginxExporter,
+                                             HAProxyExporter, IPSetExporter)
+
+# the rejection response, built once
+_FORBIDDEN_STATUS = '403 Forbidden'
+_FORBIDDEN_BODY = ("Forbidden: You don't have permission to access",)
+_FORBIDDEN_HEADERS = (('Content-Type', 'text/plain'),
+                      ('Content-Length', str(len(_FORBIDDEN_BODY[0]))))
 
 
 class IPFiltering(object):
@@ -67,7 +85,22 @@ class IPFiltering(object):
                  admin_page=None, use_memory=False, refresh_frequency=1,
                  observe=False, callback=None, ip_whitelist=None,
                  async=True, update_blfreq=None, ip_queue_ttl=360,
-                 br_callback=None):
+                 br_callback=None, ip_denylist=None, ip_feeds=None,
+                 ip_feed_ttl=None, address_cache_size=10000,
+                 subnet_treshold=None, subnet_prefixlen=24,
+                 subnet_prefixlen6=64, bloom_error_rate=None,
+                 sync_transport='memcache', sync_address=None,
+                 sync_peers=None, sync_secret=None, sync_delay=0.005,
+                 snapshot_path=None, snapshot_frequency=60,
+                 counters_path=None, export_nginx=None, export_haproxy=None,
+                 export_ipset=None, export_frequency=1, trusted_proxies=None,
+                 route_costs=None, bad_statuses=('400',), ban_escalation=None,
+                 ban_max_ttl=None, offender_history_size=100000,
+                 offender_half_life=86400, prefix_tresholds=None,
+                 prefix_tresholds6=None, prefix_window=60,
+                 prefix_counters_size=100000, shadow_policies=None,
+                 shadow_queue_size=10000, queue_stripes=16,
+                 clock_resolution=None, clock=None):
 
         """Initializes the middleware.
 
@@ -80,6 +113,8 @@ class IPFiltering(object):
           callers that provokated a bad request.
         - treshold: max number of calls per IP before we blacklist it.
         - br_treshold: max number of bad request per IP before we blacklist it.
+        - admin_page: if set, path of an admin page listing the blacklisted
+          IPs, with a JSON API below it. See admin().
         - observe: if set to True, IPs are still blacklisted but not rejected.
           This mode is useful to observe the behavior of an application without
           rejecting any call, to make sure a configuration works fine. Notice
@@ -96,17 +131,116 @@ class IPFiltering(object):
         - update_blfreq: number of requests before the blacklist is updated.
           async must be False.
         - ip_queue_ttl: Maximum time to live for an IP in the queues.
+        - ip_denylist: an IPSet or a list of networks that are always
+          rejected. Unlike blacklisted IPs, they have no TTL.
+        - ip_feeds: a list of blocklist files to load at startup. See
+          keyexchange.filtering.importer for the format.
+        - ip_feed_ttl: default TTL for the feed entries. If None, entries
+          without an explicit TTL go in the deny list.
+        - address_cache_size: number of parsed client addresses kept in
+          memory.
+        - subnet_treshold: number of blacklisted IPs from the same network
+          before the whole network is blacklisted instead. If None, networks
+          are never blacklisted automatically.
+        - subnet_prefixlen: prefix length of those networks for IPv4.
+        - subnet_prefixlen6: prefix length of those networks for IPv6.
+        - bloom_error_rate: if set, the blacklist is checked through a Bloom
+          filter with that false positive rate first.
+        - sync_transport: how blacklist changes are propagated to the other
+          nodes. 'memcache' polls memcache every refresh_frequency seconds,
+          'udp' pushes the changes to sync_peers as soon as they happen,
+          and still uses memcache to catch up.
+        - sync_address: host:port the udp transport listens to.
+        - sync_peers: list of host:port, or a multicast group, the udp
+          transport sends the changes to.
+        - sync_secret: the secret udp datagrams are signed with. Required
+          by the udp transport.
+        - sync_delay: seconds during which local changes are gathered
+          before being pushed, in async mode.
+        - snapshot_path: file where the blacklist is saved every
+          snapshot_frequency seconds, and loaded from at startup.
+        - snapshot_frequency: seconds between two snapshots.
+        - counters_path: if set, the IP counters are saved in this file
+          along with the blacklist snapshot, and loaded from it at startup.
+          Needs snapshot_path.
+        - export_nginx: file where the blacklist is written as an include
+          for an nginx geo block. See keyexchange.filtering.exporters.
+        - export_haproxy: file where the blacklist is written as an
+          HAProxy map.
+        - export_ipset: file where the blacklist is written for
+          ipset restore. After the first one, files only hold the changes
+          and must be restored in order.
+        - export_frequency: seconds between two checks for changes to
+          export.
+        - trusted_proxies: a list of networks of the proxies allowed to set
+          X-Forwarded-For. The client IP is the first hop that is not one
+          of them, walking the header from the right. If None, the first
+          IP of the header is used, which lets clients pick their address.
+        - route_costs: a list of 'METHOD PATTERN COST [TRESHOLD]' lines.
+          Requests add the cost of their route to the counter of their
+          IP instead of 1, and routes that have a treshold get their own
+          counter. See keyexchange.filtering.routes.
+        - bad_statuses: the response statuses counted as bad requests.
+          Either codes like 404, or classes like 4xx.
+        - ban_escalation: if set, the ban TTL of an IP is multiplied by
+          this factor for each previous ban, and halved previous bans
+          count every offender_half_life seconds.
+        - ban_max_ttl: maximum TTL of an escalated ban.
+        - offender_history_size: number of banned IPs remembered for the
+          escalation.
+        - offender_half_life: seconds after which a previous ban counts
+          half.
+        - prefix_tresholds: list of 'prefixlen:treshold' for IPv4, e.g.
+          ['24:500', '16:5000']. Requests are also counted per network of
+          these sizes, and a network that makes more than treshold
+          requests within prefix_window seconds is blacklisted.
+        - prefix_tresholds6: the same, for IPv6.
+        - prefix_window: length in seconds of the window of the network
+          counters.
+        - prefix_counters_size: maximum number of networks counted per
+          prefix length.
+        - shadow_policies: policies that see the traffic without rejecting
+          anything, given as 'name key=value ...' lines with the options
+          of keyexchange.filtering.shadow.CounterPolicy, or as policy
+          objects. Parsed policies count the routes of route_costs. See
+          shadow_stats().
+        - shadow_queue_size: number of requests waiting for the shadow
+          policies. Requests are dropped for the shadow policies when it's
+          full.
+        - queue_stripes: number of independently locked stripes the IP
+          queues are split in. Queues are split in fewer stripes if they
+          would hold less than 32 IPs each.
+        - clock_resolution: if set, the TTLs use their own clock, refreshed
+          every clock_resolution seconds, or read on every call if 0.
+          Otherwise the clock shared by the process is used. See
+          keyexchange.clock.
+        - clock: the clock to use instead, e.g. a VirtualClock in tests.
         """
         self.app = app
         self.blacklist_ttl = blacklist_ttl
         self.br_blacklist_ttl = br_blacklist_ttl
         self.queue_size = queue_size
         self.br_queue_size = br_queue_size
-        self.treshold = treshold
-        self.br_treshold = br_treshold
         self.observe = observe
-        self._last_ips = IPQueue(queue_size, ttl=ip_queue_ttl)
-        self._last_br_ips = IPQueue(br_queue_size, ttl=ip_queue_ttl)
+        if clock is None:
+            if clock_resolution is None:
+                clock = get_clock()
+            else:
+                clock = Clock(clock_resolution)
+        self._clock = clock
+        if shadow_policies is None:
+            self._shadows = None
+        else:
+            if isinstance(shadow_policies, str):
+                shadow_policies = [shadow_policies]
+            policies = []
+            for policy in shadow_policies:
+                if isinstance(policy, str):
+                    policy = parse_policy(policy, route_costs=route_costs,
+                                          clock=clock)
+                policies.append(policy)
+            self._shadows = ShadowRunner(policies, shadow_queue_size, clock)
+            self._shadows.start()
         if isinstance(cache_servers, str):
             cache_servers = [cache_servers]
         self._cache_server = get_memcache_class(use_memory)(cache_servers)
@@ -115,8 +249,54 @@ class IPFiltering(object):
             raise ValueError('Cannot use async mode with update_blfreq')
         self.update_blfreq = update_blfreq
         self._blcounter = 0
+        # every lookup that needs a parsed client address goes through
+        # this cache
+        self._addresses = AddressCache(address_cache_size)
+        self._counters = RequestCounters(treshold, queue_size, br_treshold,
+                                         br_queue_size, ip_queue_ttl,
+                                         route_costs, bad_statuses,
+                                         prefix_tresholds, prefix_tresholds6,
+                                         prefix_window, prefix_counters_size,
+                                         queue_stripes, self._addresses.parse,
+                                         clock)
+        self.bad_statuses = self._counters.bad_statuses
+        self._last_ips = self._counters.last_ips
+        self._last_br_ips = self._counters.last_br_ips
+        self._route_ips = self._counters.route_ips
         self._blacklisted = Blacklist(self._cache_server, refresh_frequency,
-                                      self.async)
+                                      self.async, self._addresses.parse,
+                                      subnet_treshold, subnet_prefixlen,
+                                      subnet_prefixlen6,
+                                      bloom_error_rate=bloom_error_rate,
+                                      transport=self._get_transport(
+                                          sync_transport, refresh_frequency,
+                                          sync_address, sync_peers,
+                                          sync_secret),
+                                      sync_delay=sync_delay,
+                                      snapshot_path=snapshot_path,
+                                      snapshot_frequency=snapshot_frequency,
+                                      escalation_factor=ban_escalation,
+                                      max_ttl=ban_max_ttl,
+                                      history_size=offender_history_size,
+                                      history_half_life=offender_half_life,
+                                      clock=clock)
+        self.counters_path = counters_path
+        if counters_path is not None:
+            self._load_counters()
+            self._blacklisted.checkpoint_callbacks.append(self.save_counters)
+
+        exporters = []
+        for path, klass in ((export_nginx, NginxExporter),
+                            (export_haproxy, HAProxyExporter),
+                            (export_ipset, IPSetExporter)):
+            if path is not None:
+                exporters.append(klass(path))
+        if exporters:
+            self._exporter = ExportThread(self._blacklisted, exporters,
+                                          export_frequency)
+            self._exporter.start()
+        else:
+            self._exporter = None
         if admin_page is not None and not admin_page.startswith('/'):
             admin_page = '/' + admin_page
         self.admin_page = admin_page
@@ -126,19 +306,147 @@ class IPFiltering(object):
         self.br_callback = br_callback
 
         if ip_whitelist is None:
-            self.ip_whitelist = []
+            self.ip_whitelist = IPSet()
+        else:
+            if isinstance(ip_whitelist, str):
+                ip_whitelist = [ip_whitelist]
+            self.ip_whitelist = IPSet(ip_whitelist)
+
+        if ip_denylist is None or isinstance(ip_denylist, IPSet):
+            self.ip_denylist = ip_denylist
         else:
-            self.ip_whitelist = [IP(ip) for ip in ip_whitelist]
+            if isinstance(ip_denylist, str):
+                ip_denylist = [ip_denylist]
+            self.ip_denylist = IPSet(ip_denylist)
+
+        if trusted_proxies is None:
+            self.trusted_proxies = None
+        else:
+            if isinstance(trusted_proxies, str):
+                trusted_proxies = [trusted_proxies]
+            self.trusted_proxies = IPSet(trusted_proxies)
+
+        # ranges and blacklisted IPs each loaded feed provided
+        self._static_denylist = self.ip_denylist
+        self._feeds = {}
+        self.ip_feed_ttl = ip_feed_ttl
+        if ip_feeds is not None:
+            if isinstance(ip_feeds, str):
+                ip_feeds = [ip_feeds]
+            for path in ip_feeds:
+                self.load_feed(path)
+
+        self._closed = False
+        # the final checkpoint and the pending changes would be lost
+        atexit.register(self.close)
+
+    def close(self):
+        """Stops the threads, pushes the pending changes and writes the
+        last snapshot and exports. Called at exit."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._shadows is not None:
+            self._shadows.join()
+        self._blacklisted.close()
+        if self._exporter is not None:
+            self._exporter.join()
+            self._exporter.export()
+
+    def _get_treshold(self):
+        return self._counters.treshold
+
+    def _set_treshold(self, treshold):
+        self._counters.treshold = treshold
+
+    treshold = property(_get_treshold, _set_treshold)
+
+    def _get_br_treshold(self):
+        return self._counters.br_treshold
+
+    def _set_br_treshold(self, br_treshold):
+        self._counters.br_treshold = br_treshold
+
+    br_treshold = property(_get_br_treshold, _set_br_treshold)
+
+    def _get_transport(self, name, frequency, address, peers, secret):
+        memcache = MemcacheTransport(self._cache_server, frequency)
+        if name == 'memcache':
+            return memcache
+        elif name == 'udp':
+            if address is None or not peers:
+                raise ValueError('The udp transport needs sync_address and '
+                                 'sync_peers')
+            if secret is None:
+                raise ValueError('The udp transport needs sync_secret')
+            return UDPTransport(address, peers, secret, fallback=memcache)
+        raise ValueError('Unknown sync transport %r' % name)
+
+    def _load_counters(self):
+        data = read_mapped(self.counters_path)
+        if data is None:
+            return
+        try:
+            last_ips, last_br_ips = json.loads(data[:])
+        finally:
+            data.close()
+        for queue, items in ((self._last_ips, last_ips),
+                             (self._last_br_ips, last_br_ips)):
+            queue.load([(str(ip), count, updated)
+                        for ip, count, updated in items])
+
+    def save_counters(self):
+        """Saves the IP counters in counters_path."""
+        data = json.dumps([self._last_ips.items(), self._last_br_ips.items()])
+        write_atomic(self.counters_path, data)
+
+    def load_feed(self, path, default_ttl=None):
+        """Loads or reloads a blocklist file.
+
+        The entries previously loaded from the same file are replaced:
+        temporary bans are swapped in the blacklist under one lock
+        acquisition, and a new deny list is built then swapped in. Like the
+        deny list, the bans are local to this node: they're not sent to
+        the other nodes, which load their own feeds.
+        """
+        if default_ttl is None:
+            default_ttl = self.ip_feed_ttl
+        ttls, ranges = read_feed(path, default_ttl)
+
+        previous_ips = self._feeds.get(path, ((), None))[0]
+        discard = [ip for ip in previous_ips if ip not in ttls]
+        self._blacklisted.load(ttls, discard=discard)
+        self._feeds[path] = set(ttls), ranges
+
+        # building the new deny list off-line, then swapping it
+        all_ranges = {4: [], 6: []}
+        sources = [feed_ranges for __, feed_ranges in self._feeds.values()]
+        if self._static_denylist is not None:
+            sources.append({4: self._static_denylist.ranges(4),
+                            6: self._static_denylist.ranges(6)})
+        for source in sources:
+            for version in (4, 6):
+                all_ranges[version].extend(source[version])
+        denylist = IPSet()
+        denylist.update_ranges(all_ranges)
+        self.ip_denylist = denylist
 
     def _is_whitelisted(self, ip):
-        for ip_range in self.ip_whitelist:
-            try:
-                if ip in ip_range:
-                    return True
-            except ValueError:
-                # happens when the IP is unparseable
-                return False
-        return False
+        if not self.ip_whitelist:
+            return False
+        address = self._addresses.parse(ip)
+        if address is None:
+            # happens when the IP is unparseable
+            return False
+        return self.ip_whitelist.contains_address(*address)
+
+    def _is_denied(self, ip):
+        if not self.ip_denylist:
+            return False
+        address = self._addresses.parse(ip)
+        if address is None:
+            return False
+        return self.ip_denylist.contains_address(*address)
 
     def _check_ip(self, ip, environ):
         if self._is_whitelisted(ip):
@@ -151,18 +459,21 @@ class IPFiltering(object):
         if self.observe and ip in self._blacklisted:
             return
 
-        # insert the IP in the queue
-        # if the queue is full, the opposite-end item is discarded
-        self._last_ips.append(ip)
-
-        # counts its ratio in the queue
-        if self._last_ips.count(ip) >= self.treshold:
-
+        # counting the request for the IP, its route and its networks
+        over, network = self._counters.hit(ip, environ.get('REQUEST_METHOD'),
+                                           environ.get('PATH_INFO', ''))
+        if over:
             # blacklisting the IP
             self._blacklisted.add(ip, self.blacklist_ttl)
             if self.callback is not None:
                 self.callback(ip, environ)
 
+        if network is not None:
+            # whitelisted IPs of the network are still accepted
+            self._blacklisted.add(network, self.blacklist_ttl)
+            if self.callback is not None:
+                self.callback(network, environ)
+
     def _inc_bad_request(self, ip, environ):
         if self._is_whitelisted(ip):
             return
@@ -174,48 +485,203 @@ class IPFiltering(object):
             return
         # insert the IP in the br queue
         # if the queue is full, the opposite-end item is discarded
-        self._last_br_ips.append(ip)
-
         # counts its occurences in the queue
-        if self._last_br_ips.count(ip) >= self.br_treshold:
+        if self._counters.hit_bad(ip):
             # blacklisting the IP
             self._blacklisted.add(ip, self.br_blacklist_ttl)
             if self.callback is not None:
                 self.callback(ip, environ)
 
+    def admin_list(self, after=None, prefix=None, limit=100):
+        """Returns a page of the blacklist: {'entries': [[entry, expiry],
+        ...], 'next': cursor of the next page or None}."""
+        entries, cursor = self._blacklisted.page(after, prefix, limit)
+        return {'entries': entries, 'next': cursor}
+
+    def admin_edit(self, add=None, remove=()):
+        """Blacklists and unblacklists IPs and networks in bulk.
+
+        add is a list of entries, blacklisted for blacklist_ttl seconds, or
+        a mapping of entries to their TTL (None never expires). Removed
+        IPs are also dropped from the counters. Raises a ValueError, and
+        changes nothing, if an entry is not an IP or a network or a TTL is
+        not a number.
+        """
+        # JSON strings are unicode
+        if add is None:
+            add = {}
+        elif isinstance(add, dict):
+            add = dict([(str(elmt), ttl) for elmt, ttl in add.items()])
+        else:
+            add = dict([(str(elmt), self.blacklist_ttl) for elmt in add])
+        remove = [str(elmt) for elmt in remove]
+        added, removed = self._blacklisted.edit(add, remove)
+        for ip in remove:
+            self._counters.remove(ip)
+        return {'added': added, 'removed': removed}
+
+    def admin_stats(self):
+        """Returns the counters of the filtering state."""
+        entries = self._blacklisted.entries()
+        networks = len([elmt for elmt in entries if '/' in elmt])
+        return {'observe': self.observe,
+                'blacklist': {'ips': len(entries) - networks,
+                              'networks': networks},
+                'queues': {'requests': len(self._last_ips),
+                           'bad_requests': len(self._last_br_ips),
+                           'routes': dict([('%s %s' % (route.method,
+                                                      route.pattern),
+                                            len(queue))
+                                           for route, queue
+                                           in self._route_ips.items()])},
+                'shadow': self.shadow_stats()}
+
+    def _json(self, start_response, data, status='200 OK'):
+        body = json.dumps(data)
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _admin_api(self, environ, start_response, path):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            if path == '/blacklist' and method == 'GET':
+                limit = max(1, min(int(query.get('limit', [100])[0]),
+                                   10000))
+                return self._json(start_response, self.admin_list(
+                    query.get('after', [None])[0],
+                    query.get('prefix', [None])[0], limit))
+            elif path == '/blacklist' and method == 'POST':
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+                data = json.loads(environ['wsgi.input'].read(length))
+                return self._json(start_response, self.admin_edit(
+                    data.get('add'), data.get('remove', ())))
+            elif path == '/stats' and method == 'GET':
+                return self._json(start_response, self.admin_stats())
+        except (ValueError, TypeError, AttributeError), e:
+            return self._json(start_response, {'error': str(e)},
+                              '400 Bad Request')
+        return self._json(start_response, {'error': 'Not Found'},
+                          '404 Not Found')
+
     def admin(self, environ, start_response):
         """Displays an admin page containing the blacklisted IPs
 
+        The page is a view over the JSON API, served below it:
+
+        - GET <admin_page>/blacklist?after=&prefix=&limit=: admin_list()
+        - POST <admin_page>/blacklist with {"add": ..., "remove": [...]}:
+          admin_edit()
+        - GET <admin_page>/stats: admin_stats()
+
         This page is not activated by default.
         """
-        post_env = environ.copy()
-        post_env['QUERY_STRING'] = ''
-        post = cgi.FieldStorage(fp=environ['wsgi.input'], environ=post_env,
-                                keep_blank_values=True)
-        ips = [ip for ip in post.keys() if post[ip].value == 'on']
-        for ip in ips:
-            try:
-                self._blacklisted.remove(ip)
-                self._blacklisted.save()  # force immediate save
-                if ip in self._last_ips:
-                    self._last_ips.remove(ip)
-                if ip in self._last_br_ips:
-                    self._last_br_ips.remove(ip)
-            except KeyError:
-                pass
-
+        path = environ.get('PATH_INFO', '')[len(self.admin_page):]
+        if path not in ('', '/'):
+            return self._admin_api(environ, start_response, path)
+
+        if environ.get('REQUEST_METHOD') == 'POST':
+            post_env = environ.copy()
+            post_env['QUERY_STRING'] = ''
+            post = cgi.FieldStorage(fp=environ['wsgi.input'],
+                                    environ=post_env, keep_blank_values=True)
+            self.admin_edit(remove=[ip for ip in post.keys()
+                                    if post[ip].value == 'on'])
+
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        prefix = query.get('prefix', [None])[0]
+        page = self.admin_list(query.get('after', [None])[0], prefix)
+        next_page = None
+        if page['next'] is not None:
+            query = [('after', page['next'])]
+            if prefix is not None:
+                query.append(('prefix', prefix))
+            next_page = '%s?%s' % (self.admin_page, urlencode(query))
         headers = [('Content-Type', 'text/html')]
         start_response('200 OK', headers)
         # we want to display the list of blacklisted IPs
-        return [self._admin_tpl.render(ips=self._blacklisted.ips,
-                                       admin_page=self.admin_page,
-                                       observe=self.observe)]
+        html = self._admin_tpl.render(ips=[elmt for elmt, expiry
+                                           in page['entries']],
+                                      next_page=next_page,
+                                      admin_page=self.admin_page,
+                                      observe=self.observe)
+        return [html.encode('utf8')]
+
+    def shadow_stats(self):
+        """Returns the counters of the shadow policies.
+
+        For each policy: the requests it saw, the ones it would have
+        blocked, and how those overlap with the ones the live policy
+        blocked. dropped is the number of requests the policies missed
+        because their queue was full.
+        """
+        if self._shadows is None:
+            return {'dropped': 0, 'policies': {}}
+        return {'dropped': self._shadows.dropped,
+                'policies': self._shadows.stats()}
+
+    def _is_trusted(self, ip):
+        # None if the IP is invalid
+        address = self._addresses.parse(ip)
+        if address is None:
+            return None
+        return self.trusted_proxies.contains_address(*address)
+
+    def _get_ip(self, environ):
+        # what's the remote ip ?
+        remote = environ.get('REMOTE_ADDR')
+        forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+        if forwarded is None:
+            return remote
+
+        if self.trusted_proxies is None:
+            comma = forwarded.find(',')
+            if comma != -1:
+                forwarded = forwarded[:comma]
+            return forwarded.strip()
+
+        if remote is None or not self._is_trusted(remote):
+            return remote
+
+        # walking the hops from the right, without splitting the header.
+        # Each hop was added by the proxy on its right, so the first
+        # untrusted one is the client.
+        end = len(forwarded)
+        while True:
+            comma = forwarded.rfind(',', 0, end)
+            hop = forwarded[comma + 1:end].strip()
+            trusted = self._is_trusted(hop)
+            if trusted is None:
+                # a trusted proxy forwarded garbage
+                return None
+            if not trusted or comma == -1:
+                return hop
+            end = comma
 
     def __call__(self, environ, start_response):
         # is it an admin call ?
-        url = environ.get('PATH_INFO')
-        if url is not None and url == self.admin_page:
-            return self.admin(environ, start_response)
+        if self.admin_page is not None:
+            path = environ.get('PATH_INFO', '')
+            if (path.startswith(self.admin_page) and
+                path[len(self.admin_page):][:1] in ('', '/')):
+                return self.admin(environ, start_response)
+
+        ip = self._get_ip(environ)
+
+        # a blacklisted network can contain whitelisted IPs
+        if ip is None or (not self.observe and
+                          ((ip in self._blacklisted and
+                            not self._is_whitelisted(ip)) or
+                           self._is_denied(ip))):
+            # returning a 403. Servers may add headers to the list they
+            # get, so the constant one is copied.
+            start_response(_FORBIDDEN_STATUS, list(_FORBIDDEN_HEADERS))
+            if self._shadows is not None and ip is not None:
+                self._shadows.submit(ip, True, None,
+                                     environ.get('REQUEST_METHOD'),
+                                     environ.get('PATH_INFO', ''))
+            return _FORBIDDEN_BODY
 
         start_response_status = []
 
@@ -223,30 +689,18 @@ class IPFiltering(object):
             start_response_status.append(status)
             return start_response(status, headers, exc_info)
 
-        # what's the remote ip ?
-        if 'HTTP_X_FORWARDED_FOR' in environ:
-            ip = environ['HTTP_X_FORWARDED_FOR'].split(',')[0].strip()
-        elif 'REMOTE_ADDR' in environ:
-            ip = environ['REMOTE_ADDR']
-        else:
-            ip = None
-
-        if ip is None or (ip in self._blacklisted and not self.observe):
-            # returning a 403
-            headers = [('Content-Type', 'text/plain')]
-            start_response('403 Forbidden', headers)
-            return ["Forbidden: You don't have permission to access"]
-
         # updating the blacklist on sync mode
         if not self.async:
             self._blcounter += 1
             if self._blcounter >= self.update_blfreq:
                 self._blcounter = 0
                 try:
+                    self._blacklisted.expire()
                     if self._blacklisted.outsynced:
                         self._blacklisted.save()
                     else:
                         self._blacklisted.update()
+                    self._blacklisted.checkpoint()
                 except Exception, e:
                     from keyexchange.filtering import logger
                     logger.error(str(e))
@@ -256,8 +710,14 @@ class IPFiltering(object):
 
         res = self.app(environ, _start_response)
 
-        if start_response_status[0].startswith('400'):
-            # this IP issued a 400. We want to log that
+        status = start_response_status[0]
+        if self._counters.is_bad(status):
+            # this IP issued a bad request. We want to log that
             self._inc_bad_request(ip, environ)
 
+        if self._shadows is not None:
+            self._shadows.submit(ip, False, status,
+                                 environ.get('REQUEST_METHOD'),
+                                 environ.get('PATH_INFO', ''))
+
         return res
@@ -0,0 +1,98 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+History of the IPs that got banned, used to ban repeat offenders longer.
+
+Each IP has a score: the number of times it was banned, halved every
+half_life seconds. The history keeps at most size IPs, the ones banned
+the longest ago are dropped first.
+"""
+
+
+class OffenderHistory(object):
+    """Decaying count of bans per IP. Not thread-safe, the blacklist
+    calls it with its lock held."""
+
+    def __init__(self, size=100000, half_life=86400):
+        self.size = size
+        self.half_life = float(half_life)
+        # ip -> (score, time of the score, expiry of the last ban)
+        self._offenders = {}
+
+    def __len__(self):
+        return len(self._offenders)
+
+    def _decay(self, score, updated, now):
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def score(self, ip, now):
+        """Returns the decayed number of bans of ip."""
+        offender = self._offenders.get(ip)
+        if offender is None:
+            return 0.
+        score, updated, __ = offender
+        return self._decay(score, updated, now)
+
+    def offend(self, ip, now, expiry=None):
+        """Counts a ban of ip ending at expiry.
+
+        A ban is only counted once, so the same change received twice
+        doesn't count twice. Returns False if it was already counted.
+        """
+        offender = self._offenders.get(ip)
+        if offender is None:
+            score = 0.
+        else:
+            score, updated, last_expiry = offender
+            # snapshots round expiries to the second
+            if (expiry is not None and last_expiry is not None and
+                abs(expiry - last_expiry) < 1):
+                return False
+            score = self._decay(score, updated, now)
+        self._offenders[ip] = score + 1, now, expiry
+        if len(self._offenders) > self.size:
+            self._prune()
+        return True
+
+    def forget(self, ip):
+        self._offenders.pop(ip, None)
+
+    def _prune(self):
+        # drops the oldest tenth, so pruning is amortized
+        offenders = sorted(self._offenders.items(),
+                           key=lambda item: item[1][1])
+        for ip, __ in offenders[:len(offenders) - self.size * 9 // 10]:
+            del self._offenders[ip]
@@ -0,0 +1,145 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Request counters per network.
+
+Counting per IP misses floods spread over many addresses of the same
+network, so requests are also counted per prefix, at several levels (e.g.
+/24 and /16 for IPv4, /64 and /48 for IPv6), each with its own treshold.
+
+A level is a dict of network -> count, where the network is the address
+shifted right by the number of host bits. Counts are kept for the current
+and the previous window, and the rate is estimated over a sliding window
+by weighting the previous count with the part of it that is still in the
+window. Each level tracks at most size networks per window.
+"""
+import threading
+
+from keyexchange.clock import get_clock
+from keyexchange.filtering.IPy import IP
+
+_BITS = {4: 32, 6: 128}
+
+
+class PrefixCounters(object):
+    """Sliding window counters per network.
+
+    levels maps an IP version to a list of (prefixlen, treshold).
+    """
+    def __init__(self, levels, window=60, size=100000, clock=None):
+        self.window = float(window)
+        if clock is None:
+            clock = get_clock()
+        self._clock = clock
+        self.size = size
+        # version -> [(host bits, prefixlen, treshold)], most specific
+        # networks first
+        self._levels = {}
+        for version, prefixes in levels.items():
+            prefixes = sorted(prefixes, reverse=True)
+            self._levels[version] = [(_BITS[version] - prefixlen, prefixlen,
+                                      treshold)
+                                     for prefixlen, treshold in prefixes]
+        self._lock = threading.Lock()
+        self._start = clock.time()
+        self._current = self._new_counts()
+        self._previous = self._new_counts()
+
+    def _new_counts(self):
+        return dict([((version, prefixlen), {})
+                     for version, levels in self._levels.items()
+                     for __, prefixlen, __ in levels])
+
+    def _rotate(self, now):
+        elapsed = now - self._start
+        if elapsed < self.window:
+            return elapsed
+        if elapsed < 2 * self.window:
+            self._previous = self._current
+        else:
+            self._previous = self._new_counts()
+        self._current = self._new_counts()
+        self._start += self.window * int(elapsed / self.window)
+        return now - self._start
+
+    def hit(self, address, weight=1, now=None):
+        """Counts a request from address, an (integer, version) tuple.
+
+        Returns the most specific network that went over its treshold,
+        in CIDR notation, or None.
+        """
+        ip, version = address
+        levels = self._levels.get(version)
+        if not levels:
+            return None
+        if now is None:
+            now = self._clock.time()
+
+        over = None
+        self._lock.acquire()
+        try:
+            # the part of the previous window still in the sliding window
+            ratio = 1 - self._rotate(now) / self.window
+            for hostbits, prefixlen, treshold in levels:
+                network = ip >> hostbits
+                counts = self._current[version, prefixlen]
+                count = counts.get(network)
+                if count is None:
+                    if len(counts) >= self.size:
+                        continue
+                    count = 0
+                count = counts[network] = count + weight
+                if over is None:
+                    previous = self._previous[version, prefixlen]
+                    rate = count + previous.get(network, 0) * ratio
+                    if rate >= treshold:
+                        over = network << hostbits, prefixlen
+        finally:
+            self._lock.release()
+
+        if over is None:
+            return None
+        network, prefixlen = over
+        return IP(network, ipversion=version).make_net(
+            prefixlen).strCompressed(1)
+
+    def networks(self, address):
+        """Returns the counted networks of address, an (integer, version)
+        tuple, in CIDR notation, most specific first."""
+        ip, version = address
+        return [IP(ip >> hostbits << hostbits, ipversion=version).make_net(
+                    prefixlen).strCompressed(1)
+                for hostbits, prefixlen, __ in self._levels.get(version, ())]
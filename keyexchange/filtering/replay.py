@@ -0,0 +1,217 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Replays access logs through the filtering policy, to tune its settings.
+
+Usage::
+
+    $ bin/keyexchange-replay access.log treshold=10,20,50 queue_size=200,1000
+
+Every combination of the given CounterPolicy options is replayed in its
+own worker process. Options that take a list, like prefix_tresholds, are
+given as one whitespace-separated value, e.g. "prefix_tresholds=24:500
+16:5000". Each worker streams the log (common log format, as
+written by TransLogger) through the policy, with a clock that follows the
+log timestamps, and reports:
+
+- bans: number of bans
+- banned: number of distinct banned IPs and networks
+- blocked: number of requests that would have been rejected
+- suspicious: banned IPs that never made a bad request. These are the
+  candidates for false positives.
+- max_rss: peak memory of the worker, in kilobytes.
+"""
+import sys
+import time
+import json
+import calendar
+import resource
+import itertools
+from optparse import OptionParser
+from multiprocessing import Pool
+
+from keyexchange.clock import VirtualClock
+from keyexchange.filtering.shadow import CounterPolicy, _number
+
+_MONTHS = dict([(month, index + 1) for index, month in
+                enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul',
+                           'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])])
+
+
+def parse_timestamp(stamp):
+    """Parses '10/Oct/2000:13:55:36 -0700' into an epoch time."""
+    parsed = calendar.timegm((int(stamp[7:11]), _MONTHS[stamp[3:6]],
+                              int(stamp[0:2]), int(stamp[12:14]),
+                              int(stamp[15:17]), int(stamp[18:20])))
+    offset = int(stamp[22:24]) * 3600 + int(stamp[24:26]) * 60
+    if stamp[21] == '-':
+        offset = -offset
+    return parsed - offset
+
+
+def read_log(lines):
+    """Yields (ip, timestamp, status, method, path) for each valid line."""
+    last_stamp = last_time = None
+    for line in lines:
+        # ip - user [timestamp] "request" status size ...
+        space = line.find(' ')
+        start = line.find('[', space)
+        end = line.find(']', start)
+        request = line.find('"', end)
+        quote = line.find('"', request + 1)
+        if space == -1 or start == -1 or end == -1 or request == -1 or \
+           quote == -1:
+            continue
+        stamp = line[start + 1:end]
+        # most consecutive lines share their timestamp
+        if stamp != last_stamp:
+            try:
+                last_time = parse_timestamp(stamp)
+            except (ValueError, KeyError, IndexError):
+                continue
+            last_stamp = stamp
+        # "METHOD PATH PROTOCOL"
+        request = line[request + 1:quote].split(' ')
+        if len(request) > 1:
+            method, path = request[0], request[1]
+        else:
+            method, path = None, ''
+        yield line[:space], last_time, line[quote + 2:quote + 5], method, path
+
+
+def replay(path, options, bad_statuses='400', route_costs=None):
+    """Replays the log at path through a CounterPolicy built with options.
+
+    Returns a dict of counters.
+    """
+    clock = VirtualClock()
+    bans = []
+    policy = CounterPolicy('replay', clock=clock, callback=bans.append,
+                           bad_statuses=bad_statuses, route_costs=route_costs,
+                           **options)
+    is_bad = policy.counters.is_bad
+    bad_ips = set()
+    banned = set()
+    requests = blocked = 0
+
+    log = open(path)
+    try:
+        for ip, now, status, method, request_path in read_log(log):
+            clock.now = now
+            requests += 1
+            if is_bad(status):
+                bad_ips.add(ip)
+            if policy.check(ip, status, now, method, request_path):
+                blocked += 1
+    finally:
+        log.close()
+
+    banned.update(bans)
+    banned_ips = set([elmt for elmt in banned if '/' not in elmt])
+    return {'options': options, 'requests': requests, 'bans': len(bans),
+            'banned': len(banned), 'blocked': blocked,
+            'suspicious': len(banned_ips - bad_ips),
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def _replay(args):
+    return replay(*args)
+
+
+def combinations(options):
+    """Returns every combination of {name: [values]} as a list of dicts."""
+    names = sorted(options)
+    return [dict(zip(names, values)) for values in
+            itertools.product(*[options[name] for name in names])]
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] LOGFILE name=v1,v2 ...')
+    parser.add_option('-p', '--processes', type='int', default=None,
+                      help='number of worker processes (default: one per '
+                           'CPU)')
+    parser.add_option('-b', '--bad-statuses', default='400',
+                      help='comma-separated statuses or classes like 4xx '
+                           'counted as bad requests (default: 400)')
+    parser.add_option('-r', '--route-cost', dest='route_costs',
+                      action='append', default=None,
+                      help="a 'METHOD PATTERN COST [TRESHOLD]' route. Can "
+                           'be repeated')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='prints the results as JSON')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('missing the log file')
+
+    path = args[0]
+    grid = {}
+    for arg in args[1:]:
+        name, values = arg.split('=')
+        grid[name] = [_number(value) for value in values.split(',')]
+
+    try:
+        # a fresh process per combination, so max_rss is its own
+        pool = Pool(options.processes, maxtasksperchild=1)
+    except TypeError:
+        # Python 2.6
+        pool = Pool(options.processes)
+    start = time.time()
+    try:
+        results = pool.map(_replay, [(path, combination,
+                                      options.bad_statuses,
+                                      options.route_costs)
+                                     for combination in combinations(grid)])
+    finally:
+        pool.close()
+        pool.join()
+
+    if options.json:
+        print(json.dumps(results))
+        return 0
+    for result in results:
+        settings = ' '.join(['%s=%s' % item
+                             for item in sorted(result['options'].items())])
+        print('%s: %d requests, %d bans, %d banned, %d blocked, '
+              '%d suspicious, %d KB' % (settings or 'defaults',
+              result['requests'], result['bans'], result['banned'],
+              result['blocked'], result['suspicious'], result['max_rss']))
+    sys.stderr.write('%d combinations replayed in %.1fs\n' % (
+                     len(results), time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
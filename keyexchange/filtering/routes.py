@@ -0,0 +1,122 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Per-route costs for the request counters.
+
+Routes are defined by lines of the form::
+
+    METHOD PATTERN COST [TRESHOLD]
+
+METHOD can be * to match all methods. In PATTERN, * matches any part of a
+path segment. The first matching route wins, so specific routes go first::
+
+    GET /new_channel 10 50
+    * /* 1
+
+Requests that match no route cost 1. A route with a TRESHOLD also gets a
+counter of its own, so a client that hammers it can be blacklisted before
+it reaches the global treshold.
+
+All the routes that apply to a method are compiled into a single regular
+expression, so matching a request is one regex search.
+"""
+import re
+
+
+class Route(object):
+    """A route: method, pattern, cost and optional treshold."""
+
+    def __init__(self, method, pattern, cost=1, treshold=None):
+        self.method = method.upper()
+        self.pattern = pattern
+        self.cost = cost
+        self.treshold = treshold
+
+    def regex(self):
+        return '[^/]*'.join([re.escape(part)
+                             for part in self.pattern.split('*')])
+
+    def __repr__(self):
+        return '<Route %s %s>' % (self.method, self.pattern)
+
+
+def parse_route(line):
+    """Parses a 'METHOD PATTERN COST [TRESHOLD]' line into a Route."""
+    parts = line.split()
+    if len(parts) not in (3, 4):
+        raise ValueError('Invalid route %r' % line)
+    treshold = None
+    if len(parts) == 4:
+        treshold = int(parts[3])
+    return Route(parts[0], parts[1], int(parts[2]), treshold)
+
+
+class Router(object):
+    """Matches requests to routes.
+
+    routes is a list of Route instances or of lines parsed by
+    parse_route().
+    """
+    def __init__(self, routes):
+        self.routes = []
+        for route in routes:
+            if not isinstance(route, Route):
+                route = parse_route(route)
+            self.routes.append(route)
+        methods = set([route.method for route in self.routes])
+        methods.discard('*')
+        self._compiled = dict([(method, self._compile(method))
+                               for method in methods])
+        self._default = self._compile('*')
+
+    def _compile(self, method):
+        routes = [route for route in self.routes
+                  if route.method in (method, '*')]
+        if not routes:
+            return None, []
+        # one group per route, lastindex tells which one matched
+        regex = '|'.join(['(%s)' % route.regex() for route in routes])
+        return re.compile('^(?:%s)$' % regex), routes
+
+    def match(self, method, path):
+        """Returns the first route matching the request, or None."""
+        regex, routes = self._compiled.get(method, self._default)
+        if regex is None:
+            return None
+        match = regex.match(path)
+        if match is None:
+            return None
+        return routes[match.lastindex - 1]
@@ -0,0 +1,202 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Shadow policies: filtering policies that see the live traffic but never
+reject anything, to try other settings on production traffic.
+
+Requests are handed to a ShadowRunner through a bounded queue, and a
+worker thread feeds them to each policy. When the queue is full, requests
+are dropped instead of slowing down the application. For each policy, the
+runner counts the requests it would have blocked, and how they overlap
+with the ones the live policy blocked.
+
+A policy is any object with a name attribute and a
+check(ip, status, now, method, path) method returning True if it would
+have blocked the request. status is None for the requests the live
+policy rejected.
+"""
+import threading
+from Queue import Queue, Full
+
+from keyexchange.clock import get_clock
+from keyexchange.filtering.counters import RequestCounters
+
+
+class CounterPolicy(object):
+    """The counting policy of IPFiltering, with its own settings.
+
+    Takes the blacklist_ttl and br_blacklist_ttl options of IPFiltering,
+    and the ones of keyexchange.filtering.counters.RequestCounters.
+    callback is called with each IP or network the policy bans.
+    """
+
+    def __init__(self, name, blacklist_ttl=300, br_blacklist_ttl=86400,
+                 callback=None, **options):
+        self.name = name
+        self.blacklist_ttl = blacklist_ttl
+        self.br_blacklist_ttl = br_blacklist_ttl
+        self.callback = callback
+        self.counters = RequestCounters(**options)
+        # ip or network -> expiry of the bans this policy would have made
+        self.banned = {}
+        self._networks = 0
+
+    def _is_banned(self, elmt, now):
+        expiry = self.banned.get(elmt)
+        if expiry is None:
+            return False
+        if expiry > now:
+            return True
+        del self.banned[elmt]
+        if '/' in elmt:
+            self._networks -= 1
+        return False
+
+    def _ban(self, elmt, ttl, now):
+        if '/' in elmt and elmt not in self.banned:
+            self._networks += 1
+        self.banned[elmt] = now + ttl
+        if self.callback is not None:
+            self.callback(elmt)
+
+    def check(self, ip, status, now, method=None, path=''):
+        if self._is_banned(ip, now):
+            return True
+        if self._networks:
+            for network in self.counters.networks(ip):
+                if self._is_banned(network, now):
+                    return True
+
+        over, network = self.counters.hit(ip, method, path)
+        if network is not None:
+            self._ban(network, self.blacklist_ttl, now)
+        ttls = []
+        if over:
+            ttls.append(self.blacklist_ttl)
+        if self.counters.is_bad(status) and self.counters.hit_bad(ip):
+            ttls.append(self.br_blacklist_ttl)
+        if ttls:
+            # one ban, for the longest TTL
+            self._ban(ip, max(ttls), now)
+        return False
+
+
+def _number(value):
+    # option values are numbers, or lists separated by commas
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_policy(line, **defaults):
+    """Parses 'name key=value ...' into a CounterPolicy.
+
+    defaults are the options the line doesn't set. Lists are separated by
+    commas, e.g. bad_statuses=400,5xx prefix_tresholds=24:500,16:5000
+    """
+    parts = line.split()
+    options = dict(defaults)
+    for option in parts[1:]:
+        key, value = option.split('=')
+        options[key] = _number(value)
+    return CounterPolicy(parts[0], **options)
+
+
+class ShadowRunner(threading.Thread):
+    """Feeds the requests to the shadow policies, off the request path."""
+
+    def __init__(self, policies, queue_size=10000, clock=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.policies = policies
+        if clock is None:
+            clock = get_clock()
+        self._clock = clock
+        self._queue = Queue(queue_size)
+        self.dropped = 0
+        self._stats = dict([(policy.name, {'requests': 0, 'blocked': 0,
+                                           'both': 0, 'shadow_only': 0,
+                                           'live_only': 0})
+                            for policy in policies])
+
+    def submit(self, ip, live_blocked, status=None, method=None, path=''):
+        """Queues a request. Never blocks."""
+        try:
+            self._queue.put_nowait((ip, live_blocked, status,
+                                    self._clock.time(), method, path))
+        except Full:
+            self.dropped += 1
+
+    def stats(self):
+        """Returns a mapping of policy name -> counters."""
+        return dict([(name, dict(counters))
+                     for name, counters in self._stats.items()])
+
+    def process(self, ip, live_blocked, status, now, method=None, path=''):
+        for policy in self.policies:
+            try:
+                blocked = policy.check(ip, status, now, method, path)
+            except Exception, e:
+                from keyexchange.filtering import logger
+                logger.error('Shadow policy %s failed: %s' % (policy.name,
+                                                              str(e)))
+                continue
+            counters = self._stats[policy.name]
+            counters['requests'] += 1
+            if blocked:
+                counters['blocked'] += 1
+                if live_blocked:
+                    counters['both'] += 1
+                else:
+                    counters['shadow_only'] += 1
+            elif live_blocked:
+                counters['live_only'] += 1
+
+    def run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            self.process(*request)
+
+    def join(self, timeout=None):
+        """Stops the worker once the queued requests are processed."""
+        self._queue.put(None)
+        threading.Thread.join(self, timeout)
@@ -0,0 +1,180 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Versioned synchronization of the blacklist through memcache.
+
+Changes are pushed as an append-only sequence of records, one memcache key
+per version::
+
+    <prefix>:version        -> latest version (memcache counter)
+    <prefix>:change:<n>     -> list of (op, entry, expiry) records
+
+A node only fetches the versions it did not see yet. Every compact_every
+versions, the node that pushed the change also writes a snapshot of the
+whole blacklist, sharded across several keys::
+
+    <prefix>:snapshot       -> (version, snapshot id, number of shards)
+    <prefix>:snapshot:<id>:<i> -> (entry, expiry) list, see
+                                  keyexchange.filtering.codec
+
+Nodes that are too far behind, or that missed some changes, start over
+from the latest snapshot. Applying a record twice is harmless, so a
+snapshot may contain changes that are newer than its version.
+"""
+from keyexchange.filtering.codec import encode, decode
+
+ADD = '+'
+REMOVE = '-'
+
+
+def _chunks(items, size):
+    for index in xrange(0, len(items), size):
+        yield items[index:index + size]
+
+
+class MemcacheLog(object):
+    """Change log and snapshots of the blacklist, stored in memcache."""
+
+    def __init__(self, cache_server, prefix='keyexchange:blacklist',
+                 compact_every=100, shard_size=5000, chunk_size=1000,
+                 ttl=3600):
+        self.cache_server = cache_server
+        self.prefix = prefix
+        self.compact_every = compact_every
+        self.shard_size = shard_size
+        self.chunk_size = chunk_size
+        # change records are dropped by memcache after this time
+        self.ttl = ttl
+
+    def _key(self, *parts):
+        return ':'.join([self.prefix] + [str(part) for part in parts])
+
+    def latest(self):
+        """Returns the latest version, or 0."""
+        version = self.cache_server.get(self._key('version'))
+        if version is None:
+            return 0
+        return int(version)
+
+    def _next_versions(self, count):
+        # returns the last version of the reserved range
+        key = self._key('version')
+        version = self.cache_server.incr(key, count)
+        if version is None:
+            self.cache_server.add(key, '0')
+            version = self.cache_server.incr(key, count)
+        return int(version)
+
+    def push(self, records):
+        """Pushes change records. Returns the versions used."""
+        if not records:
+            return []
+        chunks = list(_chunks(records, self.chunk_size))
+        last = self._next_versions(len(chunks))
+        versions = range(last - len(chunks) + 1, last + 1)
+        for version, chunk in zip(versions, chunks):
+            if not self.cache_server.set(self._key('change', version), chunk,
+                                         time=self.ttl):
+                from keyexchange.filtering import logger
+                logger.error('Could not push the blacklist change %d' %
+                             version)
+        return versions
+
+    def changes(self, start, end):
+        """Returns a mapping of version -> records for start..end.
+
+        Versions that are not (or no longer) in memcache are missing.
+        """
+        keys = dict([(self._key('change', version), version)
+                     for version in xrange(start, end + 1)])
+        found = self.cache_server.get_multi(keys.keys())
+        return dict([(keys[key], records)
+                     for key, records in found.items()])
+
+    def compaction_due(self, versions):
+        for version in versions:
+            if version % self.compact_every == 0:
+                return True
+        return False
+
+    def snapshot(self):
+        """Returns the latest (version, entries) snapshot, or None."""
+        pointer = self.cache_server.get(self._key('snapshot'))
+        if pointer is None:
+            return None
+        version, snapshot_id, shards = pointer
+        keys = [self._key('snapshot', snapshot_id, index)
+                for index in range(shards)]
+        found = self.cache_server.get_multi(keys)
+        if len(found) != shards:
+            # being replaced, or partly evicted
+            return None
+        entries = []
+        try:
+            for key in keys:
+                entries.extend(decode(found[key]))
+        except ValueError, e:
+            # written by a node using another format, the changes
+            # will be used instead
+            from keyexchange.filtering import logger
+            logger.error('Could not read the blacklist snapshot: %s' % str(e))
+            return None
+        return version, entries
+
+    def write_snapshot(self, version, entries, snapshot_id):
+        """Writes a new snapshot, then drops the previous one.
+
+        snapshot_id must be unique, like the version of the change
+        that made the compaction due.
+        """
+        previous = self.cache_server.get(self._key('snapshot'))
+        shards = list(_chunks(entries, self.shard_size))
+        for index, shard in enumerate(shards):
+            if not self.cache_server.set(self._key('snapshot', snapshot_id,
+                                                   index), encode(shard)):
+                from keyexchange.filtering import logger
+                logger.error('Could not write the blacklist snapshot')
+                return False
+
+        self.cache_server.set(self._key('snapshot'),
+                              (version, snapshot_id, len(shards)))
+
+        if previous is not None and previous[1] != snapshot_id:
+            __, previous_id, previous_shards = previous
+            for index in range(previous_shards):
+                self.cache_server.delete(self._key('snapshot', previous_id,
+                                                   index))
+        return True
@@ -0,0 +1,334 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Transports used to propagate blacklist changes between nodes.
+
+A transport is attached to a Blacklist and has to provide:
+
+- attach(blacklist): called once. Remote changes are handed to
+  blacklist.receive(records), or applied with blacklist._apply(records)
+  when the transport is called with the blacklist lock held.
+- publish(records): sends local (op, entry, expiry) change records.
+- poll(): fetches remote changes, for transports that need polling.
+  Called with the blacklist lock held.
+- frequency: seconds between two polls, or None if the transport
+  pushes changes and never needs to be polled.
+- close(): releases the resources.
+
+MemcacheTransport polls the versioned change log stored in memcache.
+UDPTransport pushes changes as soon as they happen, to a list of peers or
+to a multicast group, and can use a MemcacheTransport as a fallback to
+catch up on lost datagrams and to bootstrap new nodes.
+"""
+import os
+import time
+import json
+import hmac
+import socket
+import struct
+import threading
+from hashlib import sha1
+
+from keyexchange.filtering.sync import MemcacheLog, ADD
+
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    # Python < 2.7.7
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+def _address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+class MemcacheTransport(object):
+    """Polls the change log stored in memcache.
+
+    At most max_fetch versions are fetched per poll. A missing version is
+    retried once if it's among the last compact_every versions, since it
+    may not be written yet. Older missing versions are lost, and are
+    skipped right away.
+    """
+
+    def __init__(self, cache_server, frequency=5, compact_every=100,
+                 max_fetch=1000):
+        self.log = MemcacheLog(cache_server, compact_every=compact_every)
+        self.frequency = frequency
+        self.max_fetch = max_fetch
+        # last version of the change log applied locally, the versions
+        # that were found missing once, and the ones pushed by this node
+        self.version = 0
+        self.missing = set()
+        self.own = set()
+        self.blacklist = None
+
+    def attach(self, blacklist):
+        self.blacklist = blacklist
+
+    def poll(self):
+        # fetching the changes made since our version
+        latest = self.log.latest()
+        if latest <= self.version:
+            return
+        start = self.version + 1
+        if latest - self.version > self.log.compact_every:
+            # too far behind, starting over from the snapshot
+            start = self._load_snapshot(start)
+
+        end = min(latest, start + self.max_fetch - 1)
+        changes = self.log.changes(start, end)
+        recent = latest - self.log.compact_every
+        applied = start - 1
+        lost = 0
+        for version in xrange(start, end + 1):
+            if version in self.own:
+                # applied already, and applying it again could undo
+                # newer local changes
+                self.own.discard(version)
+                self.missing.discard(version)
+                applied = version
+                continue
+            records = changes.get(version)
+            if records is None:
+                if version > recent and version not in self.missing:
+                    # the changes may not be written yet, retrying them
+                    # all later
+                    self.missing.update([missing for missing
+                                         in xrange(version, end + 1)
+                                         if missing not in changes])
+                    break
+                self.missing.discard(version)
+                lost += 1
+            else:
+                self.missing.discard(version)
+                self.blacklist._apply(records)
+            applied = version
+        self.version = applied
+        if lost:
+            from keyexchange.filtering import logger
+            logger.error('Lost %d blacklist changes before version %d' %
+                         (lost, applied + 1))
+
+    def _load_snapshot(self, start):
+        snapshot = self.log.snapshot()
+        if snapshot is None or snapshot[0] < start:
+            return start
+        version, entries = snapshot
+        self.blacklist._apply([(ADD, elmt, expiry)
+                               for elmt, expiry in entries])
+        self.missing.clear()
+        self.own = set([own for own in self.own if own > version])
+        self.version = version
+        return version + 1
+
+    def publish(self, records):
+        # the blacklist polls before publishing, so a snapshot written
+        # now is complete
+        versions = self.log.push(records)
+        self.own.update(versions)
+        if self.log.compaction_due(versions):
+            self.log.write_snapshot(self.version, self.blacklist._snapshot(),
+                                    versions[-1])
+
+    def close(self):
+        pass
+
+
+class UDPTransport(object):
+    """Pushes changes over UDP, as JSON datagrams.
+
+    - address: host:port to listen to. If the host is a multicast group,
+      the socket joins it.
+    - peers: list of host:port to send the changes to. Can be a multicast
+      group.
+    - secret: if set, datagrams are signed with it and unsigned ones are
+      dropped, as well as the ones sent more than max_age seconds ago or
+      already received. The port should not be reachable from the outside
+      anyway.
+    - fallback: an optional polling transport, that also gets every
+      published change.
+    """
+    max_records = 50
+    max_age = 30
+
+    def __init__(self, address, peers, secret=None, fallback=None):
+        self.address = _address(address)
+        if isinstance(peers, str):
+            peers = peers.split()
+        self.peers = [_address(peer) for peer in peers]
+        self.secret = secret
+        self.fallback = fallback
+        if fallback is not None:
+            self.frequency = fallback.frequency
+        else:
+            self.frequency = None
+        # used to ignore our own datagrams when they are looped back
+        self.node_id = os.urandom(8).encode('hex')
+        # signature -> expiry of the datagrams received recently
+        self._seen = {}
+        self._purge_at = 0
+        self.blacklist = None
+        self._socket = None
+        self._receiver = None
+        self._running = False
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict['_socket'] = odict['_receiver'] = odict['blacklist'] = None
+        odict['_running'] = False
+        return odict
+
+    def attach(self, blacklist):
+        self.blacklist = blacklist
+        if self.fallback is not None:
+            self.fallback.attach(blacklist)
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        host, port = self.address
+        if self._is_multicast(host):
+            self._socket.bind(('', port))
+            group = struct.pack('4sl', socket.inet_aton(host),
+                                socket.INADDR_ANY)
+            self._socket.setsockopt(socket.IPPROTO_IP,
+                                    socket.IP_ADD_MEMBERSHIP, group)
+        else:
+            self._socket.bind(self.address)
+        self._socket.settimeout(.5)
+
+        self._running = True
+        self._receiver = threading.Thread(target=self._receive)
+        self._receiver.daemon = True
+        self._receiver.start()
+
+    def _is_multicast(self, host):
+        try:
+            return 224 <= int(host.split('.')[0]) <= 239
+        except ValueError:
+            return False
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, sha1).hexdigest()
+
+    def _encode(self, records, now=None):
+        if now is None:
+            now = time.time()
+        payload = json.dumps([self.node_id, now, records])
+        if self.secret is not None:
+            payload = self._sign(payload) + payload
+        return payload
+
+    def _is_replayed(self, signature, sent, now):
+        if abs(now - sent) > self.max_age:
+            return True
+        if now >= self._purge_at:
+            self._seen = dict([(seen, expiry)
+                               for seen, expiry in self._seen.items()
+                               if expiry > now])
+            self._purge_at = now + self.max_age
+        if signature in self._seen:
+            return True
+        self._seen[signature] = sent + self.max_age
+        return False
+
+    def _decode(self, data, now=None):
+        if self.secret is not None:
+            signature, data = data[:40], data[40:]
+            if not compare_digest(signature, self._sign(data)):
+                return None
+        node_id, sent, records = json.loads(data)
+        if node_id == self.node_id:
+            return None
+        if self.secret is not None:
+            if now is None:
+                now = time.time()
+            if self._is_replayed(signature, sent, now):
+                return None
+        return [(str(op), str(elmt), expiry) for op, elmt, expiry in records]
+
+    def _receive(self):
+        while self._running:
+            try:
+                data, __ = self._socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except socket.error:
+                # the socket was closed
+                break
+            try:
+                records = self._decode(data)
+                if records:
+                    self.blacklist.receive(records)
+            except Exception, e:
+                from keyexchange.filtering import logger
+                logger.error('Invalid blacklist datagram: %s' % str(e))
+
+    def poll(self):
+        if self.fallback is not None:
+            self.fallback.poll()
+
+    def publish(self, records):
+        for index in xrange(0, len(records), self.max_records):
+            data = self._encode(records[index:index + self.max_records])
+            for peer in self.peers:
+                try:
+                    self._socket.sendto(data, peer)
+                except socket.error, e:
+                    from keyexchange.filtering import logger
+                    logger.error('Could not send to %s:%d: %s' % (peer[0],
+                                 peer[1], str(e)))
+        if self.fallback is not None:
+            self.fallback.publish(records)
+
+    def close(self):
+        self._running = False
+        if self._receiver is not None:
+            self._receiver.join()
+            self._receiver = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        if self.fallback is not None:
+            self.fallback.close()
@@ -0,0 +1,305 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Micro-benchmarks for the IP filtering layer.
+
+Usage::
+
+    $ bin/python -m keyexchange.tests.bench_filtering [name ...]
+
+Without arguments, all benchmarks are run.
+"""
+import os
+import sys
+import time
+import gc
+import resource
+import tempfile
+import subprocess
+import threading
+import cPickle
+
+from keyexchange.filtering.IPy import IP
+from keyexchange.filtering.importer import read_feed
+from keyexchange.filtering.blacklist import Blacklist
+from keyexchange.filtering.ipqueue import IPQueue, StripedIPQueue
+from keyexchange.clock import VirtualClock
+from keyexchange.filtering.ipset import IPSet
+from keyexchange.filtering.codec import encode, decode
+from keyexchange.filtering.middleware import IPFiltering
+from keyexchange.util import MemoryClient
+
+
+def _maxrss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _DictIP(object):
+    # mimics the layout IP instances had before they used __slots__
+    def __init__(self, ip):
+        self.ip = ip
+        self._ipversion = 4
+        self._prefixlen = 32
+        self.NoPrefixForSingleIp = 1
+        self.WantPrefixLen = None
+
+
+_LAYOUTS = [('IP (__slots__)', IP), ('__dict__ layout', _DictIP)]
+
+
+def _ipy_memory(layout, size):
+    # run in a fresh process per layout: ru_maxrss is the high-water
+    # mark of the whole process
+    label, factory = _LAYOUTS[layout]
+    base = 0x0a000000
+    gc.collect()
+    before = _maxrss()
+    start = time.time()
+    items = [factory(base + i) for i in xrange(size)]
+    duration = time.time() - start
+    per_item = sys.getsizeof(items[0])
+    if hasattr(items[0], '__dict__'):
+        per_item += sys.getsizeof(items[0].__dict__)
+    print('%-16s %d instances: %.2fs, ~%d bytes each, +%d KB RSS' % (
+          label, size, duration, per_item, _maxrss() - before))
+
+
+def bench_ipy_memory(size=1000000):
+    """Memory used by 1M IP instances, compared to a __dict__ layout."""
+    for layout in range(len(_LAYOUTS)):
+        sys.stdout.flush()
+        subprocess.check_call([sys.executable, '-c',
+                               'from keyexchange.tests.bench_filtering '
+                               'import _ipy_memory; _ipy_memory(%d, %d)'
+                               % (layout, size)])
+
+
+def bench_feed_import(size=1000000):
+    """Import of a 1M entries feed, half networks and half banned IPs."""
+    fd, path = tempfile.mkstemp()
+    try:
+        feed = os.fdopen(fd, 'w')
+        try:
+            for i in xrange(size / 2):
+                feed.write('%d.%d.%d.0/24\n' % (i >> 16 & 255, i >> 8 & 255,
+                                                i & 255))
+                feed.write('10.%d.%d.%d 600\n' % (i >> 16 & 255,
+                                                   i >> 8 & 255, i & 255))
+        finally:
+            feed.close()
+
+        start = time.time()
+        ttls, ranges = read_feed(path)
+        parsed = time.time()
+        blacklist = Blacklist(async=False)
+        blacklist.load(ttls)
+        denylist = IPSet()
+        denylist.update_ranges(ranges)
+        print('%d entries: parsed in %.2fs, loaded in %.2fs' % (
+              size, parsed - start, time.time() - parsed))
+    finally:
+        os.remove(path)
+
+
+class _SlowClient(MemoryClient):
+    # simulates the network round trip of a memcache server
+    def get(self, key):
+        time.sleep(.005)
+        return MemoryClient.get(self, key)
+
+
+class _LockedBlacklist(Blacklist):
+    # reads under the lock, like the blacklist used to
+    def __contains__(self, elmt):
+        self._lock.acquire()
+        try:
+            return Blacklist.__contains__(self, elmt)
+        finally:
+            self._lock.release()
+
+
+def bench_blacklist_contention(threads=60, duration=2.):
+    """Membership checks from 60 threads while the syncer does I/O."""
+    for label, klass in (('lock-free reads', Blacklist),
+                         ('locked reads', _LockedBlacklist)):
+        blacklist = klass(_SlowClient(None), frequency=0, async=False)
+        for i in range(1000):
+            blacklist.add('10.0.%d.%d' % (i >> 8, i & 255), 600)
+        blacklist.save()
+        counts = [0] * threads
+        running = [True]
+
+        def sync():
+            while running[0]:
+                blacklist.update()
+
+        def read(index):
+            ips = ['10.0.0.1', '10.1.0.1', '192.168.0.1']
+            count = 0
+            while running[0]:
+                for ip in ips:
+                    ip in blacklist
+                count += len(ips)
+            counts[index] = count
+
+        workers = [threading.Thread(target=sync)]
+        workers += [threading.Thread(target=read, args=(i,))
+                    for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        time.sleep(duration)
+        running[0] = False
+        for worker in workers:
+            worker.join()
+        print('%-16s %d threads: %d checks/s' % (label, threads,
+              sum(counts) / duration))
+
+
+def bench_ipqueue_contention(threads=60, duration=2.):
+    """Counting requests from 60 threads, with and without stripes."""
+    for label, queue in (('single lock', IPQueue(10000)),
+                         ('4 stripes', StripedIPQueue(10000, stripes=4)),
+                         ('16 stripes', StripedIPQueue(10000, stripes=16))):
+        counts = [0] * threads
+        running = [True]
+
+        def count(index):
+            ips = ['10.0.%d.%d' % (index, i) for i in range(50)]
+            done = 0
+            while running[0]:
+                for ip in ips:
+                    queue.append(ip)
+                done += len(ips)
+            counts[index] = done
+
+        workers = [threading.Thread(target=count, args=(i,))
+                   for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        time.sleep(duration)
+        running[0] = False
+        for worker in workers:
+            worker.join()
+        print('%-12s %d threads: %d requests/s' % (label, threads,
+              sum(counts) / duration))
+
+
+def bench_ipqueue_expiry(size=200000):
+    """Appending a burst of IPs, then expiring all of them with len()."""
+    clock = VirtualClock(1000)
+    queue = IPQueue(size, ttl=360, clock=clock)
+    start = time.time()
+    for i in xrange(size):
+        queue.append('10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255))
+        clock.advance(.001)
+    print('append: %d IPs/s' % (size / (time.time() - start)))
+    clock.advance(360)
+    start = time.time()
+    length = len(queue)
+    print('len() after expiry: %d IPs left in %.3fs' % (length,
+          time.time() - start))
+    start = time.time()
+    for i in xrange(size):
+        len(queue)
+    print('len(): %d calls/s' % (size / (time.time() - start)))
+
+
+def bench_snapshot_codec(size=500000):
+    """Snapshot of 500k IPv4 entries, pickled and with the binary codec."""
+    now = time.time()
+    entries = [('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                now + i % 3600) for i in xrange(size)]
+    for label, dumps, loads in (('pickle', cPickle.dumps, cPickle.loads),
+                                ('codec', encode, decode)):
+        start = time.time()
+        data = dumps(entries)
+        encoded = time.time()
+        loads(data)
+        print('%-8s %d entries: %d bytes, encoded in %.2fs, decoded in '
+              '%.2fs' % (label, size, len(data), encoded - start,
+                         time.time() - encoded))
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def _hello(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['hello']
+
+
+def bench_rejections(duration=2.):
+    """Rejected and accepted requests per second, on one core."""
+    app = IPFiltering(_hello, use_memory=True, async=False,
+                      update_blfreq=1000, treshold=10 ** 9,
+                      ip_whitelist=[], ip_denylist=['192.0.2.0/24'])
+    app._blacklisted.add('10.0.0.1')
+    for label, environ in (
+            ('blacklisted', {'REMOTE_ADDR': '10.0.0.1'}),
+            ('forwarded', {'REMOTE_ADDR': '127.0.0.1',
+                           'HTTP_X_FORWARDED_FOR': '10.0.0.1, 10.1.1.1'}),
+            ('denied', {'REMOTE_ADDR': '192.0.2.1'}),
+            ('accepted', {'REMOTE_ADDR': '10.0.0.2'})):
+        count = 0
+        end = time.time() + duration
+        while time.time() < end:
+            for i in xrange(1000):
+                app(environ, _start_response)
+            count += 1000
+        print('%-12s %d requests/s' % (label, count / duration))
+
+
+BENCHMARKS = {'ipy_memory': bench_ipy_memory,
+              'feed_import': bench_feed_import,
+              'blacklist_contention': bench_blacklist_contention,
+              'ipqueue_contention': bench_ipqueue_contention,
+              'ipqueue_expiry': bench_ipqueue_expiry,
+              'snapshot_codec': bench_snapshot_codec,
+              'rejections': bench_rejections}
+
+
+def main(names=None):
+    if not names:
+        names = sorted(BENCHMARKS.keys())
+    for name in names:
+        print('== %s' % name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,87 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import threading
+
+from keyexchange.filtering.addresses import AddressCache
+
+
+class TestAddressCache(unittest.TestCase):
+
+    def test_parse(self):
+        cache = AddressCache()
+        self.assertEqual(cache.parse('10.0.0.1'), (0x0a000001, 4))
+        self.assertEqual(cache.parse('::1'), (1, 6))
+        self.assertEqual(cache.parse('bad_guy'), None)
+        self.assertEqual(cache.parse('10.0.0.1'), (0x0a000001, 4))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(cache.hit_ratio(), .25)
+
+    def test_lru(self):
+        cache = AddressCache(size=2)
+        cache.parse('10.0.0.1')
+        cache.parse('10.0.0.2')
+        cache.parse('10.0.0.1')
+        # 10.0.0.2 is the least recently used
+        cache.parse('10.0.0.3')
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('10.0.0.1' in cache)
+        self.assertFalse('10.0.0.2' in cache)
+        self.assertTrue('10.0.0.3' in cache)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.hit_ratio(), 0.)
+
+    def test_threading(self):
+        cache = AddressCache(size=50)
+        ips = ['10.0.0.%d' % i for i in range(100)]
+
+        class Worker(threading.Thread):
+            def run(self):
+                for i in range(10):
+                    for ip in ips:
+                        cache.parse(ip)
+
+        workers = [Worker() for i in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(len(cache), 50)
+        self.assertEqual(cache.hits + cache.misses, 10000)
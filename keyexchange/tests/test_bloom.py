@@ -0,0 +1,86 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from keyexchange.filtering.bloom import BloomFilter, RotatingBloomFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_bloom(self):
+        bloom = BloomFilter.for_capacity(1000, .01)
+        ips = ['10.0.%d.%d' % (i >> 8, i & 255) for i in range(1000)]
+        for ip in ips:
+            bloom.add(ip)
+
+        # no false negatives
+        for ip in ips:
+            self.assertTrue(ip in bloom)
+
+        # and about 1% of false positives
+        others = ['11.0.%d.%d' % (i >> 8, i & 255) for i in range(10000)]
+        false_positives = len([ip for ip in others if ip in bloom])
+        self.assertTrue(false_positives < 300)
+
+    def test_serialization(self):
+        bloom = BloomFilter.for_capacity(100)
+        bloom.add('ip')
+        bloom2 = BloomFilter.fromstring(bloom.tostring())
+        self.assertEqual(bloom2.bits, bloom.bits)
+        self.assertEqual(bloom2.count, 1)
+        self.assertTrue('ip' in bloom2)
+
+        copy = bloom.copy()
+        copy.add('other')
+        self.assertFalse('other' in bloom)
+        self.assertTrue('other' in copy)
+
+    def test_rotation(self):
+        bloom = RotatingBloomFilter(100, period=10)
+        now = bloom._rotation - 10
+        bloom.add('one', now)
+        bloom.add('two', now + 15)
+        self.assertTrue('one' in bloom)
+        self.assertTrue('two' in bloom)
+
+        # items are kept between one and two periods
+        bloom.add('three', now + 25)
+        self.assertFalse('one' in bloom)
+        self.assertTrue('two' in bloom)
+        bloom.add('four', now + 60)
+        self.assertFalse('two' in bloom)
+        self.assertFalse('three' in bloom)
+        self.assertTrue('four' in bloom)
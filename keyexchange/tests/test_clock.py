@@ -0,0 +1,134 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import cPickle
+import unittest
+
+from keyexchange.clock import Clock, VirtualClock, get_clock
+from keyexchange.filtering.middleware import IPFiltering
+
+
+class FakeApp(object):
+    def __call__(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+class TestClock(unittest.TestCase):
+
+    def test_clock(self):
+        clock = Clock(0.01)
+        try:
+            start = clock.time()
+            self.assertTrue(abs(start - time.time()) < 1)
+            time.sleep(.05)
+            self.assertTrue(clock.time() > start)
+            # cached between two ticks
+            self.assertEqual(clock.time(), clock.now)
+        finally:
+            clock.stop()
+
+        clock = Clock(0)
+        first = clock.time()
+        self.assertTrue(clock.time() >= first)
+        # never goes backwards
+        clock._last = first + 100
+        self.assertEqual(clock.time(), first + 100)
+
+        # from a config file
+        clock = Clock('0.01')
+        try:
+            self.assertEqual(clock.resolution, .01)
+            start = clock.time()
+            time.sleep(.05)
+            self.assertTrue(clock.time() > start)
+        finally:
+            clock.stop()
+
+        # the shared clock is safe to use across forks
+        if hasattr(os, 'register_at_fork'):
+            self.assertEqual(get_clock().resolution, .01)
+        else:
+            self.assertEqual(get_clock().resolution, 0)
+
+    def test_fork(self):
+        clock = Clock(0.01)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                # the ticker stayed in the parent
+                start = clock.time()
+                time.sleep(.05)
+                os._exit(int(clock.time() <= start))
+            __, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+        finally:
+            clock.stop()
+
+    def test_ticker_failure(self):
+        clock = Clock(0.01)
+        # breaks the ticker
+        clock.resolution = 'oops'
+        clock._ticker.join()
+        start = clock.time()
+        time.sleep(.02)
+        # the clock is read on every call instead
+        self.assertTrue(clock.time() > start)
+
+    def test_pickling(self):
+        clock = get_clock()
+        self.assertTrue(cPickle.loads(cPickle.dumps(clock)) is clock)
+        clock = cPickle.loads(cPickle.dumps(Clock(0)))
+        self.assertEqual(clock.resolution, 0)
+
+    def test_virtual_clock(self):
+        clock = VirtualClock(100)
+        app = IPFiltering(FakeApp(), use_memory=True, async=False,
+                          update_blfreq=1, treshold=2, blacklist_ttl=10,
+                          clock=clock)
+        environ = {'REMOTE_ADDR': '10.0.0.1'}
+        for i in range(3):
+            app(dict(environ), _start_response)
+        self.assertTrue('10.0.0.1' in app._blacklisted)
+
+        # the ban expires when the clock says so
+        clock.advance(11)
+        self.assertFalse('10.0.0.1' in app._blacklisted)
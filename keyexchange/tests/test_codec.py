@@ -0,0 +1,71 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from keyexchange.filtering.codec import encode, decode, MAGIC
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        entries = [('10.0.0.2', 1300000000.5), ('10.0.0.1', None),
+                   ('2001:db8::1', 1300000000), ('10.0.0.0/8', None),
+                   ('2001:DB8::2', None), ('ip1', 12)]
+        data = encode(entries)
+        self.assertTrue(data.startswith(MAGIC))
+        decoded = decode(data)
+
+        # expiries are rounded up to the second
+        self.assertEqual(dict(decoded),
+                         {'10.0.0.1': None, '10.0.0.2': 1300000001,
+                          '2001:db8::1': 1300000000, '10.0.0.0/8': None,
+                          '2001:DB8::2': None, 'ip1': 12})
+
+        # addresses are sorted
+        self.assertEqual([elmt for elmt, __ in decoded[:3]],
+                         ['10.0.0.1', '10.0.0.2', '2001:db8::1'])
+
+        # 4 bytes per address and per expiry
+        self.assertEqual(len(encode([('10.0.0.1', None)])),
+                         len(encode([])) + 8)
+        self.assertEqual(decode(encode([])), [])
+
+    def test_invalid(self):
+        data = encode([('10.0.0.1', None), ('ip1', None)])
+        self.assertRaises(ValueError, decode, data[:-5])
+        self.assertRaises(ValueError, decode, 'XXXX' + data[4:])
+        # blobs from newer nodes are rejected
+        self.assertRaises(ValueError, decode, data[:4] + '\x02' + data[5:])
@@ -0,0 +1,73 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from keyexchange.clock import VirtualClock
+from keyexchange.filtering.counters import (RequestCounters,
+                                            _compile_statuses)
+
+
+class TestRequestCounters(unittest.TestCase):
+
+    def test_compile_statuses(self):
+        for statuses in (404, '404', '400,4xx', '400 4xx', ['4xx']):
+            self.assertTrue('404' in _compile_statuses(statuses))
+        self.assertFalse('500' in _compile_statuses('4xx'))
+
+    def test_hit(self):
+        counters = RequestCounters(treshold=5, br_treshold=2,
+                                   route_costs=['GET /x 2 3'],
+                                   bad_statuses='4xx',
+                                   prefix_tresholds='24:6',
+                                   clock=VirtualClock(10))
+        self.assertEqual(counters.hit('10.0.0.1', 'GET', '/x'),
+                         (False, None))
+        # over the treshold of the route
+        self.assertEqual(counters.hit('10.0.0.1', 'GET', '/x'),
+                         (True, None))
+        self.assertEqual(counters.hit('10.0.0.2', 'GET', '/x'),
+                         (False, '10.0.0.0/24'))
+        self.assertEqual(counters.networks('10.0.0.2'), ['10.0.0.0/24'])
+        self.assertEqual(counters.networks('garbage'), [])
+
+        self.assertTrue(counters.is_bad('404 Not Found'))
+        self.assertFalse(counters.is_bad(None))
+        self.assertFalse(counters.hit_bad('10.0.0.1'))
+        self.assertTrue(counters.hit_bad('10.0.0.1'))
+
+        counters.remove('10.0.0.1')
+        self.assertEqual(counters.last_ips.count('10.0.0.1'), 0)
+        self.assertEqual(counters.last_br_ips.count('10.0.0.1'), 0)
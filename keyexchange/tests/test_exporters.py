@@ -0,0 +1,142 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from keyexchange.filtering.blacklist import Blacklist
+from keyexchange.filtering.exporters import (NginxExporter, HAProxyExporter,
+                                             IPSetExporter, ExportThread)
+
+
+class TestExporters(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = time.time()
+        self.entries = {'10.0.0.2': None, '10.0.0.0/24': self.now + 30.5,
+                        '2001:db8::/32': None, 'ip1': None,
+                        '10.0.0.9': self.now - 1}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self, name):
+        with open(os.path.join(self.directory, name)) as exported:
+            return exported.read().splitlines()
+
+    def test_nginx(self):
+        path = os.path.join(self.directory, 'nginx')
+        exporter = NginxExporter(path)
+        self.assertTrue(exporter.export(self.entries, self.now))
+        # expired entries and entries that are not IPs are left out
+        self.assertEqual(self._read('nginx'), ['10.0.0.0/24 1;',
+                                               '10.0.0.2 1;',
+                                               '2001:db8::/32 1;'])
+
+        # the file is only rewritten when something changed
+        os.remove(path)
+        self.assertFalse(exporter.export(self.entries, self.now))
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(exporter.export(self.entries, self.now + 31))
+        self.assertEqual(self._read('nginx'), ['10.0.0.2 1;',
+                                               '2001:db8::/32 1;'])
+
+        exporter = NginxExporter(path, deny=True)
+        exporter.export(self.entries, self.now)
+        self.assertEqual(self._read('nginx')[0], 'deny 10.0.0.0/24;')
+
+    def test_haproxy(self):
+        exporter = HAProxyExporter(os.path.join(self.directory, 'map'))
+        exporter.export(self.entries, self.now)
+        self.assertEqual(self._read('map'),
+                         ['10.0.0.0/24 %d' % (self.now + 30.5),
+                          '10.0.0.2 0', '2001:db8::/32 0'])
+
+    def test_ipset(self):
+        exporter = IPSetExporter(os.path.join(self.directory, 'ipset'),
+                                 name='banned')
+        exporter.export(self.entries, self.now)
+        lines = self._read('ipset')
+        self.assertEqual(lines[:3], [
+            'create banned hash:net family inet timeout 0 -exist',
+            'create banned-tmp hash:net family inet timeout 0 -exist',
+            'flush banned-tmp'])
+        # entries get their remaining TTL
+        self.assertTrue('add banned-tmp 10.0.0.0/24 timeout 30' in lines)
+        self.assertTrue('add banned-tmp 10.0.0.2 timeout 0' in lines)
+        self.assertTrue('add banned6-tmp 2001:db8::/32 timeout 0' in lines)
+        self.assertEqual(lines[-4:], ['swap banned-tmp banned',
+                                      'destroy banned-tmp',
+                                      'swap banned6-tmp banned6',
+                                      'destroy banned6-tmp'])
+
+        # then only the changes
+        entries = dict(self.entries)
+        del entries['10.0.0.2']
+        entries['10.0.0.3'] = self.now + 10
+        entries['10.0.0.0/24'] = self.now + 60.5
+        self.assertTrue(exporter.export(entries, self.now))
+        self.assertEqual(self._read('ipset'), [
+            'add banned 10.0.0.0/24 timeout 60 -exist',
+            'add banned 10.0.0.3 timeout 10 -exist',
+            'del banned 10.0.0.2 -exist'])
+
+        # and the whole sets again every full_every exports
+        exporter = IPSetExporter(os.path.join(self.directory, 'ipset'),
+                                 name='banned', full_every=2)
+        exporter.export(self.entries, self.now)
+        exporter.export(entries, self.now)
+        del entries['10.0.0.3']
+        exporter.export(entries, self.now)
+        self.assertEqual(self._read('ipset')[-1], 'destroy banned6-tmp')
+
+    def test_thread(self):
+        path = os.path.join(self.directory, 'nginx')
+        blacklist = Blacklist(async=False)
+        blacklist.add('10.0.0.1', .2)
+        thread = ExportThread(blacklist, [NginxExporter(path)], .05)
+        thread.start()
+        try:
+            time.sleep(.1)
+            self.assertEqual(self._read('nginx'), ['10.0.0.1 1;'])
+            # expired entries are removed from the file
+            time.sleep(.3)
+            self.assertEqual(self._read('nginx'), [])
+        finally:
+            thread.join()
@@ -38,11 +38,18 @@ import time
 import threading
 import random
 import cPickle
+import socket
+import os
+import shutil
+import tempfile
+import json
 
 from keyexchange.filtering.middleware import IPFiltering
 from keyexchange.filtering.blacklist import Blacklist
 from keyexchange.filtering.ipqueue import IPQueue
+from keyexchange.filtering.transports import MemcacheTransport, UDPTransport
 from keyexchange.util import MemoryClient
+from keyexchange.clock import VirtualClock
 
 from webtest import TestApp, AppError
 from webob.exc import HTTPForbidden
@@ -207,6 +214,411 @@ class TestIPFiltering(unittest.TestCase):
         self.assertEqual(len(blacklist), 90)
         self.assertFalse(blacklist._dirty)
 
+    def test_blacklist_networks(self):
+        blacklist = Blacklist(async=False)
+        blacklist.add('10.0.0.1/24', .5)
+        blacklist.add('2001:db8::/32')
+        self.assertTrue('10.0.0.0/24' in blacklist.ips)
+        self.assertTrue('10.0.0.200' in blacklist)
+        self.assertTrue('2001:db8::1' in blacklist)
+        self.assertFalse('10.0.1.1' in blacklist)
+        self.assertFalse('bad_guy' in blacklist)
+
+        blacklist.remove('2001:db8::/32')
+        self.assertFalse('2001:db8::1' in blacklist)
+
+        # networks expire like IPs
+        time.sleep(.6)
+        self.assertFalse('10.0.0.200' in blacklist)
+        self.assertEqual(len(blacklist), 0)
+
+    def test_blacklist_escalation(self):
+        blacklist = Blacklist(async=False, subnet_treshold=3)
+        blacklist.add('10.0.0.1', 10)
+        blacklist.add('10.0.0.2', 10)
+        blacklist.add('10.0.1.1', 10)
+        blacklist.remove('10.0.0.2')
+        blacklist.add('10.0.0.3', 10)
+        self.assertFalse('10.0.0.20' in blacklist)
+
+        # the third IP of 10.0.0.0/24 replaces them all by the network
+        blacklist.add('10.0.0.4', 10)
+        self.assertEqual(blacklist.ips, set(['10.0.0.0/24', '10.0.1.1']))
+        self.assertTrue('10.0.0.20' in blacklist)
+
+        blacklist = Blacklist(async=False, subnet_treshold=2)
+        blacklist.add('2001:db8::1', 10)
+        blacklist.add('2001:db8::2:1', 10)
+        self.assertEqual(blacklist.ips, set(['2001:db8::/64']))
+
+    def test_blacklist_expire(self):
+        cache = MemoryClient(None)
+        clock = VirtualClock(1000)
+        blacklist = Blacklist(cache, async=False, clock=clock)
+        blacklist.add('ip1', .2)
+        blacklist.add('ip2', 10)
+        blacklist.add('ip3')
+        blacklist.add('ip1', .3)  # the first TTL is stale now
+        blacklist.save()
+
+        now = clock.time()
+        self.assertEqual(blacklist.expire(now + .25), 0)
+        self.assertEqual(blacklist.expire(now + .5), 1)
+        self.assertEqual(blacklist.ips, set(['ip2', 'ip3']))
+
+        # expired entries are not merged from memcache
+        clock.advance(.3)
+        other = Blacklist(cache, async=False, clock=clock)
+        other.update()
+        self.assertEqual(other.ips, set(['ip2', 'ip3']))
+
+    def test_blacklist_sync(self):
+        cache = MemoryClient(None)
+        node1 = Blacklist(cache, async=False, compact_every=5)
+        node2 = Blacklist(cache, async=False, compact_every=5)
+
+        node1.add('ip1')
+        node1.add('ip2', 10)
+        node1.save()
+        node2.add('ip3')
+        node2.save()
+        self.assertEqual(node2.ips, set(['ip1', 'ip2', 'ip3']))
+
+        # only the changes are fetched
+        node1.remove('ip2')
+        node1.save()
+        node2.update()
+        self.assertEqual(node2.ips, set(['ip1', 'ip3']))
+        self.assertEqual(node2._transport.version, 3)
+        node1.update()
+        self.assertEqual(node1.ips, set(['ip1', 'ip3']))
+
+        # the 5th version triggers a snapshot
+        node1.add('ip4')
+        node1.save()
+        node1.add('ip5')
+        node1.save()
+        version, entries = node1._transport.log.snapshot()
+        self.assertEqual(version, 4)
+        self.assertEqual(len(entries), 4)
+
+        # a new node, or one that is too far behind, starts from the
+        # snapshot, then gets the changes made after it
+        for i in range(5):
+            node1.add('ip%d' % (i + 6))
+            node1.save()
+        node3 = Blacklist(cache, async=False, compact_every=5)
+        node3.update()
+        self.assertEqual(node3.ips, node1.ips)
+        self.assertEqual(node3._transport.version, 10)
+
+        # missing changes are retried once, then skipped
+        node1.add('ip11')
+        node1.add('ip12')
+        node1.save()
+        node1.add('ip13')
+        node1.save()
+        cache.delete('keyexchange:blacklist:change:11')
+        node3.update()
+        self.assertEqual(node3._transport.version, 10)
+        node3.update()
+        self.assertEqual(node3._transport.version, 12)
+        self.assertTrue('ip13' in node3)
+        self.assertFalse('ip11' in node3)
+
+    def test_blacklist_catch_up(self):
+        # far behind, with no snapshot and the changes gone
+        cache = MemoryClient(None)
+        cache.set('keyexchange:blacklist:version', '5000')
+        fetched = []
+        get_multi = cache.get_multi
+
+        def _get_multi(keys):
+            fetched.append(len(keys))
+            return get_multi(keys)
+
+        cache.get_multi = _get_multi
+        node = Blacklist(cache, async=False)
+        for i in range(5):
+            node.update()
+        self.assertTrue(max(fetched) <= 1000)
+        self.assertEqual(node._transport.version, 4900)
+        # the recent versions are retried once, then skipped
+        node.update()
+        node.update()
+        self.assertEqual(node._transport.version, 5000)
+
+    def test_blacklist_escalation_ttl(self):
+        cache = MemoryClient(None)
+        clock = VirtualClock(1000)
+        node1 = Blacklist(cache, async=False, escalation_factor=2,
+                          max_ttl=1000, clock=clock)
+        node2 = Blacklist(cache, async=False, escalation_factor=2,
+                          clock=clock)
+
+        def ttl(node, ip):
+            return node._ttls[ip] - clock.time()
+
+        node1.add('ip1', 100)
+        self.assertEqual(ttl(node1, 'ip1'), 100)
+        node1.save()
+        node2.update()
+        clock.advance(101)
+        node1.add('ip1', 100)
+        self.assertTrue(190 < ttl(node1, 'ip1') <= 200)
+        node1.save()
+
+        # the other nodes know about the previous bans
+        node2.update()
+        clock.advance(201)
+        node2.add('ip1', 100)
+        self.assertTrue(390 < ttl(node2, 'ip1') <= 400)
+        node2.save()
+        node1.update()
+        clock.advance(401)
+        node1.add('ip1', 100)
+        self.assertTrue(ttl(node1, 'ip1') <= 1000)
+
+        # unbanning by hand resets the history
+        node1.remove('ip1')
+        node1.add('ip1', 100)
+        self.assertEqual(ttl(node1, 'ip1'), 100)
+
+    def test_blacklist_escalation_active(self):
+        # several requests crossing the treshold before the ban is
+        # published are one offence
+        cache = MemoryClient(None)
+        clock = VirtualClock(1000)
+        node1 = Blacklist(cache, async=False, escalation_factor=2,
+                          clock=clock)
+        node2 = Blacklist(cache, async=False, escalation_factor=2,
+                          clock=clock)
+        for i in range(5):
+            node1.add('1.2.3.4', 300)
+            # not escalated, only refreshed
+            self.assertEqual(node1._ttls['1.2.3.4'], 1300 + i)
+            clock.advance(1)
+        # a longer TTL extends the ban
+        node1.add('1.2.3.4', 600)
+        self.assertEqual(node1._ttls['1.2.3.4'], 1605)
+        node1.save()
+        node2.update()
+        # one offence on both nodes
+        for node in (node1, node2):
+            score = node._history.score('1.2.3.4', clock.time())
+            self.assertTrue(.99 < score <= 1)
+
+        # the next ban, once this one expired, is escalated once
+        clock.advance(600)
+        node1.add('1.2.3.4', 300)
+        self.assertTrue(590 < node1._ttls['1.2.3.4'] - clock.time() <= 600)
+
+    def test_blacklist_lock_free_reads(self):
+        blacklist = Blacklist(async=False)
+        blacklist.add('ip1')
+        blacklist.add('10.0.0.0/8')
+        found = []
+
+        def read():
+            found.append('ip1' in blacklist)
+            found.append('10.1.2.3' in blacklist)
+
+        # a writer or the syncer holding the lock doesn't block readers
+        blacklist._lock.acquire()
+        try:
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(1.)
+        finally:
+            blacklist._lock.release()
+        self.assertEqual(found, [True, True])
+
+        blacklist.remove('ip1')
+        self.assertFalse('ip1' in blacklist)
+
+    def test_blacklist_load(self):
+        cache = MemoryClient(None)
+        node1 = Blacklist(cache, async=False, compact_every=1)
+        node1.load({'10.0.0.1': 600, '10.1.0.0/16': None})
+        node1.add('10.0.0.2')
+        node1.save()
+        node1.add('10.0.0.3')
+        node1.save()
+
+        # feeds are loaded by each node, they're not shared
+        node2 = Blacklist(cache, async=False)
+        node2.update()
+        self.assertEqual(node2.ips, set(['10.0.0.2', '10.0.0.3']))
+        self.assertEqual(sorted(node1._transport.log.snapshot()[1]),
+                         [('10.0.0.2', None), ('10.0.0.3', None)])
+
+        # unless asked to
+        node1.load({'10.0.0.4': None}, discard=['10.0.0.1'], record=True)
+        node1.save()
+        node2.update()
+        self.assertTrue('10.0.0.4' in node2)
+        self.assertFalse('10.1.2.3' in node2)
+
+    def test_blacklist_bloom(self):
+        cache = MemoryClient(None)
+        blacklist = Blacklist(cache, async=False, bloom_error_rate=.01,
+                              compact_every=1)
+        blacklist.load(dict([('ip%d' % i, None) for i in range(100)]))
+        blacklist.add('10.0.0.0/8')
+        blacklist.add('more')
+        blacklist.remove('ip1')
+        self.assertTrue('ip2' in blacklist)
+        self.assertTrue('more' in blacklist)
+        self.assertTrue('10.1.2.3' in blacklist)
+        self.assertFalse('ip1' in blacklist)
+        self.assertFalse('other' in blacklist)
+
+        # the filter is local to the node
+        blacklist.save()
+        self.assertEqual(cache.get('keyexchange:blacklist:bloom'), None)
+
+    def test_blacklist_udp(self):
+        ports = []
+        for i in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            ports.append(sock.getsockname()[1])
+            sock.close()
+        addresses = ['127.0.0.1:%d' % port for port in ports]
+
+        cache = MemoryClient(None)
+        nodes = []
+        for address, peer in zip(addresses, reversed(addresses)):
+            transport = UDPTransport(address, [peer], secret='secret',
+                                     fallback=MemcacheTransport(cache, 60))
+            nodes.append(Blacklist(transport=transport, sync_delay=0))
+        node1, node2 = nodes
+        try:
+            # the change is pushed without waiting for the next poll
+            node1.add('ip1')
+            node1.add('10.0.0.0/8')
+            for i in range(50):
+                if '10.1.2.3' in node2:
+                    break
+                time.sleep(.02)
+            self.assertEqual(node2.ips, set(['ip1', '10.0.0.0/8']))
+
+            # unsigned datagrams are dropped
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.sendto('["other", %f, [["+", "ip2", null]]]' % time.time(),
+                        ('127.0.0.1', ports[1]))
+            sock.close()
+            time.sleep(.1)
+            self.assertFalse('ip2' in node2)
+
+            # so are replayed and old ones
+            now = time.time()
+            other = UDPTransport(addresses[0], [], secret='secret')
+            data = other._encode([('+', 'ip3', None)], now)
+            transport = node2._transport
+            self.assertEqual(transport._decode(data, now),
+                             [('+', 'ip3', None)])
+            self.assertEqual(transport._decode(data, now + 1), None)
+            data = other._encode([('+', 'ip3', None)], now - 31)
+            self.assertEqual(transport._decode(data, now), None)
+            data = UDPTransport(addresses[0], [], secret='other')._encode(
+                [('+', 'ip3', None)], now)
+            self.assertEqual(transport._decode(data, now), None)
+
+            # the middleware doesn't run the transport unsigned
+            self.assertRaises(ValueError, IPFiltering, None, use_memory=True,
+                              sync_transport='udp',
+                              sync_address=addresses[0],
+                              sync_peers=[addresses[1]])
+
+            # and memcache still has every change
+            node3 = Blacklist(cache, async=False)
+            node3.update()
+            self.assertEqual(node3.ips, node2.ips)
+        finally:
+            for node in nodes:
+                node.close()
+
+    def test_blacklist_close(self):
+        # pending changes are pushed when the syncer stops
+        cache = MemoryClient(None)
+        blacklist = Blacklist(cache, frequency=60, sync_delay=60)
+        blacklist.add('ip1')
+        blacklist.close()
+        self.assertFalse(blacklist.outsynced)
+        other = Blacklist(cache, async=False)
+        other.update()
+        self.assertTrue('ip1' in other)
+
+    def test_close(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        try:
+            app = IPFiltering(FakeApp(), use_memory=True,
+                              refresh_frequency=60, sync_delay=60,
+                              snapshot_path=path, snapshot_frequency=600,
+                              shadow_policies=['strict treshold=2'])
+            app._blacklisted.add('10.0.0.1')
+            self.assertTrue(app._blacklisted.outsynced)
+            self.assertFalse(os.path.exists(path))
+            app.close()
+            app.close()
+
+            # the pending change was pushed, and the snapshot written
+            other = Blacklist(app._cache_server, async=False)
+            other.update()
+            self.assertTrue('10.0.0.1' in other)
+            restored = Blacklist(async=False, snapshot_path=path)
+            self.assertTrue('10.0.0.1' in restored)
+            self.assertFalse(app._shadows.isAlive())
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_blacklist_snapshot(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            blacklist = Blacklist(async=False, snapshot_path=path,
+                                  snapshot_frequency=10)
+            blacklist.add('10.0.0.1')
+            blacklist.add('10.0.0.0/24', 600)
+            blacklist.add('ip1', .1)
+            now = time.time()
+            self.assertFalse(blacklist.checkpoint(now))
+            self.assertTrue(blacklist.checkpoint(now + 10))
+            self.assertFalse(blacklist.checkpoint(now + 11))
+
+            # a restarted node gets its bans back, minus the expired ones
+            time.sleep(1.1)
+            restarted = Blacklist(async=False, snapshot_path=path)
+            self.assertEqual(restarted.ips, set(['10.0.0.1', '10.0.0.0/24']))
+            self.assertTrue('10.0.0.20' in restarted)
+        finally:
+            os.remove(path)
+
+    def test_counters_snapshot(self):
+        directory = tempfile.mkdtemp()
+        options = dict(treshold=5, use_memory=True, async=False,
+                       update_blfreq=100,
+                       snapshot_path=os.path.join(directory, 'blacklist'),
+                       counters_path=os.path.join(directory, 'counters'))
+        try:
+            app = IPFiltering(FakeApp(), **options)
+            app._last_ips.append('ip1')
+            app._last_ips.append('ip1')
+            app._last_br_ips.append('ip2')
+            # writes the last checkpoint
+            app.close()
+
+            app = IPFiltering(FakeApp(), **options)
+            self.assertEqual(app._last_ips.count('ip1'), 2)
+            self.assertEqual(app._last_br_ips.count('ip2'), 1)
+            app.close()
+        finally:
+            shutil.rmtree(directory)
+
     def test_admin_page(self):
         # activate the admin page
         self.app.app.admin_page = '/__admin__'
@@ -244,6 +656,91 @@ class TestIPFiltering(unittest.TestCase):
         self.assertTrue('myip' not in self.app.app._last_ips)
         self.assertTrue('myip' not in self.app.app._last_br_ips)
 
+    def test_admin_api(self):
+        self.app.app.admin_page = '/__admin__'
+        res = self.app.post('/__admin__/blacklist', json.dumps(
+            {'add': ['10.0.0.1', '10.0.1.0/24', '10.0.0.2']}))
+        self.assertEqual(sorted(res.json['added']),
+                         ['10.0.0.1', '10.0.0.2', '10.0.1.0/24'])
+
+        res = self.app.get('/__admin__/blacklist?limit=2')
+        self.assertEqual([entry for entry, expiry in res.json['entries']],
+                         ['10.0.0.1', '10.0.0.2'])
+        res = self.app.get('/__admin__/blacklist?limit=2&after=%s' %
+                           res.json['next'])
+        self.assertEqual(res.json['entries'][0][0], '10.0.1.0/24')
+        self.assertEqual(res.json['next'], None)
+        res = self.app.get('/__admin__/blacklist?prefix=10.0.1')
+        self.assertEqual(len(res.json['entries']), 1)
+
+        res = self.app.post('/__admin__/blacklist', json.dumps(
+            {'remove': ['10.0.0.1', '10.0.1.0/24', '10.9.9.9']}))
+        self.assertEqual(sorted(res.json['removed']),
+                         ['10.0.0.1', '10.0.1.0/24'])
+        res = self.app.get('/__admin__/stats')
+        self.assertEqual(res.json['blacklist'], {'ips': 1, 'networks': 0})
+
+        self.app.post('/__admin__/blacklist', json.dumps({'add': ['nope']}),
+                      status=400)
+        self.app.post('/__admin__/blacklist', json.dumps(
+            {'remove': ['10.0.0.2'], 'add': {'10.0.0.3': 10,
+                                             '10.0.0.4': 'abc'}}),
+            status=400)
+        self.assertTrue('10.0.0.2' in self.app.app._blacklisted)
+        self.assertFalse('10.0.0.3' in self.app.app._blacklisted)
+        for limit in (0, -1):
+            res = self.app.get('/__admin__/blacklist?limit=%d' % limit)
+            self.assertEqual(len(res.json['entries']), 1)
+        self.app.get('/__admin__/unknown', status=404)
+
+    def test_blacklist_edit(self):
+        blacklist = Blacklist(MemoryClient(None), async=False)
+        added, removed = blacklist.edit({'192.0.2.1': None, '192.0.2.2': 10,
+                                         '10.0.0.1/24': None})
+        self.assertEqual(len(added), 3)
+        self.assertTrue('10.0.0.7' in blacklist)
+        added, removed = blacklist.edit({'192.0.2.3': None},
+                                        ['192.0.2.1', '192.0.2.4'])
+        self.assertEqual(removed, ['192.0.2.1'])
+        # one change pushed per edit
+        self.assertEqual(blacklist._transport.log.latest(), 2)
+
+        # nothing is changed if an entry is invalid
+        for add in ({'192.0.2.5': 10, '192.0.2.6': 'abc'},
+                    {'192.0.2.5': 10, 'bad_guy': 10}):
+            self.assertRaises(ValueError, blacklist.edit, add,
+                              ['192.0.2.2'])
+            self.assertTrue('192.0.2.2' in blacklist)
+            self.assertFalse('192.0.2.5' in blacklist.ips)
+        self.assertEqual(blacklist._changes, [])
+
+        entries, cursor = blacklist.page(limit=2)
+        self.assertEqual([entry for entry, expiry in entries],
+                         ['10.0.0.0/24', '192.0.2.2'])
+        entries, cursor = blacklist.page(after=cursor)
+        self.assertEqual(entries, [('192.0.2.3', None)])
+        self.assertEqual(cursor, None)
+        self.assertEqual(blacklist.page(prefix='192.0.2.2')[0][0][0],
+                         '192.0.2.2')
+        self.assertEqual(len(blacklist.page(limit=0)[0]), 1)
+
+    def test_ip_denylist(self):
+        app = IPFiltering(FakeApp(), use_memory=True,
+                          ip_denylist=['198.51.100.0/24', '2001:db8::/32'])
+        web_app = TestApp(app)
+
+        for ip in ('198.51.100.7', '2001:db8::1'):
+            env = {'REMOTE_ADDR': ip}
+            web_app.get('/', status=403, extra_environ=env)
+
+        env = {'REMOTE_ADDR': '198.51.101.1'}
+        web_app.get('/', status=200, extra_environ=env)
+
+        # observe mode does not reject
+        app.observe = True
+        env = {'REMOTE_ADDR': '198.51.100.7'}
+        web_app.get('/', status=200, extra_environ=env)
+
     def test_ip_whitelist(self):
         env = {'REMOTE_ADDR': '127.0.0.1'}
 
@@ -310,6 +807,114 @@ class TestIPFiltering(unittest.TestCase):
         bl2 = cPickle.loads(pickled)
         self.assertTrue('ip' in bl2)
 
+    def test_rejection(self):
+        app = self.app.app
+        app._blacklisted.add('bad_guy')
+        responses = []
+
+        def start_response(status, headers, exc_info=None):
+            responses.append((status, headers))
+
+        env = {'REMOTE_ADDR': '127.0.0.1',
+               'HTTP_X_FORWARDED_FOR': ' bad_guy , 127.0.0.1'}
+        body = app(env, start_response)
+        status, headers = responses[0]
+        self.assertEqual(status, '403 Forbidden')
+        self.assertEqual(dict(headers)['Content-Length'],
+                         str(len(''.join(body))))
+
+        # the constant headers can't be altered by the server
+        headers.append(('Date', 'now'))
+        app(env, start_response)
+        self.assertEqual(len(responses[1][1]), 2)
+
+    def test_trusted_proxies(self):
+        app = IPFiltering(FakeApp(), use_memory=True, async=False,
+                          update_blfreq=10,
+                          trusted_proxies=['10.0.0.0/8', '2001:db8::/32'])
+
+        def get_ip(forwarded, remote='10.0.0.1'):
+            return app._get_ip({'REMOTE_ADDR': remote,
+                                'HTTP_X_FORWARDED_FOR': forwarded})
+
+        # the client can't pick its address by adding hops on the left
+        self.assertEqual(get_ip('1.2.3.4, 5.6.7.8, 10.1.1.1'), '5.6.7.8')
+        self.assertEqual(get_ip('5.6.7.8,2001:db8::1'), '5.6.7.8')
+        self.assertEqual(get_ip(' 5.6.7.8 '), '5.6.7.8')
+        # only proxies
+        self.assertEqual(get_ip('10.2.2.2, 10.1.1.1'), '10.2.2.2')
+        # the header is ignored when it doesn't come from a proxy
+        self.assertEqual(get_ip('5.6.7.8', '9.9.9.9'), '9.9.9.9')
+        self.assertEqual(get_ip('1.2.3.4, garbage'), None)
+
+    def test_route_costs(self):
+        app = IPFiltering(FakeApp(), treshold=20, use_memory=True,
+                          async=False, update_blfreq=100,
+                          route_costs=['GET /new_channel 5 12', '* /* 1'])
+        app = TestApp(app)
+        env = {'REMOTE_ADDR': 'ip1'}
+        app.get('/new_channel', extra_environ=env)
+        app.get('/new_channel', extra_environ=env)
+        self.assertEqual(app.app._last_ips.count('ip1'), 10)
+        # the route has its own treshold
+        app.get('/new_channel', extra_environ=env)
+        app.get('/', status=403, extra_environ=env)
+
+        env = {'REMOTE_ADDR': 'ip2'}
+        for i in range(19):
+            app.get('/abcd', extra_environ=env)
+        app.get('/new_channel', extra_environ=env)
+        app.get('/', status=403, extra_environ=env)
+
+    def test_bad_statuses(self):
+        class NotFound(object):
+            def __call__(self, environ, start_response):
+                start_response('404 Not Found', [])
+                return ['']
+
+        app = IPFiltering(NotFound(), br_treshold=3, use_memory=True,
+                          async=False, update_blfreq=100,
+                          bad_statuses=['400', '4xx'])
+        self.assertTrue('404' in app.bad_statuses)
+        self.assertFalse('500' in app.bad_statuses)
+
+        # as the config gives them
+        for statuses in (404, '404 5xx'):
+            self.assertTrue('404' in IPFiltering(
+                None, use_memory=True, bad_statuses=statuses).bad_statuses)
+
+        app = TestApp(app)
+        env = {'REMOTE_ADDR': 'prober'}
+        for i in range(3):
+            app.get('/abcd', extra_environ=env, status=404)
+        app.get('/abcd', extra_environ=env, status=403)
+
+    def test_prefix_tresholds(self):
+        app = IPFiltering(FakeApp(), treshold=100, use_memory=True,
+                          async=False, update_blfreq=100,
+                          ip_whitelist=['10.0.0.1'],
+                          prefix_tresholds='24:10 16:1000')
+        app = TestApp(app)
+        for i in range(10):
+            env = {'REMOTE_ADDR': '10.0.0.%d' % (i + 2)}
+            app.get('/', extra_environ=env)
+        app.get('/', status=403, extra_environ={'REMOTE_ADDR': '10.0.0.99'})
+        app.get('/', extra_environ={'REMOTE_ADDR': '10.0.1.1'})
+        # whitelisted IPs of the network are not blocked
+        app.get('/', extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+
+    def test_shadow_policies(self):
+        app = IPFiltering(FakeApp(), treshold=100, use_memory=True,
+                          async=False, update_blfreq=100,
+                          shadow_policies=['strict treshold=2'])
+        web_app = TestApp(app)
+        for i in range(3):
+            web_app.get('/', extra_environ={'REMOTE_ADDR': 'ip1'})
+        app._shadows.join(1.)
+        stats = app.shadow_stats()
+        self.assertEqual(stats['dropped'], 0)
+        self.assertEqual(stats['policies']['strict']['shadow_only'], 1)
+
     def test_observe_blacklist(self):
         self.app.app.observe = True
         env = {'REMOTE_ADDR': 'ok'}
@@ -0,0 +1,123 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import os
+import tempfile
+
+from keyexchange.filtering.importer import (read_feed, parse_address,
+                                            canonical_address)
+from keyexchange.filtering.middleware import IPFiltering
+
+
+_FEED = """\
+# a comment
+192.0.2.1
+198.51.100.0/24   # a network
+203.0.113.9  600
+198.51.102.0/24 300
+
+2001:db8::/32
+bogus
+10.0.0.0/33
+"""
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.feed = tempfile.mkstemp()
+        os.write(fd, _FEED)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.feed)
+
+    def _write(self, content):
+        f = open(self.feed, 'w')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('10.0.0.1'), (0x0a000001, 4))
+        self.assertEqual(parse_address('::1'), (1, 6))
+        self.assertRaises(ValueError, parse_address, 'bad_guy')
+
+    def test_read_feed(self):
+        ttls, ranges = read_feed(self.feed)
+        self.assertEqual(ttls, {'203.0.113.9': 600, '198.51.102.0/24': 300})
+        self.assertEqual(ranges[4], [(0xc0000201, 0xc0000201),
+                                     (0xc6336400, 0xc63364ff)])
+        self.assertEqual(len(ranges[6]), 1)
+
+        # with a default TTL, single IPs are temporary bans
+        ttls, ranges = read_feed(self.feed, default_ttl=60)
+        self.assertEqual(ttls, {'203.0.113.9': 600, '192.0.2.1': 60,
+                                '198.51.102.0/24': 300})
+        self.assertEqual(len(ranges[4]), 1)
+
+        self._write('')
+        self.assertEqual(read_feed(self.feed), ({}, {4: [], 6: []}))
+
+    def test_canonical_address(self):
+        self.assertEqual(canonical_address('2001:0DB8:0:0:0:0:0:1'),
+                         '2001:db8::1')
+        self.assertEqual(canonical_address('10.0.0.1'), '10.0.0.1')
+        self.assertRaises(ValueError, canonical_address, 'bad_guy')
+
+        # blacklisted IPs are matched with the notation clients use
+        self._write('2001:0DB8:0:0:0:0:0:1 600\n')
+        app = IPFiltering(None, use_memory=True, ip_feeds=[self.feed])
+        self.assertTrue('2001:db8::1' in app._blacklisted)
+
+    def test_load_feed(self):
+        app = IPFiltering(None, use_memory=True, ip_feeds=[self.feed],
+                          ip_denylist=['192.0.2.128/25'])
+        self.assertTrue('203.0.113.9' in app._blacklisted)
+        self.assertTrue(app._is_denied('198.51.100.20'))
+        self.assertTrue(app._is_denied('192.0.2.200'))
+        self.assertTrue('198.51.102.20' in app._blacklisted)
+
+        # reloading swaps the feed entries
+        self._write('203.0.113.10 600\n198.51.101.0/24\n')
+        app.load_feed(self.feed)
+        self.assertFalse('203.0.113.9' in app._blacklisted)
+        self.assertFalse('198.51.102.20' in app._blacklisted)
+        self.assertTrue('203.0.113.10' in app._blacklisted)
+        self.assertFalse(app._is_denied('198.51.100.20'))
+        self.assertTrue(app._is_denied('198.51.101.20'))
+        self.assertTrue(app._is_denied('192.0.2.200'))
@@ -37,7 +37,8 @@ import unittest
 import time
 import threading
 
-from keyexchange.filtering.ipqueue import IPQueue
+from keyexchange.clock import VirtualClock
+from keyexchange.filtering.ipqueue import IPQueue, StripedIPQueue
 
 
 class Worker(threading.Thread):
@@ -101,3 +102,68 @@ class TestIPQueue(unittest.TestCase):
 
         # if the queue is not thread-safe we would get less than 1000 here
         self.assertEqual(queue.count('1'), 1000)
+
+    def test_striped(self):
+        queue = StripedIPQueue(maxlen=64, ttl=.5, stripes=4, min_size=8)
+        self.assertEqual(len(queue._stripes), 4)
+        self.assertEqual(queue.append('ip1'), 1)
+        self.assertEqual(queue.append('ip1', 2), 3)
+        queue.append('ip2')
+        self.assertEqual(queue.count('ip1'), 3)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual([ip for ip, count, updated in queue.items()],
+                         ['ip2', 'ip1'])
+
+        other = StripedIPQueue(maxlen=64, stripes=2, min_size=8)
+        other.load(queue.items())
+        self.assertEqual(other.count('ip1'), 3)
+
+        queue.remove('ip1')
+        self.assertFalse('ip1' in queue)
+        self.assertRaises(ValueError, queue.remove, 'ip1')
+        time.sleep(.6)
+        self.assertEqual(len(queue), 0)
+
+        # small queues are not split
+        self.assertEqual(len(StripedIPQueue(20)._stripes), 1)
+
+    def test_striped_threading(self):
+        queue = StripedIPQueue(maxlen=1000)
+        workers = [Worker(queue, ['1', '2', '3']) for i in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(queue.count('1'), 1000)
+
+    def test_buckets(self):
+        clock = VirtualClock(1000)
+        queue = IPQueue(maxlen=3, ttl=60, clock=clock, buckets=6)
+        for ip in ('ip1', 'ip2', 'ip1'):
+            queue.append(ip)
+        clock.advance(15)
+        queue.append('ip3')
+        self.assertEqual(len(queue._buckets), 2)
+
+        # the least recent IP is discarded, even within a bucket
+        queue.append('ip4')
+        self.assertEqual([ip for ip, count, updated in queue.items()],
+                         ['ip4', 'ip3', 'ip1'])
+
+        # the first bucket is dropped as a whole, once all of it is
+        # older than the TTL
+        clock.advance(50)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.count('ip1'), 0)
+        clock.advance(5)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(len(queue._buckets), 1)
+        clock.advance(20)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue._entries, 0)
+
+        # stale entries don't pile up
+        for i in range(1000):
+            queue.append('ip1')
+        self.assertTrue(queue._entries <= 2 * 3 + 16)
+        self.assertEqual(queue.count('ip1'), 1000)
@@ -0,0 +1,84 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import cPickle
+
+from keyexchange.filtering import ipset
+from keyexchange.filtering.ipset import IPSet, collapse
+
+
+class TestIPSet(unittest.TestCase):
+
+    def test_collapse(self):
+        ranges = [(10, 20), (21, 30), (5, 12), (40, 50), (45, 46)]
+        self.assertEqual(collapse(ranges), [(5, 30), (40, 50)])
+
+    def test_membership(self):
+        networks = ['10.0.0.0/24', '10.0.1.0/24', '10.0.0.5',
+                    '192.168.1.1/16', '2001:db8::/32', '::1']
+        ips = IPSet(networks)
+
+        # the two /24 are merged and the single IP is swallowed
+        self.assertEqual(len(ips), 4)
+        self.assertTrue('10.0.1.255' in ips)
+        self.assertTrue('192.168.200.1' in ips)
+        self.assertTrue('2001:db8::5' in ips)
+        self.assertFalse('10.0.2.0' in ips)
+        self.assertFalse('::2' in ips)
+        self.assertFalse('bad_guy' in ips)
+
+    def test_contains_many(self):
+        ips = IPSet(['10.0.0.0/8', '2001:db8::/32'])
+        batch = ['10.1.2.3', '11.0.0.0', '2001:db8::1', 'bad_guy', '::1']
+        expected = [True, False, True, False, False]
+        self.assertEqual(ips.contains_many(batch), expected)
+
+        # same result without numpy
+        old = ipset.get_numpy
+        ipset.get_numpy = lambda: None
+        try:
+            self.assertEqual(ips.contains_many(batch), expected)
+        finally:
+            ipset.get_numpy = old
+
+        self.assertEqual(IPSet().contains_many(['1.2.3.4']), [False])
+
+    def test_pickling(self):
+        ips = IPSet(['10.0.0.0/8'])
+        ips2 = cPickle.loads(cPickle.dumps(ips))
+        self.assertTrue('10.1.2.3' in ips2)
+        ips2.update(['11.0.0.0/8'])
+        self.assertEqual(ips2.ranges(4), [(0x0a000000, 0x0bffffff)])
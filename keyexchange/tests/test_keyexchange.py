@@ -50,6 +50,7 @@ from paste.deploy import loadapp
 from keyexchange import wsgiapp
 from keyexchange.tests.client import JPAKE
 from keyexchange.util import MemoryClient
+from keyexchange.filtering.bloom import RotatingBloomFilter
 
 
 HERE = os.path.dirname(__file__)
@@ -380,6 +381,35 @@ class TestWsgiApp(unittest.TestCase):
 
         self.app.delete('/new_channel', status=405, extra_environ=self.env)
 
+    def test_channel_filter(self):
+        if self.distant:
+            return
+        self.real_app.channels = RotatingBloomFilter(100, period=300)
+        try:
+            headers = {'X-KeyExchange-Id': 'b' * 256}
+            res = self.app.get('/new_channel', headers=headers,
+                               extra_environ=self.env)
+            cid = str(json.loads(res.body))
+            self.app.get('/%s' % cid, headers=headers,
+                         extra_environ=self.env, status=200)
+
+            # unknown channels are not looked up in memcache
+            gets = []
+            cache_get = self.real_app.cache.get
+
+            def get(key):
+                gets.append(key)
+                return cache_get(key)
+
+            self.real_app.cache.get = get
+            self.app.get('/xxxx', headers=headers, extra_environ=self.env,
+                         status=404)
+            self.assertEqual(gets, [])
+        finally:
+            self.real_app.channels = None
+            if 'get' in self.real_app.cache.__dict__:
+                del self.real_app.cache.get
+
     def test_cef_logger(self):
         # creating a channel
         headers = {'X-KeyExchange-Id': 'b' * 256}
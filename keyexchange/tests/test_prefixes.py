@@ -0,0 +1,83 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from keyexchange.filtering.prefixes import PrefixCounters
+
+
+class TestPrefixCounters(unittest.TestCase):
+
+    def test_levels(self):
+        counters = PrefixCounters({4: [(16, 10), (24, 5)], 6: [(64, 3)]},
+                                  window=10)
+        now = counters._start
+        for i in range(4):
+            self.assertEqual(counters.hit((0x0a000100 + i, 4), now=now), None)
+        self.assertEqual(counters.hit((0x0a000105, 4), now=now),
+                         '10.0.1.0/24')
+        # the /16 counts requests from all its /24s
+        for i in range(4):
+            counters.hit((0x0a000200 + i, 4), now=now)
+        self.assertEqual(counters.hit((0x0a000300, 4), now=now),
+                         '10.0.0.0/16')
+
+        ip6 = 0x20010db8 << 96
+        counters.hit((ip6 + 1, 6), now=now)
+        counters.hit((ip6 + 2, 6), now=now)
+        self.assertEqual(counters.hit((ip6 + 3, 6), now=now),
+                         '2001:db8::/64')
+
+    def test_window(self):
+        counters = PrefixCounters({4: [(24, 10)]}, window=10)
+        now = counters._start
+        for i in range(8):
+            counters.hit((0x0a000001, 4), now=now)
+        # half of the previous window is still counted
+        for i in range(5):
+            self.assertEqual(counters.hit((0x0a000001, 4), now=now + 15),
+                             None)
+        self.assertEqual(counters.hit((0x0a000001, 4), now=now + 15),
+                         '10.0.0.0/24')
+        # and nothing after two windows
+        self.assertEqual(counters.hit((0x0a000001, 4), now=now + 30), None)
+
+    def test_size(self):
+        counters = PrefixCounters({4: [(32, 2)]}, size=2)
+        now = counters._start
+        for i in range(3):
+            counters.hit((i, 4), now=now)
+        self.assertEqual(counters.hit((2, 4), now=now), None)
+        self.assertEqual(counters.hit((1, 4), now=now), '0.0.0.1')
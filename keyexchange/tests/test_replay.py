@@ -0,0 +1,108 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import tempfile
+import unittest
+
+from keyexchange.filtering.ipqueue import IPQueue
+from keyexchange.filtering.replay import (VirtualClock, parse_timestamp,
+                                          read_log, replay, combinations)
+
+_LINE = ('%s - - [10/Oct/2000:13:55:%02d -0700] "GET /new_channel '
+         'HTTP/1.1" %s 12 "-" "Firefox"\n')
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('10/Oct/2000:13:55:36 -0700'),
+                         971211336)
+        self.assertEqual(parse_timestamp('10/Oct/2000:20:55:36 +0000'),
+                         971211336)
+
+    def test_read_log(self):
+        lines = [_LINE % ('1.2.3.4', 36, '200'), 'garbage\n',
+                 _LINE % ('1.2.3.5', 37, '400')]
+        self.assertEqual(list(read_log(lines)),
+                         [('1.2.3.4', 971211336, '200', 'GET',
+                           '/new_channel'),
+                          ('1.2.3.5', 971211337, '400', 'GET',
+                           '/new_channel')])
+
+    def test_virtual_clock(self):
+        clock = VirtualClock(10)
+        queue = IPQueue(ttl=5, clock=clock)
+        queue.append('ip')
+        self.assertEqual(queue.count('ip'), 1)
+        clock.now = 16
+        self.assertEqual(queue.count('ip'), 0)
+
+    def test_replay(self):
+        log = open(self.path, 'w')
+        try:
+            for second in range(5):
+                log.write(_LINE % ('1.2.3.4', second, '200'))
+                log.write(_LINE % ('1.2.3.5', second, '400'))
+            log.write(_LINE % ('1.2.3.6', 6, '200'))
+        finally:
+            log.close()
+
+        result = replay(self.path, {'treshold': 2, 'br_treshold': 2})
+        self.assertEqual(result['requests'], 11)
+        self.assertEqual(result['bans'], 2)
+        self.assertEqual(result['banned'], 2)
+        self.assertEqual(result['blocked'], 6)
+        # 1.2.3.4 never made a bad request
+        self.assertEqual(result['suspicious'], 1)
+        self.assertTrue(result['max_rss'] > 0)
+
+        # status classes and route costs
+        result = replay(self.path, {'treshold': 100, 'br_treshold': 2},
+                        '4xx', ['GET /new_channel 1 3'])
+        self.assertEqual(result['bans'], 2)
+        self.assertEqual(result['suspicious'], 1)
+
+    def test_combinations(self):
+        self.assertEqual(combinations({'a': [1, 2], 'b': [3]}),
+                         [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}])
+        self.assertEqual(combinations({}), [{}])
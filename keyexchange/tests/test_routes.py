@@ -0,0 +1,67 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from keyexchange.filtering.routes import Router, Route, parse_route
+
+
+class TestRouter(unittest.TestCase):
+
+    def test_match(self):
+        router = Router(['GET /new_channel 10 50',
+                         Route('get', '/report', 3),
+                         '* /* 1'])
+        new_channel, report, channel = router.routes
+        self.assertEqual(new_channel.treshold, 50)
+        self.assertEqual(report.method, 'GET')
+
+        self.assertTrue(router.match('GET', '/new_channel') is new_channel)
+        self.assertTrue(router.match('GET', '/abcd') is channel)
+        # the first route that matches wins
+        self.assertTrue(router.match('PUT', '/new_channel') is channel)
+        self.assertTrue(router.match('DELETE', '/report') is channel)
+        # * doesn't match across segments
+        self.assertEqual(router.match('GET', '/a/b'), None)
+        self.assertEqual(router.match('GET', '/new_channel/x'), None)
+
+        self.assertEqual(Router(['GET /x 1']).match('PUT', '/x'), None)
+
+    def test_parse(self):
+        self.assertRaises(ValueError, parse_route, 'GET /')
+        self.assertRaises(ValueError, parse_route, 'GET / x')
+        route = parse_route('post /report  2')
+        self.assertEqual((route.method, route.cost, route.treshold),
+                         ('POST', 2, None))
@@ -0,0 +1,94 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import unittest
+
+from keyexchange.filtering.shadow import (CounterPolicy, ShadowRunner,
+                                          parse_policy)
+
+
+class TestShadow(unittest.TestCase):
+
+    def test_policy(self):
+        policy = parse_policy('strict treshold=3 br_treshold=2 '
+                              'blacklist_ttl=10 br_blacklist_ttl=0.5 '
+                              'bad_statuses=400,5xx')
+        self.assertEqual((policy.name, policy.counters.treshold),
+                         ('strict', 3))
+        self.assertEqual(policy.br_blacklist_ttl, .5)
+
+        now = time.time()
+        results = [policy.check('ip', '200', now) for i in range(4)]
+        self.assertEqual(results, [False, False, False, True])
+        self.assertFalse(policy.check('ip', '200', now + 11))
+
+        self.assertFalse(policy.check('other', '400', now))
+        self.assertFalse(policy.check('other', '503', now))
+        self.assertTrue(policy.check('other', None, now))
+
+    def test_policy_routes_and_prefixes(self):
+        bans = []
+        policy = parse_policy('strict treshold=100 '
+                              'prefix_tresholds=24:4,16:1000',
+                              route_costs=['POST /login 2 4'],
+                              callback=bans.append)
+        now = time.time()
+        self.assertFalse(policy.check('10.0.0.1', '200', now, 'POST',
+                                      '/login'))
+        self.assertFalse(policy.check('10.0.0.1', '200', now, 'POST',
+                                      '/login'))
+        self.assertEqual(bans, ['10.0.0.0/24', '10.0.0.1'])
+        # the whole network is banned
+        self.assertTrue(policy.check('10.0.0.2', '200', now))
+        self.assertFalse(policy.check('10.0.1.1', '200', now))
+        self.assertFalse(policy.check('10.0.0.2', '200', now + 301))
+
+    def test_runner(self):
+        runner = ShadowRunner([CounterPolicy('strict', treshold=2)])
+        runner.start()
+        for live_blocked in (False, False, False, True):
+            runner.submit('ip', live_blocked, '200')
+        runner.submit('other', True)
+        runner.join(1.)
+        self.assertEqual(runner.stats(), {'strict': {
+            'requests': 5, 'blocked': 2, 'both': 1, 'shadow_only': 1,
+            'live_only': 1}})
+
+        # a full queue drops requests rather than blocking
+        runner = ShadowRunner([], queue_size=1)
+        runner.submit('ip', False)
+        runner.submit('ip', False)
+        self.assertEqual(runner.dropped, 1)
@@ -85,9 +85,15 @@ class MemoryClient(dict):
         del self[key]
         return True
 
-    def incr(self, key):
-        val = self[key]
-        self[key] = str(int(val) + 1)
+    def incr(self, key, delta=1):
+        if key not in self:
+            return None
+        val = int(self[key]) + delta
+        self[key] = str(val)
+        return val
+
+    def get_multi(self, keys):
+        return dict([(key, self[key]) for key in keys if key in self])
 
 
 class PrefixedCache(object):
@@ -38,7 +38,6 @@ KeyExchange server - see https://wiki.mozilla.org/Services/Sync/SyncKey/J-PAKE
 """
 import re
 from hashlib import md5
-import time
 import random
 import json
 import sys
@@ -55,6 +54,8 @@ from services.config import Config
 from keyexchange.util import (generate_cid, json_response, CID_CHARS,
                               PrefixedCache, get_memcache_class)
 from keyexchange.filtering import IPFiltering
+from keyexchange.filtering.bloom import RotatingBloomFilter
+from keyexchange.clock import Clock, get_clock
 
 
 _URL = re.compile('^/(new_channel|report|[%s]+)/?$' % CID_CHARS)
@@ -101,6 +102,11 @@ class KeyExchangeApp(object):
         self.config = config
         self.cid_len = config.get('keyexchange.cid_len', 4)
         self.ttl = config.get('keyexchange.ttl', 300)
+        resolution = config.get('keyexchange.clock_resolution')
+        if resolution is None:
+            self.clock = get_clock()
+        else:
+            self.clock = Clock(resolution)
         self.max_gets = config.get('keyexchange.max_gets', 6)
         self.root = self.config.get('keyexchange.root_redirect')
         servers = config.get('keyexchange.cache_servers', ['127.0.0.1:11211'])
@@ -117,10 +123,20 @@ class KeyExchangeApp(object):
         use_memory = config.get('keyexchange.use_memory', False)
         cache = get_memcache_class(use_memory)(self.cache_servers)
         self.cache = PrefixedCache(cache, _CPREFIX)
+        # filter of the channels created by this process, used to answer
+        # 404s without querying memcache. Only safe if every request for
+        # a channel is served by the process that created it.
+        if config.get('keyexchange.channel_filter', False):
+            capacity = config.get('keyexchange.channel_filter_capacity',
+                                  100000)
+            self.channels = RotatingBloomFilter(capacity, period=self.ttl,
+                                                clock=self.clock)
+        else:
+            self.channels = None
 
     def _get_new_cid(self, client_id):
         tries = 0
-        ttl = time.time() + self.ttl
+        ttl = self.clock.time() + self.ttl
         content = ttl, [client_id], _EMPTY, None
 
         while tries < 100:
@@ -137,6 +153,8 @@ class KeyExchangeApp(object):
         if not success:
             raise HTTPServiceUnavailable()
 
+        if self.channels is not None:
+            self.channels.add(new_cid)
         return new_cid
 
     def _health_check(self):
@@ -240,7 +258,10 @@ class KeyExchangeApp(object):
 
                 raise HTTPBadRequest()
 
-        content = self.cache.get(channel_id)
+        if self.channels is not None and channel_id not in self.channels:
+            content = None
+        else:
+            content = self.cache.get(channel_id)
         if content is None:
             # we have a valid channel id but it does not exists.
             log = 'Invalid X-KeyExchange-Channel'
@@ -42,6 +42,9 @@ main = keyexchange.wsgiapp:make_app
 
 [paste.app_install]
 main = paste.script.appinstall:Installer
+
+[console_scripts]
+keyexchange-replay = keyexchange.filtering.replay:main
 """
 
 requires = ['WebOb', 'Paste', 'PasteScript',